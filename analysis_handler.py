@@ -1,23 +1,8 @@
-from googleapiclient.discovery import build
-from google_auth import get_google_credentials
+from google_transport import build_service
 from datetime import datetime
 import pytz
 
 
-def extract_amount_number(amount_str):
-    """
-    Извлекает число из строки суммы
-    """
-    if not amount_str or amount_str == "Не распознано":
-        return 0
-    
-    try:
-        clean_str = amount_str.replace('₽', '').replace(' ', '').replace(',', '.').strip()
-        return float(clean_str)
-    except:
-        return 0
-
-
 class AnalysisSheetHandler:
     """
     Handler для создания НОВЫХ таблиц для массового анализа
@@ -28,9 +13,8 @@ class AnalysisSheetHandler:
         """
         Инициализация без spreadsheet_id - будем создавать новые таблицы
         """
-        creds = get_google_credentials()
-        self.service = build('sheets', 'v4', credentials=creds)
-        self.drive_service = build('drive', 'v3', credentials=creds)
+        self.service = build_service('sheets', 'v4')
+        self.drive_service = build_service('drive', 'v3')
     
     def create_analysis_spreadsheet(self, title, folder_id):
         """
@@ -107,22 +91,12 @@ class AnalysisSheetHandler:
             body=body
         ).execute()
     
-    def add_receipt_to_sheet(self, spreadsheet_id, data):
+    def add_receipt_to_sheet(self, spreadsheet_id, receipt):
         """
-        Добавление данных чека в таблицу анализа
+        Добавление чека (receipt_model.Receipt) в таблицу анализа
         (без timestamp - только данные чека)
         """
-        row = [
-            data.get('date', 'Не распознано'),
-            data.get('full_name', 'Не распознано'),
-            data.get('buyer_inn', 'Не распознано'),
-            data.get('services', 'Не распознано'),
-            extract_amount_number(data.get('amount', '0')),
-            data.get('status', 'Не распознано'),
-            data.get('fns_url', ''),
-            data.get('drive_link', ''),
-            data.get('error_details', '')
-        ]
+        row = receipt.analysis_row()
         
         body = {
             'values': [row]
@@ -0,0 +1,299 @@
+"""
+Фоновая очередь задач массового анализа (/full_analyze)
+
+Кнопка «Начать анализ» только ставит задачу в очередь (StateBackend),
+а выполняют ее воркеры - корутины, запущенные при старте бота.
+Воркер продлевает владение задачей, пока она выполняется; если процесс
+упал или был перезапущен, задача с истекшим сроком владения снова
+захватывается и продолжается (уже обработанные файлы пропускаются).
+"""
+import asyncio
+import logging
+import os
+import time
+
+from memory_budget import MB, RssSampler
+from vision_usage import usage_scope, record_chat_usage, format_usage_short
+from scratch_space import get_scratch_space
+from state_backend import (
+    get_state_backend,
+    WORKER_ID,
+    JOB_QUEUED,
+    JOB_RUNNING,
+    JOB_DONE,
+    JOB_FAILED,
+    JOB_CANCELLED,
+)
+
+logger = logging.getLogger(__name__)
+
+# Число одновременно выполняемых задач в одном процессе
+ANALYSIS_WORKERS = int(os.getenv('ANALYSIS_WORKERS', '2'))
+# Как часто свободный воркер проверяет очередь (задачи из других процессов)
+ANALYSIS_POLL_INTERVAL = float(os.getenv('ANALYSIS_POLL_INTERVAL', '2'))
+# Срок владения задачей; продлевается каждые JOB_LEASE_TTL / 3 секунд
+JOB_LEASE_TTL = int(os.getenv('JOB_LEASE_TTL', '60'))
+# Сколько раз задачу можно начать заново (после падений процесса)
+ANALYSIS_MAX_ATTEMPTS = int(os.getenv('ANALYSIS_MAX_ATTEMPTS', '3'))
+# Сколько ждать завершения текущего файла при остановке бота
+ANALYSIS_SHUTDOWN_TIMEOUT = float(os.getenv('ANALYSIS_SHUTDOWN_TIMEOUT', '30'))
+
+STATUS_NAMES = {
+    JOB_QUEUED: 'в очереди',
+    JOB_RUNNING: 'выполняется',
+    JOB_DONE: 'завершен',
+    JOB_FAILED: 'ошибка',
+    JOB_CANCELLED: 'отменен',
+}
+
+
+class JobStopped(Exception):
+    """Задача остановлена до завершения"""
+
+
+class JobCancelled(JobStopped):
+    """Пользователь отменил задачу (/cancel)"""
+
+
+class JobInterrupted(JobStopped):
+    """Бот останавливается или задачу захватил другой воркер - задача вернется в очередь"""
+
+
+class JobContext:
+    """
+    То, что видит функция-исполнитель задачи: проверка отмены и отчет о прогрессе
+    """
+
+    def __init__(self, queue, job):
+        self.job = job
+        self.resumed = job['attempts'] > 1
+        self.lease_lost = False
+        # Область временных файлов задачи (удаляется по завершении задачи)
+        self.scratch = None
+        self._queue = queue
+
+    @property
+    def progress(self):
+        """Прогресс, сохраненный предыдущими попытками (при возобновлении)"""
+        return self.job.get('progress') or {}
+
+    def checkpoint(self):
+        """
+        Вызывается между файлами: бросает JobCancelled или JobInterrupted,
+        если задачу нужно остановить
+        """
+        if self._queue.stopping or self.lease_lost:
+            raise JobInterrupted()
+        job = self._queue.state.get_job(self.job['id'])
+        if job and job['cancel_requested']:
+            raise JobCancelled()
+
+    def report_progress(self, **progress):
+        """Сохранение прогресса (видно в /status и при возобновлении)"""
+        self.job['progress'] = {**self.progress, **progress}
+        self._queue.state.update_job(self.job['id'], progress=self.job['progress'])
+
+
+class AnalysisJobQueue:
+    """
+    Очередь задач анализа и пул воркеров
+
+    runner - корутина runner(bot, job, context), выполняющая задачу
+    и возвращающая словарь с результатом
+    """
+
+    def __init__(self, runner, state=None, workers=ANALYSIS_WORKERS,
+                 poll_interval=ANALYSIS_POLL_INTERVAL, lease_ttl=JOB_LEASE_TTL):
+        self.runner = runner
+        self.state = state or get_state_backend()
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.lease_ttl = lease_ttl
+        self.stopping = False
+        self.bot = None
+        self._tasks = []
+        self._wakeup = None
+
+    def enqueue(self, chat_id, payload, dedupe_key=None):
+        """
+        Постановка задачи в очередь
+        Возвращает (job, created) - см. StateBackend.enqueue_job
+        """
+        job, created = self.state.enqueue_job('full_analyze', chat_id, payload, dedupe_key)
+        if created:
+            logger.info(f"Задача {job['id']} поставлена в очередь (чат {chat_id})")
+            if self._wakeup:
+                self._wakeup.set()
+        return job, created
+
+    def queue_position(self, job):
+        """Позиция задачи в общей очереди (1 - следующая) или None"""
+        if job['status'] != JOB_QUEUED:
+            return None
+        queued = self.state.list_jobs(statuses=[JOB_QUEUED])
+        return 1 + sum(1 for j in queued if j['created_at'] < job['created_at'])
+
+    async def start(self, bot):
+        """Запуск воркеров (вызывается из post_init приложения)"""
+        self.bot = bot
+        self.stopping = False
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker(n)) for n in range(self.workers)]
+        logger.info(f"Запущено воркеров анализа: {self.workers} ({WORKER_ID})")
+
+    async def stop(self):
+        """
+        Остановка воркеров: текущие файлы дорабатываются (не дольше
+        ANALYSIS_SHUTDOWN_TIMEOUT), незавершенные задачи возвращаются в очередь
+        """
+        if not self._tasks:
+            return
+        self.stopping = True
+        self._wakeup.set()
+        _, pending = await asyncio.wait(self._tasks, timeout=ANALYSIS_SHUTDOWN_TIMEOUT)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        self._tasks = []
+        self.state.release_owned_jobs(WORKER_ID)
+        logger.info("Воркеры анализа остановлены")
+
+    async def _worker(self, number):
+        while not self.stopping:
+            try:
+                job = self.state.claim_next_job(WORKER_ID, self.lease_ttl)
+            except Exception as e:
+                logger.error(f"Воркер {number}: ошибка чтения очереди: {e}")
+                job = None
+
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._run(job)
+
+    async def _heartbeat(self, context):
+        while True:
+            await asyncio.sleep(self.lease_ttl / 3)
+            if not self.state.heartbeat_job(context.job['id'], WORKER_ID, self.lease_ttl):
+                logger.warning(f"Задача {context.job['id']}: владение потеряно")
+                context.lease_lost = True
+                return
+
+    async def _run(self, job):
+        job_id = job['id']
+        started = time.time()
+        queue_wait = job['started_at'] - job['created_at']
+
+        if job['attempts'] > ANALYSIS_MAX_ATTEMPTS:
+            logger.error(f"Задача {job_id}: превышено число попыток ({job['attempts'] - 1})")
+            self.state.update_job(job_id, status=JOB_FAILED, finished_at=started,
+                                  result={'error': 'превышено число попыток'})
+            await self._notify(job['chat_id'], "❌ Анализ прерван: задача несколько раз не смогла завершиться")
+            return
+
+        logger.info(
+            f"Задача {job_id} начата (попытка {job['attempts']}), "
+            f"ожидание в очереди {queue_wait:.1f} с"
+        )
+
+        context = JobContext(self, job)
+        heartbeat = asyncio.create_task(self._heartbeat(context))
+        status = JOB_DONE
+        result = {}
+        # Пиковый RSS процесса за время задачи (при нескольких воркерах
+        # включает память параллельных задач)
+        rss = RssSampler(interval=0.1)
+        try:
+            with rss, usage_scope() as usage, get_scratch_space().scope(f"job{job_id}") as scratch:
+                context.scratch = scratch
+                result = await self.runner(self.bot, job, context) or {}
+        except JobCancelled:
+            status = JOB_CANCELLED
+        except JobInterrupted:
+            status = JOB_QUEUED
+        except Exception as e:
+            logger.error(f"Задача {job_id} завершилась с ошибкой: {e}")
+            status = JOB_FAILED
+            result = {'error': str(e)}
+        finally:
+            heartbeat.cancel()
+
+        # Запросы к OpenAI оплачены, даже если задача прервана
+        vision = usage.as_dict()
+        record_chat_usage(self.state, job['chat_id'], vision)
+
+        if status == JOB_QUEUED:
+            # Вернется в очередь: при остановке бота это сделает stop(),
+            # при потере владения задача уже принадлежит другому воркеру
+            logger.info(f"Задача {job_id} прервана, будет продолжена позже")
+            return
+
+        finished = time.time()
+        elapsed = finished - started
+        done = context.progress.get('done', 0)
+        result.update({
+            'queue_wait_s': round(queue_wait, 1),
+            'elapsed_s': round(elapsed, 1),
+            'files_per_min': round(done / elapsed * 60, 1) if elapsed > 0 else 0.0,
+            'peak_rss_mb': round(rss.peak / MB),
+            'vision': vision,
+        })
+        self.state.update_job(job_id, status=status, finished_at=finished, result=result)
+        logger.info(
+            f"Задача {job_id}: {STATUS_NAMES[status]}, файлов {done} за {elapsed:.1f} с "
+            f"({result['files_per_min']} файлов/мин), ожидание в очереди {queue_wait:.1f} с, "
+            f"пиковый RSS {result['peak_rss_mb']} МБ, {format_usage_short(vision)}"
+        )
+
+    async def _notify(self, chat_id, text):
+        try:
+            await self.bot.send_message(chat_id, text)
+        except Exception as e:
+            logger.error(f"Не удалось отправить сообщение в чат {chat_id}: {e}")
+
+
+def format_job_status(job, position=None):
+    """
+    Текст для /status
+    """
+    payload = job.get('payload') or {}
+    progress = job.get('progress') or {}
+    result = job.get('result') or {}
+    folder_name = payload.get('folder_info', {}).get('folder_name', job['id'])
+
+    status = STATUS_NAMES.get(job['status'], job['status'])
+    if position:
+        status += f" (позиция {position})"
+    if job['status'] == JOB_RUNNING and job['cancel_requested']:
+        status += ", отмена запрошена"
+
+    lines = [f"📋 Анализ «{folder_name}»", f"Статус: {status}"]
+
+    if progress.get('total'):
+        lines.append(
+            f"Обработано: {progress.get('done', 0)}/{progress['total']} "
+            f"(✅ {progress.get('success', 0)}, ❌ {progress.get('errors', 0)})"
+        )
+
+    if job['status'] == JOB_RUNNING and job['started_at']:
+        elapsed = time.time() - job['started_at']
+        if elapsed > 0 and progress.get('done'):
+            lines.append(f"Скорость: {progress['done'] / elapsed * 60:.1f} файлов/мин")
+        lines.append(f"Ожидание в очереди: {job['started_at'] - job['created_at']:.0f} с")
+    elif 'files_per_min' in result:
+        lines.append(f"Скорость: {result['files_per_min']} файлов/мин")
+        lines.append(f"Ожидание в очереди: {result['queue_wait_s']:.0f} с")
+        if result.get('peak_rss_mb'):
+            lines.append(f"Пик памяти: {result['peak_rss_mb']} МБ")
+        if result.get('vision', {}).get('calls'):
+            lines.append(format_usage_short(result['vision']))
+
+    if result.get('error'):
+        lines.append(f"Ошибка: {result['error']}")
+
+    return '\n'.join(lines)
@@ -0,0 +1,4 @@
+"""
+Бенчмарки и нагрузочные тесты бота (запускаются из корня репозитория:
+python -m benchmarks.<модуль>)
+"""
@@ -0,0 +1,139 @@
+import json
+import os
+import time
+import tracemalloc
+
+# Замер RSS общий с ботом (отчет о пиковой памяти /full_analyze)
+from memory_budget import RssSampler
+
+
+def percentile(values, pct):
+    """
+    Перцентиль по отсортированной выборке (линейная интерполяция)
+    values - список чисел
+    pct - перцентиль от 0 до 100
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct / 100
+    lower = int(k)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (k - lower)
+
+
+def measure_stage(func, inputs, repeat=1):
+    """
+    Прогон одной стадии по всем входам корпуса
+    func - функция стадии (принимает один вход)
+    inputs - список входов
+    repeat - сколько раз прогнать весь корпус
+
+    Возвращает словарь: число вызовов, пропускная способность (вызовов/с),
+    перцентили задержки (мс), пиковая память Python и пиковый прирост RSS (МБ)
+    """
+    latencies = []
+
+    tracemalloc.start()
+    with RssSampler() as rss:
+        started = time.perf_counter()
+        for _ in range(repeat):
+            for item in inputs:
+                t0 = time.perf_counter()
+                func(item)
+                latencies.append((time.perf_counter() - t0) * 1000)
+        elapsed = time.perf_counter() - started
+    _, peak_py = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'calls': len(latencies),
+        'throughput': len(latencies) / elapsed if elapsed > 0 else 0.0,
+        'p50_ms': percentile(latencies, 50),
+        'p90_ms': percentile(latencies, 90),
+        'p99_ms': percentile(latencies, 99),
+        'max_ms': max(latencies) if latencies else 0.0,
+        'peak_py_mb': peak_py / 1024 / 1024,
+        'peak_rss_mb': max(0, rss.peak - rss.start_rss) / 1024 / 1024,
+    }
+
+
+def load_baseline(path):
+    """
+    Загрузка сохраненного baseline (None, если файла нет)
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_baseline(path, results):
+    """
+    Сохранение результатов как нового baseline
+    """
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2, sort_keys=True)
+
+
+# Изменения меньше этих порогов считаем шумом измерений (задержка в мс, память в МБ)
+NOISE_FLOOR = {'p50_ms': 0.05, 'p99_ms': 0.05, 'peak_rss_mb': 1.0}
+
+
+def compare_with_baseline(results, baseline, tolerance=0.10):
+    """
+    Сравнение результатов с baseline
+    tolerance - допустимое ухудшение (0.10 = 10%)
+
+    Возвращает список строк-отчетов и флаг наличия регрессий
+    """
+    lines = []
+    regressed = False
+
+    for stage, current in results.items():
+        base = (baseline or {}).get(stage)
+        if not base or 'error' in current or 'error' in base:
+            lines.append(f"{stage:<22} нет данных для сравнения")
+            continue
+
+        checks = [
+            ('throughput', current['throughput'], base['throughput'], True),
+            ('p50_ms', current['p50_ms'], base['p50_ms'], False),
+            ('p99_ms', current['p99_ms'], base['p99_ms'], False),
+            ('peak_rss_mb', current['peak_rss_mb'], base['peak_rss_mb'], False),
+        ]
+        parts = []
+        for name, now, before, higher_is_better in checks:
+            if not before:
+                continue
+            change = (now - before) / before
+            worse = -change if higher_is_better else change
+            mark = ''
+            if worse > tolerance and abs(now - before) >= NOISE_FLOOR.get(name, 0):
+                mark = ' ❌'
+                regressed = True
+            parts.append(f"{name} {change:+.1%}{mark}")
+        lines.append(f"{stage:<22} " + ', '.join(parts))
+
+    return lines, regressed
+
+
+def format_results(results):
+    """
+    Таблица результатов для вывода в консоль
+    """
+    header = (
+        f"{'Стадия':<22} {'вызовов':>8} {'вызовов/с':>10} {'p50 мс':>9} "
+        f"{'p90 мс':>9} {'p99 мс':>9} {'py МБ':>8} {'RSS МБ':>8}"
+    )
+    lines = [header, '-' * len(header)]
+    for stage, r in results.items():
+        if 'error' in r:
+            lines.append(f"{stage:<22} пропущено: {r['error']}")
+            continue
+        lines.append(
+            f"{stage:<22} {r['calls']:>8} {r['throughput']:>10.1f} {r['p50_ms']:>9.2f} "
+            f"{r['p90_ms']:>9.2f} {r['p99_ms']:>9.2f} {r['peak_py_mb']:>8.1f} "
+            f"{r['peak_rss_mb']:>8.1f}"
+        )
+    return '\n'.join(lines)
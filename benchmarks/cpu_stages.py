@@ -0,0 +1,209 @@
+"""
+Офлайн-бенчмарк локальных (CPU) стадий обработки чека на синтетическом корпусе.
+
+Никаких сетевых вызовов: декодирование изображений, QR, рендер PDF,
+base64-кодирование, разбор текста, валидация и парсинг сумм.
+
+Baseline (benchmarks/baseline_cpu.json) в репозитории не хранится: время
+стадий зависит от машины, поэтому baseline сохраняется локально - перед
+изменениями, на той же машине, где идет сравнение.
+
+Запуск из корня репозитория:
+    python -m benchmarks.cpu_stages                   # прогон и сравнение с baseline
+    python -m benchmarks.cpu_stages --save-baseline   # сохранить результаты как baseline
+    python -m benchmarks.cpu_stages --stages qr,encode_image --repeat 5
+"""
+import argparse
+import json
+import os
+import sys
+
+from benchmarks.common import (
+    compare_with_baseline,
+    format_results,
+    load_baseline,
+    measure_stage,
+    save_baseline,
+)
+
+CORPUS_DIR = os.path.join(os.path.dirname(__file__), 'corpus')
+MANIFEST_PATH = os.path.join(CORPUS_DIR, 'manifest.json')
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline_cpu.json')
+
+
+def load_manifest():
+    with open(MANIFEST_PATH, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _corpus_paths(entries):
+    return [os.path.join(CORPUS_DIR, e['file']) for e in entries]
+
+
+def _corpus_bytes(entries):
+    contents = []
+    for path in _corpus_paths(entries):
+        with open(path, 'rb') as f:
+            contents.append(f.read())
+    return contents
+
+
+def stage_decode(manifest):
+    # Без кэша image_decode: каждый вызов декодирует заново
+    from image_decode import decode_bytes
+    return decode_bytes, _corpus_bytes(manifest['images'])
+
+
+def stage_qr(manifest):
+    from image_decode import decode_bytes
+    from qr_parser import extract_qr_from_image
+
+    # QR получает уже декодированное изображение, как в process_receipt_image
+    return extract_qr_from_image, [decode_bytes(data) for data in _corpus_bytes(manifest['images'])]
+
+
+def stage_pdf_render(manifest):
+    from image_decode import decode_bytes
+    return decode_bytes, _corpus_bytes(manifest['pdfs'])
+
+
+def stage_quality(manifest):
+    from image_decode import decode_bytes
+    from image_quality import measure_quality
+
+    # Проверка качества получает декодированное изображение, как в process_receipt_image
+    return measure_quality, [decode_bytes(data) for data in _corpus_bytes(manifest['images'])]
+
+
+def stage_encode_image(manifest):
+    from openai_vision import OpenAIVisionParser
+
+    # Клиент OpenAI для кодирования не нужен - не создаем его
+    parser = OpenAIVisionParser.__new__(OpenAIVisionParser)
+    return parser.encode_image, _corpus_paths(manifest['images'])
+
+
+def stage_parse_receipt_data(manifest):
+    from ocr_handler import parse_receipt_data
+    return parse_receipt_data, [t['ocr_text'] for t in manifest['texts']]
+
+
+def stage_validate(manifest):
+    from ocr_handler import parse_receipt_data, validate_and_clean_data
+
+    parsed = [parse_receipt_data(t['ocr_text']) for t in manifest['texts']]
+
+    def validate(data):
+        # validate_and_clean_data меняет словарь - работаем с копией
+        return validate_and_clean_data(dict(data))
+
+    return validate, parsed
+
+
+def stage_extract_amount(manifest):
+    from receipt_model import extract_amount_number
+    amounts = [t['amount'] for t in manifest['texts']] + ['Не распознано', '', '7 021.00 ₽']
+    return extract_amount_number, amounts
+
+
+def stage_receipt_rows(manifest):
+    from ocr_handler import parse_receipt_data, validate_and_clean_data
+    from receipt_model import Receipt
+
+    parsed = []
+    for t in manifest['texts']:
+        data = parse_receipt_data(t['ocr_text'])
+        validate_and_clean_data(data)
+        parsed.append(data)
+
+    def build_rows(data):
+        # Как в pipeline: запись из ответа Vision, затем строки обеих таблиц
+        receipt = Receipt.from_dict(data)
+        return receipt.registry_row('13.08.2025 12:00:00', 'Прямая загрузка'), receipt.analysis_row()
+
+    return build_rows, parsed
+
+
+STAGES = {
+    'decode': stage_decode,
+    'qr': stage_qr,
+    'pdf_render': stage_pdf_render,
+    'quality': stage_quality,
+    'encode_image': stage_encode_image,
+    'parse_receipt_data': stage_parse_receipt_data,
+    'validate': stage_validate,
+    'extract_amount': stage_extract_amount,
+    'receipt_rows': stage_receipt_rows,
+}
+
+# Быстрые стадии гоняем больше раз, чтобы перцентили были осмысленными
+REPEAT_MULTIPLIER = {
+    'parse_receipt_data': 20,
+    'validate': 50,
+    'extract_amount': 200,
+    'receipt_rows': 50,
+}
+
+
+def run(stage_names, repeat):
+    """
+    Прогон выбранных стадий. Стадии, для которых нет зависимостей
+    (например, zbar или poppler), попадают в отчет как пропущенные
+    """
+    manifest = load_manifest()
+    results = {}
+
+    for name in stage_names:
+        try:
+            func, inputs = STAGES[name](manifest)
+            # Прогрев: первый вызов платит за импорт и инициализацию библиотек
+            func(inputs[0])
+            results[name] = measure_stage(func, inputs, repeat * REPEAT_MULTIPLIER.get(name, 1))
+        except Exception as e:
+            results[name] = {'error': f"{type(e).__name__}: {e}"}
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк CPU-стадий обработки чеков')
+    parser.add_argument('--stages', default=','.join(STAGES),
+                        help='Стадии через запятую (по умолчанию все)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Сколько раз прогнать корпус')
+    parser.add_argument('--baseline', default=BASELINE_PATH,
+                        help='Путь к файлу baseline')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Сохранить результаты как новый baseline')
+    parser.add_argument('--tolerance', type=float, default=0.10,
+                        help='Допустимое ухудшение относительно baseline (0.10 = 10%%)')
+    args = parser.parse_args()
+
+    stage_names = [s.strip() for s in args.stages.split(',') if s.strip()]
+    unknown = [s for s in stage_names if s not in STAGES]
+    if unknown:
+        parser.error(f"Неизвестные стадии: {', '.join(unknown)}")
+
+    results = run(stage_names, args.repeat)
+    print(format_results(results))
+
+    if args.save_baseline:
+        save_baseline(args.baseline, results)
+        print(f"\n✅ Baseline сохранен: {args.baseline}")
+        return 0
+
+    baseline = load_baseline(args.baseline)
+    if baseline is None:
+        print(f"\n⚠️ Baseline не найден ({args.baseline}) - сравнения не было.\n"
+              f"Baseline не хранится в репозитории (время зависит от машины): сохрани его "
+              f"на этой машине до изменений - python -m benchmarks.cpu_stages --save-baseline")
+        return 0
+
+    lines, regressed = compare_with_baseline(results, baseline, args.tolerance)
+    print("\nСравнение с baseline:")
+    print('\n'.join(lines))
+    return 1 if regressed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
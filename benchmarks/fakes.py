@@ -0,0 +1,798 @@
+"""
+Локальные заменители внешних сервисов для нагрузочного теста:
+Telegram Bot API, Google Drive/Sheets, OpenAI и ФНС.
+
+У каждого заменителя настраиваемая задержка и доля ошибок (FaultInjector).
+"""
+import asyncio
+import hashlib
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram.request import BaseRequest
+
+
+class FaultInjector:
+    """
+    Задержка и ошибки для заменителя сервиса
+    latency_ms - средняя задержка ответа
+    jitter_ms - разброс задержки (равномерно ±jitter_ms)
+    error_rate - доля запросов, завершающихся ошибкой (0..1)
+    """
+
+    def __init__(self, latency_ms=0, jitter_ms=0, error_rate=0.0, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def delay(self):
+        """Задержка в секундах для очередного запроса"""
+        with self._lock:
+            jitter = self._rng.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0
+        return max(0.0, self.latency_ms + jitter) / 1000
+
+    def should_fail(self):
+        if not self.error_rate:
+            return False
+        with self._lock:
+            return self._rng.random() < self.error_rate
+
+
+# ---------------------------------------------------------------------------
+# Telegram
+# ---------------------------------------------------------------------------
+
+class FakeTelegramRequest(BaseRequest):
+    """
+    Заменитель HTTP-транспорта python-telegram-bot: отвечает на вызовы Bot API
+    локально и отдает файлы (фото/PDF) из переданного словаря
+
+    files - {file_id: bytes} для getFile + скачивания
+    """
+
+    def __init__(self, files=None, faults=None):
+        self.files = files if files is not None else {}
+        self.faults = faults or FaultInjector()
+        self.calls = Counter()
+        self.sent = defaultdict(list)  # chat_id -> [текст сообщения, ...]
+        self._message_ids = itertools.count(1000)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        delay = self.faults.delay()
+        if delay:
+            await asyncio.sleep(delay)
+
+        # Скачивание файла: https://api.telegram.org/file/bot<token>/<file_path>
+        if '/file/bot' in url:
+            self.calls['downloadFile'] += 1
+            file_id = url.rsplit('/', 1)[-1].split('.', 1)[0]
+            return 200, self.files.get(file_id, b'')
+
+        api_method = url.rsplit('/', 1)[-1]
+        self.calls[api_method] += 1
+        params = request_data.parameters if request_data else {}
+
+        if self.faults.should_fail():
+            return 500, json.dumps({'ok': False, 'error_code': 500,
+                                    'description': 'Injected error'}).encode()
+
+        result = self._handle(api_method, params)
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+    def _message(self, chat_id, text=None, message_id=None):
+        message = {
+            'message_id': message_id or next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'private'},
+        }
+        if text is not None:
+            message['text'] = text
+        return message
+
+    def _handle(self, api_method, params):
+        if api_method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'LoadTest', 'username': 'load_test_bot'}
+
+        if api_method in ('sendMessage', 'editMessageText'):
+            chat_id = params.get('chat_id')
+            text = params.get('text', '')
+            self.sent[int(chat_id)].append(text)
+            return self._message(chat_id, text, params.get('message_id'))
+
+        if api_method in ('sendDocument', 'sendPhoto'):
+            chat_id = params.get('chat_id')
+            self.sent[int(chat_id)].append(f'<{api_method}>')
+            return self._message(chat_id)
+
+        if api_method == 'getFile':
+            file_id = params['file_id']
+            return {
+                'file_id': file_id,
+                'file_unique_id': file_id,
+                'file_size': len(self.files.get(file_id, b'')),
+                'file_path': f'documents/{file_id}.bin',
+            }
+
+        # answerCallbackQuery, deleteWebhook и прочие служебные вызовы
+        return True
+
+
+def make_user(chat_id):
+    return {'id': chat_id, 'is_bot': False, 'first_name': 'Load', 'username': f'load_{chat_id}'}
+
+
+def photo_update(update_id, chat_id, file_id, width=1280, height=1707):
+    """Синтетический Update с фото (PhotoSize: превью + полный размер)"""
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': make_user(chat_id),
+            'photo': [
+                {'file_id': f'{file_id}_s', 'file_unique_id': f'{file_id}_s',
+                 'width': width // 4, 'height': height // 4},
+                {'file_id': file_id, 'file_unique_id': file_id,
+                 'width': width, 'height': height},
+            ],
+        },
+    }
+
+
+def document_update(update_id, chat_id, file_id, file_name='receipt.pdf'):
+    """Синтетический Update с документом"""
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': make_user(chat_id),
+            'document': {'file_id': file_id, 'file_unique_id': file_id,
+                         'file_name': file_name, 'mime_type': 'application/pdf'},
+        },
+    }
+
+
+def command_update(update_id, chat_id, command):
+    """Синтетический Update с командой (например, /full_analyze)"""
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': make_user(chat_id),
+            'text': command,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command.split()[0])}],
+        },
+    }
+
+
+def callback_update(update_id, chat_id, data):
+    """Синтетический Update с нажатием inline-кнопки"""
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': make_user(chat_id),
+            'chat_instance': str(chat_id),
+            'data': data,
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': '✅ Папка создана!',
+            },
+        },
+    }
+
+
+# ---------------------------------------------------------------------------
+# Google Drive / Sheets
+# ---------------------------------------------------------------------------
+
+class FakeHttpError(Exception):
+    """Ошибка Google API (если googleapiclient недоступен)"""
+
+
+def _http_error(status=503):
+    try:
+        import httplib2
+        from googleapiclient.errors import HttpError
+        return HttpError(httplib2.Response({'status': status}), b'Injected error')
+    except ImportError:
+        return FakeHttpError(f'HTTP {status}')
+
+
+class FakeCall:
+    """
+    Ленивый запрос в стиле googleapiclient: результат вычисляется в execute()
+    """
+
+    def __init__(self, backend, func):
+        self._backend = backend
+        self._func = func
+
+    def execute(self, num_retries=0):
+        self._backend.calls += 1
+        delay = self._backend.faults.delay()
+        if delay:
+            time.sleep(delay)  # httplib2 - блокирующий клиент
+        if self._backend.faults.should_fail():
+            raise _http_error()
+        return self._func()
+
+
+class _MediaResponse(dict):
+    def __init__(self, status, headers):
+        super().__init__(headers)
+        self.status = status
+
+
+class _MediaHttp:
+    """HTTP-объект для MediaIoBaseDownload: отдает содержимое файла одним куском"""
+
+    def __init__(self, backend, content):
+        self._backend = backend
+        self._content = content
+
+    def request(self, uri, method='GET', headers=None, **kwargs):
+        delay = self._backend.faults.delay()
+        if delay:
+            time.sleep(delay)
+        return _MediaResponse(200, {'content-length': str(len(self._content))}), self._content
+
+
+class _MediaRequest:
+    def __init__(self, backend, content):
+        self.http = _MediaHttp(backend, content)
+        self.uri = 'https://fake.googleapis.com/media'
+        self.headers = {}
+
+
+class FakeGoogleBackend:
+    """
+    Общее хранилище для фейковых Drive и Sheets: файлы, папки и строки таблиц
+    """
+
+    FOLDER = 'application/vnd.google-apps.folder'
+    SPREADSHEET = 'application/vnd.google-apps.spreadsheet'
+
+    def __init__(self, faults=None):
+        self.faults = faults or FaultInjector()
+        self.calls = 0
+        self.files = {}    # id -> {'id', 'name', 'mimeType', 'parents', 'content'}
+        self.values = defaultdict(list)  # (spreadsheet_id, лист) -> [строки]
+        self.sheets = defaultdict(list)  # spreadsheet_id -> [свойства листов по порядку]
+        self.sheets_lock = threading.Lock()
+        self.change_log = []  # id файла на каждое изменение (лента changes.list)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def new_id(self, prefix):
+        with self._lock:
+            return f'{prefix}{next(self._ids)}'
+
+    def add_file(self, parent_id, name, mime_type, content=b''):
+        """Положить файл в папку (как если бы пользователь загрузил его на Drive)"""
+        file_id = self.new_id('file')
+        self.files[file_id] = {'id': file_id, 'name': name, 'mimeType': mime_type,
+                               'parents': [parent_id], 'content': content}
+        self.record_change(file_id)
+        return file_id
+
+    def record_change(self, file_id):
+        with self._lock:
+            self.change_log.append(file_id)
+
+    def matches(self, query, f):
+        """Минимальный разбор q-запросов Drive, которые использует бот"""
+        if 'trashed=false' in query and f.get('trashed'):
+            return False
+        for name in re.findall(r"name='([^']*)'", query):
+            if f['name'] != name:
+                return False
+        for parent in re.findall(r"'([^']*)' in parents", query):
+            if parent not in f['parents']:
+                return False
+        for mime in re.findall(r"mimeType\s*=\s*'([^']*)'", query):
+            if f['mimeType'] != mime:
+                return False
+        for mime in re.findall(r"mimeType\s*!=\s*'([^']*)'", query):
+            if f['mimeType'] == mime:
+                return False
+        for key, value in re.findall(r"appProperties has \{ key='([^']*)' and value='([^']*)' \}", query):
+            if f.get('appProperties', {}).get(key) != value:
+                return False
+        return True
+
+    def link(self, file_id, mime_type):
+        if mime_type == self.FOLDER:
+            return f'https://drive.google.com/drive/folders/{file_id}'
+        if mime_type == self.SPREADSHEET:
+            return f'https://docs.google.com/spreadsheets/d/{file_id}'
+        return f'https://drive.google.com/file/d/{file_id}/view'
+
+
+class FakeDriveFiles:
+    def __init__(self, backend):
+        self.b = backend
+
+    def list(self, q='', fields=None, pageSize=100, **kwargs):
+        return FakeCall(self.b, lambda: {
+            'files': [{'id': f['id'], 'name': f['name'], 'mimeType': f['mimeType'],
+                       'size': str(len(f.get('content', b''))),
+                       'webViewLink': self.b.link(f['id'], f['mimeType'])}
+                      for f in list(self.b.files.values()) if self.b.matches(q, f)][:pageSize]
+        })
+
+    def create(self, body, fields=None, media_body=None, **kwargs):
+        def run():
+            mime_type = body.get('mimeType', 'application/octet-stream')
+            file_id = self.b.new_id('folder' if mime_type == self.b.FOLDER else 'file')
+            self.b.files[file_id] = {'id': file_id, 'name': body.get('name', ''),
+                                     'mimeType': mime_type, 'parents': list(body.get('parents', [])),
+                                     'appProperties': dict(body.get('appProperties', {})),
+                                     'content': b''}
+            self.b.record_change(file_id)
+            return {'id': file_id, 'webViewLink': self.b.link(file_id, mime_type)}
+        return FakeCall(self.b, run)
+
+    def get(self, fileId, fields=None, **kwargs):
+        def run():
+            f = self.b.files.get(fileId, {'id': fileId, 'parents': ['root'], 'mimeType': ''})
+            return {'id': fileId, 'parents': f['parents'],
+                    'webViewLink': self.b.link(fileId, f['mimeType'])}
+        return FakeCall(self.b, run)
+
+    def update(self, fileId, addParents=None, removeParents=None, fields=None, **kwargs):
+        def run():
+            f = self.b.files.setdefault(fileId, {'id': fileId, 'name': '', 'parents': [],
+                                                 'mimeType': self.b.SPREADSHEET})
+            if removeParents:
+                f['parents'] = [p for p in f['parents'] if p not in removeParents.split(',')]
+            if addParents:
+                f['parents'].extend(addParents.split(','))
+            self.b.record_change(fileId)
+            return {'id': fileId, 'parents': f['parents']}
+        return FakeCall(self.b, run)
+
+    def get_media(self, fileId, **kwargs):
+        self.b.calls += 1
+        return _MediaRequest(self.b, self.b.files.get(fileId, {}).get('content', b''))
+
+
+class FakeDriveChanges:
+    """Лента изменений: позиция (page token) - номер следующего изменения в change_log"""
+
+    def __init__(self, backend):
+        self.b = backend
+
+    def getStartPageToken(self, **kwargs):
+        return FakeCall(self.b, lambda: {'startPageToken': str(len(self.b.change_log) + 1)})
+
+    def list(self, pageToken, pageSize=100, fields=None, **kwargs):
+        def run():
+            start = int(pageToken) - 1
+            ids = self.b.change_log[start:start + pageSize]
+            changes = []
+            for file_id in ids:
+                f = self.b.files.get(file_id)
+                if f is None:
+                    changes.append({'fileId': file_id, 'removed': True})
+                    continue
+                changes.append({'fileId': file_id, 'removed': False, 'file': {
+                    'id': file_id, 'name': f['name'], 'mimeType': f['mimeType'],
+                    'size': str(len(f.get('content', b''))), 'parents': list(f['parents']),
+                    'trashed': bool(f.get('trashed')),
+                }})
+            end = start + len(ids)
+            if end < len(self.b.change_log):
+                return {'changes': changes, 'nextPageToken': str(end + 1)}
+            return {'changes': changes, 'newStartPageToken': str(end + 1)}
+        return FakeCall(self.b, run)
+
+
+class FakeDriveService:
+    def __init__(self, backend):
+        self._files = FakeDriveFiles(backend)
+        self._changes = FakeDriveChanges(backend)
+
+    def files(self):
+        return self._files
+
+    def changes(self):
+        return self._changes
+
+
+class FakeSheetValues:
+    def __init__(self, backend):
+        self.b = backend
+
+    @staticmethod
+    def _sheet(range_):
+        return range_.split('!', 1)[0].strip("'") if '!' in range_ else ''
+
+    def append(self, spreadsheetId, range, body, valueInputOption=None, **kwargs):
+        def run():
+            rows = self.b.values[(spreadsheetId, self._sheet(range))]
+            start = len(rows) + 1
+            rows.extend(body.get('values', []))
+            prefix = f"{self._sheet(range)}!" if self._sheet(range) else ''
+            return {'updates': {'updatedRange': f'{prefix}A{start}:J{len(rows)}',
+                                'updatedRows': len(body.get('values', []))}}
+        return FakeCall(self.b, run)
+
+    def update(self, spreadsheetId, range, body, valueInputOption=None, **kwargs):
+        def run():
+            rows = self.b.values[(spreadsheetId, self._sheet(range))]
+            if not rows:
+                rows.extend(body.get('values', []))
+            return {'updatedRows': len(body.get('values', []))}
+        return FakeCall(self.b, run)
+
+    def get(self, spreadsheetId, range, **kwargs):
+        # Диапазон вида 'A5:J' или 'A5:J100' - строки с 5-й (по 100-ю)
+        match = re.fullmatch(r'[A-Z]+(\d*)(?::[A-Z]+(\d*))?', range.split('!')[-1])
+        start = int(match.group(1)) - 1 if match and match.group(1) else 0
+        end = int(match.group(2)) if match and match.group(2) else None
+        return FakeCall(self.b, lambda: {
+            'values': [list(r) for r in self.b.values[(spreadsheetId, self._sheet(range))][start:end]]
+        })
+
+    def _cell(self, spreadsheet_id, range_):
+        """(строки листа, индекс строки, индекс колонки) для диапазона из одной ячейки 'F5'"""
+        match = re.fullmatch(r'([A-Z])(\d+)', range_.split('!')[-1])
+        return (self.b.values[(spreadsheet_id, self._sheet(range_))],
+                int(match.group(2)) - 1, ord(match.group(1)) - ord('A'))
+
+    def batchGet(self, spreadsheetId, ranges, **kwargs):
+        def run():
+            result = []
+            for range_ in ranges:
+                rows, row, column = self._cell(spreadsheetId, range_)
+                value = rows[row][column] if row < len(rows) and column < len(rows[row]) else ''
+                result.append({'range': range_, 'values': [[value]] if value != '' else []})
+            return {'valueRanges': result}
+        return FakeCall(self.b, run)
+
+    def batchUpdate(self, spreadsheetId, body, **kwargs):
+        def run():
+            for item in body.get('data', []):
+                rows, row, column = self._cell(spreadsheetId, item['range'])
+                values = rows[row]
+                values += [''] * (column + 1 - len(values))
+                values[column] = item['values'][0][0]
+            return {'totalUpdatedCells': len(body.get('data', []))}
+        return FakeCall(self.b, run)
+
+
+class FakeSpreadsheets:
+    def __init__(self, backend):
+        self.b = backend
+        self._values = FakeSheetValues(backend)
+
+    def create(self, body, fields=None, **kwargs):
+        def run():
+            sheet_id = self.b.new_id('sheet')
+            self.b.files[sheet_id] = {'id': sheet_id,
+                                      'name': body.get('properties', {}).get('title', ''),
+                                      'mimeType': self.b.SPREADSHEET, 'parents': ['root']}
+            for sheet in body.get('sheets') or [{'properties': {'title': 'Лист1'}}]:
+                self._add_sheet(sheet_id, dict(sheet['properties']))
+            return {'spreadsheetId': sheet_id,
+                    'spreadsheetUrl': self.b.link(sheet_id, self.b.SPREADSHEET)}
+        return FakeCall(self.b, run)
+
+    def _add_sheet(self, spreadsheet_id, props):
+        props['sheetId'] = int(self.b.new_id(''))
+        with self.b.sheets_lock:
+            sheets = self.b.sheets[spreadsheet_id]
+            if any(p['title'] == props['title'] for p in sheets):
+                raise ValueError(f"Лист {props['title']} уже существует")
+            sheets.insert(min(props.pop('index', len(sheets)), len(sheets)), props)
+            for i, p in enumerate(sheets):
+                p['index'] = i
+        return props
+
+    def get(self, spreadsheetId, fields=None, **kwargs):
+        # Таблицы, созданные не через create (GOOGLE_SHEET_ID), - с одним листом
+        return FakeCall(self.b, lambda: {'sheets': [
+            {'properties': dict(p)}
+            for p in self.b.sheets[spreadsheetId] or [{'sheetId': 0, 'title': 'Лист1', 'index': 0}]
+        ]})
+
+    def batchUpdate(self, spreadsheetId, body, **kwargs):
+        def run():
+            replies = []
+            for request in body.get('requests', []):
+                props = self._add_sheet(spreadsheetId, dict(request['addSheet']['properties']))
+                replies.append({'addSheet': {'properties': dict(props)}})
+            return {'replies': replies}
+        return FakeCall(self.b, run)
+
+    def values(self):
+        return self._values
+
+
+class FakeSheetsService:
+    def __init__(self, backend):
+        self._spreadsheets = FakeSpreadsheets(backend)
+
+    def spreadsheets(self):
+        return self._spreadsheets
+
+
+def make_fake_build(backend):
+    """
+    Замена googleapiclient.discovery.build, возвращающая фейковые сервисы
+    """
+    def fake_build(service_name, version, *args, **kwargs):
+        if service_name == 'drive':
+            return FakeDriveService(backend)
+        if service_name == 'sheets':
+            return FakeSheetsService(backend)
+        raise ValueError(f'Нет фейка для сервиса {service_name}')
+    return fake_build
+
+
+# ---------------------------------------------------------------------------
+# OpenAI
+# ---------------------------------------------------------------------------
+
+# Оценка токенов для фейка: ~3 символа на токен (смесь кириллицы и JSON),
+# изображение - фиксированная стоимость (одинакова в любом режиме промпта),
+# в низком качестве (detail=low) - только база
+FAKE_CHARS_PER_TOKEN = 3
+FAKE_IMAGE_TOKENS = 1105
+FAKE_LOW_IMAGE_TOKENS = 85
+# Поля, которые фейк "не разглядел" в низком качестве (low_detail_miss_rate)
+FAKE_LOW_MISSED_FIELDS = ('amount', 'date', 'buyer_inn', 'full_name')
+
+
+def estimate_tokens(text):
+    return -(-len(text) // FAKE_CHARS_PER_TOKEN)
+
+
+def estimate_prompt_tokens(request):
+    """Токены промпта запроса chat.completions (текст сообщений, схема ответа, изображения)"""
+    tokens = 0
+    for message in request.get('messages', []):
+        content = message.get('content')
+        parts = content if isinstance(content, list) else [{'type': 'text', 'text': content or ''}]
+        for part in parts:
+            if part.get('type') == 'image_url':
+                tokens += FAKE_LOW_IMAGE_TOKENS if image_detail(request) == 'low' else FAKE_IMAGE_TOKENS
+            else:
+                tokens += estimate_tokens(part.get('text', ''))
+    response_format = request.get('response_format') or {}
+    if response_format.get('type') == 'json_schema':
+        tokens += estimate_tokens(json.dumps(response_format['json_schema'], ensure_ascii=False))
+    return tokens
+
+
+def image_detail(request):
+    """detail изображения в запросе chat.completions (None - не указан)"""
+    for message in request.get('messages', []):
+        content = message.get('content')
+        for part in content if isinstance(content, list) else []:
+            if part.get('type') == 'image_url':
+                return part['image_url'].get('detail')
+    return None
+
+
+class FakeOpenAIServer:
+    """
+    Локальный HTTP-сервер, совместимый с /v1/chat/completions.
+    Возвращает JSON чека (по кругу из receipts) с заданной задержкой и ошибками:
+    при response_format=json_schema - компактный JSON только с полями схемы,
+    иначе - как обычно отвечает модель на текстовый промпт (```json ... ```).
+    usage оценивается по запросу и ответу (estimate_prompt_tokens);
+    decode_ms_per_token - время генерации токена ответа (длинный ответ - дольше)
+    low_detail_miss_rate - доля ответов на detail=low с пустым полем
+    (FAKE_LOW_MISSED_FIELDS); запрос detail=high сразу после detail=low
+    (эскалация) получает тот же чек
+    """
+
+    def __init__(self, receipts, faults=None, host='127.0.0.1', port=0, decode_ms_per_token=0,
+                 low_detail_miss_rate=0.0, seed=None):
+        self.receipts = receipts
+        self.decode_ms_per_token = decode_ms_per_token
+        self.low_detail_miss_rate = low_detail_miss_rate
+        self.faults = faults or FaultInjector()
+        self.requests = 0
+        self._cycle = itertools.cycle(receipts)
+        self._rng = random.Random(seed)
+        self._last = (None, None)
+        self._lock = threading.Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                request = json.loads(self.rfile.read(length) or b'{}')
+                detail = image_detail(request)
+                with server._lock:
+                    server.requests += 1
+                    last_receipt, last_detail = server._last
+                    if detail == 'high' and last_detail == 'low':
+                        receipt = last_receipt
+                    else:
+                        receipt = next(server._cycle)
+                    server._last = (receipt, detail)
+                    if detail == 'low' and server._rng.random() < server.low_detail_miss_rate:
+                        receipt = dict(receipt, **{server._rng.choice(FAKE_LOW_MISSED_FIELDS): ''})
+
+                time.sleep(server.faults.delay())
+
+                if server.faults.should_fail():
+                    payload = {'error': {'message': 'Injected error', 'type': 'server_error'}}
+                    self._reply(500, payload)
+                    return
+
+                response_format = request.get('response_format') or {}
+                if response_format.get('type') == 'json_schema':
+                    fields = response_format['json_schema']['schema']['properties']
+                    content = json.dumps({k: receipt.get(k, '') for k in fields}, ensure_ascii=False)
+                else:
+                    content = '```json\n' + json.dumps(receipt, ensure_ascii=False, indent=2) + '\n```'
+
+                prompt_tokens = estimate_prompt_tokens(request)
+                completion_tokens = estimate_tokens(content)
+                time.sleep(completion_tokens * server.decode_ms_per_token / 1000)
+                self._reply(200, {
+                    'id': f'chatcmpl-{server.requests}',
+                    'object': 'chat.completion',
+                    'created': int(time.time()),
+                    'model': 'gpt-4o-mini',
+                    'choices': [{'index': 0, 'finish_reason': 'stop',
+                                 'message': {'role': 'assistant', 'content': content}}],
+                    'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                              'total_tokens': prompt_tokens + completion_tokens},
+                })
+
+            def _reply(self, status, payload):
+                body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._httpd = ThreadingHTTPServer((host, port), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address[:2]
+        return f'http://{host}:{port}/v1'
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+# ---------------------------------------------------------------------------
+# ФНС («Мой налог»)
+# ---------------------------------------------------------------------------
+
+class FakeFnsServer:
+    """
+    Локальный HTTP-сервер с ответами lknpd.nalog.ru на
+    GET /api/v1/receipt/{ИНН}/{ID чека}/json: JSON чека с cancellationInfo
+    (null - действителен) и ETag; запрос с совпадающим If-None-Match
+    получает 304 без тела. Чеки из missing - 404, остальные существуют.
+    cancel(receipt_id) аннулирует чек - меняется ответ и его ETag
+    """
+
+    RECEIPT_RE = re.compile(r'/api/v1/receipt/(\d+)/([A-Za-z0-9]+)/json')
+
+    def __init__(self, cancelled=(), missing=(), faults=None, host='127.0.0.1', port=0):
+        self.cancelled = set(cancelled)
+        self.missing = set(missing)
+        self.faults = faults or FaultInjector()
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                time.sleep(server.faults.delay())
+                match = server.RECEIPT_RE.fullmatch(self.path.split('?', 1)[0])
+                self._reply(*server.respond(match, self.headers.get('If-None-Match')))
+
+            def _reply(self, status, body, etag=None):
+                self.send_response(status)
+                if etag:
+                    self.send_header('ETag', etag)
+                if status != 304:
+                    self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._httpd = ThreadingHTTPServer((host, port), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    def respond(self, match, if_none_match):
+        """(HTTP-статус, тело, ETag) ответа на запрос чека"""
+        with self._lock:
+            self.calls['requests'] += 1
+            if self.faults.should_fail():
+                self.calls['errors'] += 1
+                return 503, b'{"message": "Injected error"}', None
+            if not match or match.group(2) in self.missing:
+                self.calls['not_found'] += 1
+                return 404, b'{"message": "receipt not found"}', None
+            inn, receipt_id = match.groups()
+            cancelled = receipt_id in self.cancelled
+
+        body = json.dumps({
+            'receiptId': receipt_id,
+            'inn': inn,
+            'cancellationInfo': (
+                {'operationTime': '2025-01-01T00:00:00+03:00', 'comment': 'Чек сформирован ошибочно'}
+                if cancelled else None
+            ),
+        }, ensure_ascii=False).encode('utf-8')
+        etag = '"' + hashlib.sha1(body).hexdigest()[:16] + '"'
+        with self._lock:
+            if if_none_match == etag:
+                self.calls['not_modified'] += 1
+                return 304, b'', etag
+            self.calls['ok'] += 1
+        return 200, body, etag
+
+    def cancel(self, receipt_id):
+        with self._lock:
+            self.cancelled.add(receipt_id)
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address[:2]
+        return f'http://{host}:{port}/api/v1'
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
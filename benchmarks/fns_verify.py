@@ -0,0 +1,175 @@
+"""
+Проверка чеков реестра в ФНС (fns_verifier) против локальных заменителей
+
+Реестр из --rows чеков (часть - старше FNS_VERIFY_RECENT_DAYS) записывается
+в фейковую таблицу Google, ФНС отвечает локальный FakeFnsServer с задержкой
+--latency-ms. Сценарии по порядку:
+- serial - пустой кэш, один запрос за раз (как последовательная проверка)
+- concurrent - пустой кэш, --concurrency запросов одновременно
+- cached - повтор в пределах FNS_VERIFY_CACHE_TTL: без запросов к ФНС
+- conditional - кэш устарел, ФНС аннулировала --cancel чеков: условные
+  запросы, 304 по неизменившимся чекам, статусы аннулированных записаны в таблицу
+- recent_only - фоновая проверка: только недавние и еще не проверенные чеки
+
+Для каждого сценария: время, запросы к ФНС (из них 304), вызовы Google,
+строки с измененным статусом. В конце - проверка, что в таблице и в копии
+реестра аннулированы ровно --cancel чеков.
+
+Запуск из корня репозитория:
+    python -m benchmarks.fns_verify
+    python -m benchmarks.fns_verify --rows 1000 --concurrency 16 --latency-ms 50
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+from benchmarks import fakes
+
+BUYER_INN = '9705246070'
+
+
+def install_fakes(google):
+    """Подмена Google до импорта обработчиков (как в benchmarks.load_test)"""
+    os.environ.setdefault('REGISTRY_MIRROR_DIR', tempfile.mkdtemp(prefix='registry-mirror-'))
+
+    import google_auth
+    google_auth.get_google_credentials = lambda: None
+
+    import googleapiclient.discovery
+    googleapiclient.discovery.build = fakes.make_fake_build(google)
+
+
+def receipt_id(i):
+    return f"2000{i:06d}ab"
+
+
+def fill_registry(google, rows, recent_days):
+    """Таблица-реестр с rows чеками: каждый четвертый - старше recent_days дней"""
+    from receipt_model import Receipt
+    from registry_shards import new_spreadsheet_sheets
+    from sheets_handler import SheetsHandler
+
+    service = fakes.make_fake_build(google)('sheets', 'v4')
+    sheet_id = service.spreadsheets().create(
+        body={'properties': {'title': 'Реестр'}, 'sheets': new_spreadsheet_sheets()}
+    ).execute()['spreadsheetId']
+
+    today = date.today()
+    sheets = SheetsHandler(sheet_id)
+    values = []
+    for i in range(rows):
+        day = today - timedelta(days=recent_days + 30 + i % 200 if i % 4 == 0 else i % recent_days)
+        seller_inn = f"7700{i:08d}"
+        values.append(sheets.build_receipt_row(Receipt.from_dict({
+            'date': day.strftime('%d.%m.%Y'),
+            'full_name': 'Иванов И.И.',
+            'buyer_inn': BUYER_INN,
+            'services': 'услуги',
+            'amount': '1 000.00 ₽',
+            'status': 'Действителен',
+            'fns_url': f"https://lknpd.nalog.ru/api/v1/receipt/{seller_inn}/{receipt_id(i)}/print",
+            'drive_link': f"https://drive.example/{i}",
+        })))
+    sheets.add_receipt_rows(values)
+    return sheet_id
+
+
+async def run_scenario(name, verifier, sheet_id, google, fns, recent_only=False):
+    requests_before = fns.calls['requests']
+    not_modified_before = fns.calls['not_modified']
+    google_before = google.calls
+
+    started = time.perf_counter()
+    stats = await verifier.verify_registry(sheet_id, recent_only=recent_only)
+    elapsed = time.perf_counter() - started
+
+    return {
+        'scenario': name,
+        'elapsed_s': elapsed,
+        'rows': stats['rows'],
+        'fns_requests': fns.calls['requests'] - requests_before,
+        'not_modified': fns.calls['not_modified'] - not_modified_before,
+        'cached': stats['cached'],
+        'errors': stats['error'],
+        'google_calls': google.calls - google_before,
+        'updated': stats['updated'],
+        'cancelled': stats['cancelled'],
+    }
+
+
+def format_result(r):
+    return (
+        f"[{r['scenario']}] {r['elapsed_s']:.2f} с, строк {r['rows']}, запросов к ФНС {r['fns_requests']} "
+        f"(304: {r['not_modified']}, ошибок {r['errors']}), из кэша {r['cached']}, "
+        f"вызовов Google {r['google_calls']}, статус изменен {r['updated']}"
+    )
+
+
+async def run(args):
+    google = fakes.FakeGoogleBackend()
+    fns = fakes.FakeFnsServer(faults=fakes.FaultInjector(args.latency_ms, args.latency_ms / 4, 0, seed=1))
+    install_fakes(google)
+    fns.start()
+
+    from fns_verifier import FnsVerifier, FNS_VERIFY_RECENT_DAYS
+    from registry_mirror import CANCELLED_STATUS, get_registry_view
+    from state_backend import MemoryStateBackend
+
+    try:
+        sheet_id = fill_registry(google, args.rows, FNS_VERIFY_RECENT_DAYS)
+        results = []
+
+        serial = FnsVerifier(MemoryStateBackend(), base_url=fns.base_url, concurrency=1)
+        results.append(await run_scenario('serial', serial, sheet_id, google, fns))
+
+        state = MemoryStateBackend()
+        verifier = FnsVerifier(state, base_url=fns.base_url, concurrency=args.concurrency)
+        results.append(await run_scenario('concurrent', verifier, sheet_id, google, fns))
+        results.append(await run_scenario('cached', verifier, sheet_id, google, fns))
+
+        # Недавние чеки, которые ФНС аннулировала после первой проверки
+        for i in range(1, 4 * args.cancel, 4)[:args.cancel]:
+            fns.cancel(receipt_id(i))
+        expired = FnsVerifier(state, base_url=fns.base_url, concurrency=args.concurrency, cache_ttl=0)
+        results.append(await run_scenario('conditional', expired, sheet_id, google, fns))
+        results.append(await run_scenario('recent_only', expired, sheet_id, google, fns, recent_only=True))
+
+        for r in results:
+            print(format_result(r))
+
+        in_sheet = sum(
+            1 for (sid, _), rows in google.values.items() if sid == sheet_id
+            for row in rows if len(row) > 5 and row[5] == CANCELLED_STATUS
+        )
+        in_mirror = get_registry_view(sheet_id).summary()['cancelled']
+        ok = in_sheet == in_mirror == args.cancel
+        print(f"Аннулировано в таблице: {in_sheet}, в копии реестра: {in_mirror}, "
+              f"ожидалось {args.cancel} - {'OK' if ok else 'ОШИБКА'}")
+        return results, ok
+    finally:
+        fns.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Проверка чеков реестра в ФНС против локальных заменителей')
+    parser.add_argument('--rows', type=int, default=200, help='Чеков в реестре')
+    parser.add_argument('--concurrency', type=int, default=8, help='Одновременных запросов к ФНС')
+    parser.add_argument('--latency-ms', type=float, default=20, help='Задержка ответа ФНС')
+    parser.add_argument('--cancel', type=int, default=5, help='Сколько чеков ФНС аннулирует')
+    parser.add_argument('--json', help='Сохранить результаты в JSON-файл')
+    args = parser.parse_args()
+
+    results, ok = asyncio.run(run(args))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+"""
+Сравнение HTTP-транспорта клиентов Google API под параллельной нагрузкой
+
+Потоки одновременно добавляют строки в Sheets (values.append) и читают
+список файлов Drive (files.list) через настоящий googleapiclient, но запросы
+идут в локальный HTTP/1.1-сервер с keep-alive и задержкой ответа. Режимы:
+- shared - один сервис на общем httplib2.Http (build(credentials=...) и
+  обращение из нескольких потоков): httplib2 не потокобезопасен, поэтому
+  ответы теряются или перепутываются;
+- per_call - новый сервис (и соединение) на каждый вызов, как раньше у
+  обработчиков: без ошибок, но каждый запрос открывает соединение;
+- pooled - как build_service: google_transport.PooledHttp и CachedResource.
+
+Для каждого режима: ошибки, запросов/с, p50/p95, открытых сервером соединений
+и доля запросов по уже открытому соединению.
+
+Запуск из корня репозитория:
+    python -m benchmarks.google_transport
+    python -m benchmarks.google_transport --threads 16 --requests 400 --pool 8
+"""
+import argparse
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmarks.common import percentile
+
+MODES = ('shared', 'per_call', 'pooled')
+
+
+class FakeGoogleHandler(BaseHTTPRequestHandler):
+    """Ответы values.append и files.list; в ответе - тот же ключ, что в запросе"""
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def _reply(self, body):
+        time.sleep(self.server.latency_s)
+        payload = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        request = json.loads(self.rfile.read(length) or b'{}')
+        # Ключ запроса возвращается в ответе: так видно, что поток получил свой ответ
+        self._reply({'updates': {'updatedRows': 1}, 'key': request['values'][0][0]})
+
+    def do_GET(self):
+        key = self.path.rsplit('pageToken=', 1)[-1].split('&', 1)[0]
+        self._reply({'files': [], 'key': key})
+
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Обрывы соединений в режиме shared - ожидаемый результат, а не ошибка сервера
+        pass
+
+
+class FakeGoogleServer:
+    def __init__(self, latency_ms):
+        self.httpd = QuietHTTPServer(('127.0.0.1', 0), FakeGoogleHandler)
+        self.httpd.latency_s = latency_ms / 1000
+        self.httpd.connections = 0
+        self.httpd.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}/"
+
+    @property
+    def connections(self):
+        return self.httpd.connections
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def make_services(mode, base_url, pool_size, timeout):
+    """Функция, возвращающая (sheets, drive) для очередного вызова в этом режиме"""
+    from google.oauth2.credentials import Credentials
+    from google_auth_httplib2 import AuthorizedHttp
+    from googleapiclient.discovery import build
+
+    from google_transport import CachedResource, PooledHttp, new_http
+
+    credentials = Credentials(token='benchmark')
+
+    def build_pair(http):
+        options = {'api_endpoint': base_url}
+        return (
+            build('sheets', 'v4', http=http, client_options=options, cache_discovery=False),
+            build('drive', 'v3', http=http, client_options=options, cache_discovery=False),
+        )
+
+    if mode == 'per_call':
+        return lambda: build_pair(AuthorizedHttp(credentials, http=new_http(timeout)))
+
+    if mode == 'shared':
+        services = build_pair(AuthorizedHttp(credentials, http=new_http(timeout)))
+    else:
+        # Как build_service: общий пул и клиенты без пересоздания коллекций
+        http = PooledHttp(credentials, size=pool_size, timeout=timeout)
+        services = tuple(CachedResource(service) for service in build_pair(http))
+    return lambda: services
+
+
+def one_call(get_services, i):
+    """Один вызов Sheets или Drive; True, если ответ пришел на этот запрос"""
+    sheets, drive = get_services()
+    key = f"k{i}"
+    if i % 2:
+        result = sheets.spreadsheets().values().append(
+            spreadsheetId='bench', range='A:J', valueInputOption='USER_ENTERED',
+            body={'values': [[key]]}
+        ).execute()
+    else:
+        result = drive.files().list(q="'bench' in parents", pageToken=key).execute()
+    return result.get('key') == key
+
+
+def run_mode(mode, args):
+    server = FakeGoogleServer(args.latency_ms).start()
+    get_services = make_services(mode, server.base_url, args.pool, args.timeout)
+    latencies = []
+    errors = 0
+
+    def call(i):
+        started = time.perf_counter()
+        try:
+            ok = one_call(get_services, i)
+        except Exception:
+            ok = False
+        return ok, (time.perf_counter() - started) * 1000
+
+    try:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.threads) as executor:
+            for ok, latency in executor.map(call, range(args.requests)):
+                errors += not ok
+                latencies.append(latency)
+        elapsed = time.perf_counter() - started
+    finally:
+        server.stop()
+
+    return {
+        'requests': args.requests,
+        'errors': errors,
+        'throughput_rps': args.requests / elapsed,
+        'latency_p50_ms': percentile(latencies, 50),
+        'latency_p95_ms': percentile(latencies, 95),
+        'connections': server.connections,
+        'reuse_rate': 1 - server.connections / args.requests,
+    }
+
+
+def format_result(mode, r):
+    return (
+        f"[{mode}] запросов: {r['requests']}, ошибок: {r['errors']}, "
+        f"{r['throughput_rps']:.0f} запросов/с, p50 {r['latency_p50_ms']:.0f} мс, "
+        f"p95 {r['latency_p95_ms']:.0f} мс\n"
+        f"  соединений: {r['connections']}, запросов по открытому соединению: "
+        f"{max(0.0, r['reuse_rate']) * 100:.1f}%"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сравнение HTTP-транспорта клиентов Google API')
+    parser.add_argument('--threads', type=int, default=8, help='Параллельных потоков')
+    parser.add_argument('--requests', type=int, default=200, help='Запросов на режим')
+    parser.add_argument('--pool', type=int, default=8, help='Размер пула (режим pooled)')
+    parser.add_argument('--latency-ms', type=float, default=20, help='Задержка ответа сервера')
+    parser.add_argument('--timeout', type=float, default=5,
+                        help='Таймаут запроса, с (в режиме shared ответы теряются)')
+    parser.add_argument('--json', help='Сохранить результаты в JSON-файл')
+    args = parser.parse_args()
+
+    results = {}
+    for mode in MODES:
+        results[mode] = run_mode(mode, args)
+        print(format_result(mode, results[mode]))
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,485 @@
+"""
+Сквозной нагрузочный тест бота без реальных сервисов.
+
+Синтетические Update подаются в обработчики, зарегистрированные в bot.main()
+(через bot.register_handlers), а Telegram, Google Drive/Sheets и OpenAI
+заменены локальными фейками с настраиваемой задержкой и ошибками.
+
+Примеры (из корня репозитория):
+    python -m benchmarks.load_test --scenario photo --chats 10 --receipts 5
+    python -m benchmarks.load_test --scenario full_analyze --chats 4 --files 20
+    python -m benchmarks.load_test --scenario ingest --chats 4 --files 10 --upload-gap-ms 500
+    python -m benchmarks.load_test --scenario photo --ramp --slo-ms 15000
+    python -m benchmarks.load_test --scenario document --google-latency-ms 150 --openai-error-rate 0.05
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import time
+
+from benchmarks import fakes
+from benchmarks.common import RssSampler, percentile
+
+CORPUS_DIR = os.path.join(os.path.dirname(__file__), 'corpus')
+MANIFEST_PATH = os.path.join(CORPUS_DIR, 'manifest.json')
+
+SCENARIOS = ('photo', 'document', 'full_analyze', 'ingest')
+
+
+class LoopLagMonitor:
+    """
+    Измерение блокировки event loop: корутина «тикает» с интервалом interval,
+    любое опоздание тика - время, когда цикл был занят синхронным кодом
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.lags = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, loop.time() - expected))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    def report(self):
+        return {
+            'loop_blocked_s': sum(self.lags),
+            'loop_lag_max_ms': max(self.lags, default=0.0) * 1000,
+            'loop_lag_p99_ms': percentile(self.lags, 99) * 1000,
+        }
+
+
+class LoadTestEnvironment:
+    """
+    Поднимает фейки, импортирует бота и создает Application с фейковым транспортом
+    """
+
+    def __init__(self, args):
+        with open(MANIFEST_PATH, encoding='utf-8') as f:
+            self.manifest = json.load(f)
+
+        self.google = fakes.FakeGoogleBackend(
+            fakes.FaultInjector(args.google_latency_ms, args.google_latency_ms / 2,
+                                args.google_error_rate, seed=1)
+        )
+        receipts = [dict(e['expected'], status='Действителен')
+                    for e in self.manifest['images'] + self.manifest['pdfs']]
+        for receipt in receipts:
+            receipt.pop('fns_url', None)
+        self.openai = fakes.FakeOpenAIServer(
+            receipts,
+            fakes.FaultInjector(args.openai_latency_ms, args.openai_latency_ms / 4,
+                                args.openai_error_rate, seed=2)
+        )
+
+        # Проверка чеков в ФНС (фоновая проверка бота) - тоже локально
+        self.fns = fakes.FakeFnsServer()
+
+        # Файлы, которые «лежат» на серверах Telegram
+        self.photo_ids = []
+        self.pdf_ids = []
+        files = {}
+        for i, entry in enumerate(self.manifest['images']):
+            if entry['file'].endswith('.jpg'):
+                files[f'img{i}'] = self._read(entry['file'])
+                self.photo_ids.append(f'img{i}')
+        for i, entry in enumerate(self.manifest['pdfs']):
+            files[f'pdf{i}'] = self._read(entry['file'])
+            self.pdf_ids.append(f'pdf{i}')
+
+        self.telegram = fakes.FakeTelegramRequest(
+            files, fakes.FaultInjector(args.telegram_latency_ms, args.telegram_latency_ms / 2, 0, seed=3)
+        )
+        self.bot_module = None
+        self.app = None
+        self.handler_errors = 0
+        self.failed_sessions = 0
+        self._update_ids = itertools.count(1)
+
+    @staticmethod
+    def _read(name):
+        with open(os.path.join(CORPUS_DIR, name), 'rb') as f:
+            return f.read()
+
+    def install(self):
+        """
+        Подмена внешних сервисов и импорт бота
+        """
+        self.install_fakes()
+
+        import bot
+        self.bot_module = bot
+
+    def install_fakes(self, patch_google=True):
+        """
+        Подмена внешних сервисов ДО импорта бота: модули-обработчики
+        импортируют get_google_credentials при импорте
+        patch_google=False - не импортировать googleapiclient сейчас
+        (бенчмарк запуска вызывает patch_google() после импорта бота)
+        """
+        if 'bot' in sys.modules:
+            raise RuntimeError('bot уже импортирован - фейки нужно установить до импорта')
+
+        self.openai.start()
+        os.environ['OPENAI_API_KEY'] = 'load-test'
+        os.environ['OPENAI_BASE_URL'] = self.openai.base_url
+        self.fns.start()
+        os.environ['FNS_API_URL'] = self.fns.base_url
+        os.environ['GOOGLE_DRIVE_FOLDER_ID'] = 'root-folder'
+        os.environ['STATISTICS_SHEET_ID'] = 'stats-sheet'
+        # Копии реестров фейковых таблиц - во временный каталог, не в рабочий
+        os.environ.setdefault('REGISTRY_MIRROR_DIR', tempfile.mkdtemp(prefix='registry-mirror-'))
+        # Outbox чеков - тоже; повторы после внедренных ошибок - без долгих пауз
+        outbox_dir = tempfile.mkdtemp(prefix='upload-outbox-')
+        os.environ.setdefault('OUTBOX_DB_PATH', os.path.join(outbox_dir, 'outbox.sqlite3'))
+        os.environ.setdefault('OUTBOX_DIR', outbox_dir)
+        os.environ.setdefault('OUTBOX_RETRY_BASE', '0.2')
+        os.environ.setdefault('OUTBOX_POLL_INTERVAL', '0.1')
+        # Опрос ленты изменений фейкового Drive (drive_ingest)
+        os.environ.setdefault('DRIVE_INGEST_INTERVAL', '0.5')
+
+        import google_auth
+        google_auth.get_google_credentials = lambda: None
+
+        if patch_google:
+            self.patch_google()
+
+    def patch_google(self):
+        """Подмена googleapiclient.discovery.build (клиенты создаются при первом обращении)"""
+        import googleapiclient.discovery
+        googleapiclient.discovery.build = fakes.make_fake_build(self.google)
+
+    async def start(self):
+        from telegram.ext import Application
+
+        self.app = (
+            Application.builder()
+            .token('123456:LOAD-TEST')
+            .request(self.telegram)
+            .get_updates_request(fakes.FakeTelegramRequest())
+            .concurrent_updates(self.bot_module.CONCURRENT_UPDATES)
+            .build()
+        )
+        self.bot_module.register_handlers(self.app)
+        self.app.add_error_handler(self._on_error)
+        await self.app.initialize()
+        # То же, что post_init в bot.main(): запуск воркеров очереди анализа
+        await self.bot_module.on_startup(self.app)
+
+    async def _on_error(self, update, context):
+        # Необработанное исключение в обработчике (пользователь не получил ответа)
+        self.handler_errors += 1
+        logging.getLogger(__name__).warning(f"Исключение в обработчике: {context.error!r}")
+
+    async def stop(self):
+        await self.bot_module.on_stop(self.app)
+        await self.app.shutdown()
+        self.openai.stop()
+        self.fns.stop()
+
+    async def send(self, payload):
+        """Подать синтетический Update в приложение, вернуть время обработки (с)"""
+        from telegram import Update
+
+        update = Update.de_json(payload, self.app.bot)
+        started = time.perf_counter()
+        await self.app.process_update(update)
+        return time.perf_counter() - started
+
+    def next_update_id(self):
+        return next(self._update_ids)
+
+    async def drain_outbox(self, timeout=600, interval=0.05):
+        """Ждать, пока outbox запишет все принятые чеки"""
+        from upload_outbox import get_upload_outbox
+
+        outbox = get_upload_outbox()
+        deadline = time.perf_counter() + timeout
+        while outbox.pending_count() and time.perf_counter() < deadline:
+            await asyncio.sleep(interval)
+
+    def last_message(self, chat_id):
+        sent = self.telegram.sent.get(chat_id)
+        return sent[-1] if sent else ''
+
+    async def wait_for_message(self, chat_id, predicate, since, timeout=600, interval=0.05):
+        """
+        Ждать сообщения бота в чат (начиная с индекса since), удовлетворяющего predicate
+        Возвращает текст сообщения или None по таймауту
+        """
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            for text in self.telegram.sent.get(chat_id, [])[since:]:
+                if predicate(text):
+                    return text
+            await asyncio.sleep(interval)
+        return None
+
+
+async def run_receipts(env, kind, chats, receipts_per_chat):
+    """
+    Каждый чат последовательно шлет receipts_per_chat фото/PDF,
+    все чаты - одновременно
+    """
+    latencies = []
+    file_ids = env.photo_ids if kind == 'photo' else env.pdf_ids
+    ids = itertools.cycle(file_ids)
+
+    async def chat_session(chat_id):
+        for _ in range(receipts_per_chat):
+            if kind == 'photo':
+                payload = fakes.photo_update(env.next_update_id(), chat_id, next(ids))
+            else:
+                payload = fakes.document_update(env.next_update_id(), chat_id, next(ids))
+            latencies.append(await env.send(payload))
+
+    await asyncio.gather(*(chat_session(10_000 + c) for c in range(chats)))
+    # Запись на Drive и в таблицы идет в фоне (outbox) - прогон заканчивается,
+    # когда записаны все чеки
+    await env.drain_outbox()
+    return latencies, chats * receipts_per_chat
+
+
+async def run_full_analyze(env, chats, files_per_folder):
+    """
+    Каждый чат: /full_analyze -> загрузка файлов в папку -> «Начать анализ»
+    Кнопка только ставит задачу в очередь, поэтому задержка считается
+    от нажатия до итогового сообщения воркера (весь анализ папки)
+    """
+    latencies = []
+    corpus = [(e['file'], 'image/jpeg' if e['file'].endswith('.jpg') else
+               'image/png' if e['file'].endswith('.png') else 'application/pdf')
+              for e in env.manifest['images'] + env.manifest['pdfs']]
+    contents = {name: env._read(name) for name, _ in corpus}
+
+    async def chat_session(chat_id):
+        await env.send(fakes.command_update(env.next_update_id(), chat_id, '/full_analyze'))
+        match = re.search(r'folders/([\w-]+)', env.last_message(chat_id))
+        if not match:
+            # Папка не создана (например, из-за внедренной ошибки Google)
+            env.failed_sessions += 1
+            return
+        folder_id = match.group(1)
+
+        for i in range(files_per_folder):
+            name, mime_type = corpus[i % len(corpus)]
+            env.google.add_file(folder_id, f'{i:04d}_{name}', mime_type, contents[name])
+
+        since = len(env.telegram.sent.get(chat_id, []))
+        started = time.perf_counter()
+        await env.send(fakes.callback_update(env.next_update_id(), chat_id, f'analyze_{chat_id}'))
+        final = await env.wait_for_message(
+            chat_id, lambda t: 'Анализ завершен' in t or t.startswith(('❌', '🛑')), since
+        )
+        if final is None or not final.startswith('✅'):
+            env.failed_sessions += 1
+            return
+        latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(chat_session(20_000 + c) for c in range(chats)))
+    return latencies, len(latencies) * files_per_folder
+
+
+async def run_ingest(env, chats, files_per_folder, upload_gap):
+    """
+    Каждый чат: /full_analyze -> файлы по одному с паузой upload_gap секунд ->
+    «Начать анализ», когда все файлы обработаны автоматически (drive_ingest)
+    Задержка - от загрузки файла в папку до отметки «обработан» (файл,
+    который не распознался, - до сообщения об ошибке, без задержки); итог
+    после кнопки не должен обрабатывать файлы повторно (запросы OpenAI = файлы)
+    """
+    from drive_ingest import processed_namespace
+
+    latencies = []
+    corpus = [(e['file'], 'image/jpeg' if e['file'].endswith('.jpg') else
+               'image/png' if e['file'].endswith('.png') else 'application/pdf')
+              for e in env.manifest['images'] + env.manifest['pdfs']]
+    contents = {name: env._read(name) for name, _ in corpus}
+    state = env.bot_module.state
+
+    async def wait_processed(chat_id, namespace, file_id, file_name, added, timeout=600):
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            if state.is_processed(namespace, file_id):
+                latencies.append(time.perf_counter() - added)
+                return True
+            if any(f"• {file_name}:" in t for t in env.telegram.sent.get(chat_id, [])):
+                return True
+            await asyncio.sleep(0.05)
+        return False
+
+    async def chat_session(chat_id):
+        await env.send(fakes.command_update(env.next_update_id(), chat_id, '/full_analyze'))
+        match = re.search(r'folders/([\w-]+)', env.last_message(chat_id))
+        if not match:
+            env.failed_sessions += 1
+            return
+        folder_id = match.group(1)
+        namespace = processed_namespace(folder_id)
+
+        waiters = []
+        for i in range(files_per_folder):
+            name, mime_type = corpus[i % len(corpus)]
+            file_name = f'{i:04d}_{name}'
+            file_id = env.google.add_file(folder_id, file_name, mime_type, contents[name])
+            waiters.append(asyncio.create_task(
+                wait_processed(chat_id, namespace, file_id, file_name, time.perf_counter())
+            ))
+            await asyncio.sleep(upload_gap)
+        if not all(await asyncio.gather(*waiters)):
+            env.failed_sessions += 1
+            return
+
+        since = len(env.telegram.sent.get(chat_id, []))
+        await env.send(fakes.callback_update(env.next_update_id(), chat_id, f'analyze_{chat_id}'))
+        final = await env.wait_for_message(
+            chat_id, lambda t: 'Анализ завершен' in t or t.startswith(('❌', '🛑')), since
+        )
+        if final is None or not final.startswith('✅'):
+            env.failed_sessions += 1
+
+    await asyncio.gather(*(chat_session(30_000 + c) for c in range(chats)))
+    return latencies, len(latencies)
+
+
+async def run_level(env, args, chats):
+    """Один прогон сценария с заданным числом чатов"""
+    calls_before = sum(env.telegram.calls.values())
+    handler_errors_before = env.handler_errors
+    failed_before = env.failed_sessions
+    google_before = env.google.calls
+    openai_before = env.openai.requests
+
+    monitor = LoopLagMonitor()
+    monitor.start()
+    with RssSampler() as rss:
+        started = time.perf_counter()
+        if args.scenario == 'full_analyze':
+            latencies, receipts = await run_full_analyze(env, chats, args.files)
+        elif args.scenario == 'ingest':
+            latencies, receipts = await run_ingest(env, chats, args.files, args.upload_gap_ms / 1000)
+        else:
+            latencies, receipts = await run_receipts(env, args.scenario, chats, args.receipts)
+        elapsed = time.perf_counter() - started
+    await monitor.stop()
+
+    errors = sum(1 for texts in env.telegram.sent.values() for t in texts if t.startswith('❌'))
+    result = {
+        'scenario': args.scenario,
+        'chats': chats,
+        'receipts': receipts,
+        'elapsed_s': elapsed,
+        'receipts_per_min': receipts / elapsed * 60 if elapsed else 0.0,
+        'latency_p50_ms': percentile(latencies, 50) * 1000,
+        'latency_p95_ms': percentile(latencies, 95) * 1000,
+        'latency_p99_ms': percentile(latencies, 99) * 1000,
+        'latency_max_ms': max(latencies, default=0.0) * 1000,
+        'error_replies_total': errors,
+        'handler_exceptions': env.handler_errors - handler_errors_before,
+        'failed_sessions': env.failed_sessions - failed_before,
+        'telegram_calls': sum(env.telegram.calls.values()) - calls_before,
+        'google_calls': env.google.calls - google_before,
+        'openai_requests': env.openai.requests - openai_before,
+        'peak_rss_mb': rss.peak / 1024 / 1024,
+    }
+    result.update(monitor.report())
+    return result
+
+
+def format_result(r):
+    return (
+        f"[{r['scenario']}] чатов: {r['chats']}, чеков: {r['receipts']}, время: {r['elapsed_s']:.1f} с\n"
+        f"  пропускная способность: {r['receipts_per_min']:.1f} чеков/мин\n"
+        f"  задержка: p50 {r['latency_p50_ms']:.0f} мс, p95 {r['latency_p95_ms']:.0f} мс, "
+        f"p99 {r['latency_p99_ms']:.0f} мс, max {r['latency_max_ms']:.0f} мс\n"
+        f"  event loop заблокирован: {r['loop_blocked_s']:.1f} с "
+        f"(max лаг {r['loop_lag_max_ms']:.0f} мс, p99 {r['loop_lag_p99_ms']:.0f} мс)\n"
+        f"  вызовов: Telegram {r['telegram_calls']}, Google {r['google_calls']}, "
+        f"OpenAI {r['openai_requests']}\n"
+        f"  ошибки: ответов с ❌ (всего) {r['error_replies_total']}, "
+        f"необработанных исключений {r['handler_exceptions']}, "
+        f"сорванных сессий {r['failed_sessions']}\n"
+        f"  пиковый RSS: {r['peak_rss_mb']:.0f} МБ"
+    )
+
+
+async def main_async(args):
+    env = LoadTestEnvironment(args)
+    env.install()
+    await env.start()
+
+    results = []
+    try:
+        if args.ramp:
+            # Удваиваем число чатов, пока p95 укладывается в SLO
+            chats = 1
+            while chats <= args.max_chats:
+                result = await run_level(env, args, chats)
+                results.append(result)
+                print(format_result(result), flush=True)
+                if result['latency_p95_ms'] > args.slo_ms:
+                    break
+                chats *= 2
+            sustained = [r for r in results if r['latency_p95_ms'] <= args.slo_ms]
+            if sustained:
+                best = sustained[-1]
+                print(f"\n✅ Выдерживает {best['chats']} чатов одновременно, "
+                      f"{best['receipts_per_min']:.1f} чеков/мин при p95 ≤ {args.slo_ms:.0f} мс")
+            else:
+                print(f"\n❌ Даже 1 чат не укладывается в p95 ≤ {args.slo_ms:.0f} мс")
+        else:
+            result = await run_level(env, args, args.chats)
+            results.append(result)
+            print(format_result(result))
+    finally:
+        await env.stop()
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест бота на локальных фейках')
+    parser.add_argument('--scenario', choices=SCENARIOS, default='photo')
+    parser.add_argument('--chats', type=int, default=5, help='Одновременных чатов')
+    parser.add_argument('--receipts', type=int, default=3, help='Фото/PDF на чат')
+    parser.add_argument('--files', type=int, default=10, help='Файлов в папке /full_analyze')
+    parser.add_argument('--upload-gap-ms', type=float, default=300,
+                        help='Пауза между загрузками файлов в папку (сценарий ingest)')
+    parser.add_argument('--ramp', action='store_true',
+                        help='Наращивать число чатов (1, 2, 4, ...) до нарушения SLO')
+    parser.add_argument('--max-chats', type=int, default=64)
+    parser.add_argument('--slo-ms', type=float, default=20000, help='SLO на p95 задержки')
+    parser.add_argument('--telegram-latency-ms', type=float, default=30)
+    parser.add_argument('--google-latency-ms', type=float, default=120)
+    parser.add_argument('--google-error-rate', type=float, default=0.0)
+    parser.add_argument('--openai-latency-ms', type=float, default=2500)
+    parser.add_argument('--openai-error-rate', type=float, default=0.0)
+    parser.add_argument('--json', help='Сохранить результаты в JSON-файл')
+    args = parser.parse_args()
+
+    asyncio.run(main_async(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+"""
+Генератор синтетического корпуса чеков для бенчмарков.
+
+Корпус уже лежит в benchmarks/corpus/, этот скрипт нужен, чтобы его
+воспроизвести или расширить:
+    python -m benchmarks.make_corpus
+"""
+import json
+import os
+import random
+
+import cv2
+from PIL import Image, ImageDraw, ImageFilter, ImageFont
+
+CORPUS_DIR = os.path.join(os.path.dirname(__file__), 'corpus')
+MANIFEST_PATH = os.path.join(CORPUS_DIR, 'manifest.json')
+
+SURNAMES = ['Сабатаров', 'Иванова', 'Петров', 'Кузнецова', 'Смирнов', 'Орлова', 'Волков']
+NAMES = ['Алексей', 'Мария', 'Дмитрий', 'Анна', 'Игорь', 'Ольга', 'Сергей']
+PATRONYMICS = ['Геннадьевич', 'Петровна', 'Ильич', 'Сергеевна', 'Олегович', 'Андреевна']
+SERVICES = ['актерские услуги', 'услуги гримера', 'услуги водителя', 'монтаж видео']
+
+# (имя файла, ширина, высота, формат, есть ли QR, размытие)
+VARIANTS = [
+    ('r01_photo.jpg', 1280, 1707, 'JPEG', True, 0),
+    ('r02_scan.png', 1000, 1400, 'PNG', True, 0),
+    ('r03_camera.jpg', 3024, 4032, 'JPEG', True, 0),
+    ('r04_noqr.jpg', 1280, 1707, 'JPEG', False, 0),
+    ('r05_blurred.jpg', 1280, 1707, 'JPEG', True, 2),
+    ('r06_receipt.pdf', 1240, 1754, 'PDF', True, 0),
+    ('r07_receipt.pdf', 1240, 1754, 'PDF', False, 0),
+]
+
+
+def _font(size):
+    """Шрифт с кириллицей (DejaVu есть почти везде), иначе встроенный"""
+    for name in ('DejaVuSans.ttf', '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf'):
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            continue
+    return ImageFont.load_default()
+
+
+def _format_amount(value):
+    return f"{value:,.2f}".replace(',', ' ').replace('.', ',') + ' ₽'
+
+
+def make_receipt_fields(rng):
+    """
+    Случайные (но воспроизводимые) поля чека
+    """
+    surname = rng.choice(SURNAMES)
+    name = rng.choice(NAMES)
+    patronymic = rng.choice(PATRONYMICS)
+    amount = rng.randint(500, 90000) + rng.choice([0, 0.5, 0.99])
+    day = rng.randint(1, 28)
+    month = rng.randint(1, 12)
+    seller_inn = ''.join(str(rng.randint(0, 9)) for _ in range(12))
+    buyer_inn = ''.join(str(rng.randint(0, 9)) for _ in range(rng.choice([10, 12])))
+    receipt_id = ''.join(rng.choice('0123456789abcdef') for _ in range(10))
+
+    return {
+        'full_name_raw': f"{surname} {name} {patronymic}",
+        'full_name': f"{surname} {name[0]}.{patronymic[0]}.",
+        'amount_value': amount,
+        'amount': _format_amount(amount),
+        'services': rng.choice(SERVICES),
+        'seller_inn': seller_inn,
+        'buyer_inn': buyer_inn,
+        'date': f"{day:02d}.{month:02d}.2025",
+        'fns_url': f"https://lknpd.nalog.ru/api/v1/receipt/{seller_inn}/{receipt_id}/print",
+    }
+
+
+def make_ocr_text(fields):
+    """
+    Текст чека в том виде, в каком его возвращает Tesseract
+    """
+    return (
+        f"Чек №{fields['fns_url'].split('/')[-2]}\n"
+        f"{fields['date']} 12:34(+03:00)\n"
+        f"{fields['full_name_raw']}\n"
+        f"Наименование Сумма\n"
+        f"1 {fields['services']} {fields['amount']}\n"
+        f"Итого {fields['amount']}\n"
+        f"Налоговый режим НПД\n"
+        f"ИНН {fields['seller_inn']}\n"
+        f"Покупатель ООО \"Ромашка\"\n"
+        f"ИНН {fields['buyer_inn']}\n"
+    )
+
+
+def render_receipt(fields, width, height, with_qr, blur):
+    """
+    Рисует чек самозанятого: текст + QR-код со ссылкой ФНС
+    """
+    img = Image.new('RGB', (width, height), 'white')
+    draw = ImageDraw.Draw(img)
+    scale = width / 1000
+    font = _font(int(28 * scale))
+    margin = int(60 * scale)
+    line_height = int(44 * scale)
+
+    y = margin
+    for line in make_ocr_text(fields).splitlines():
+        draw.text((margin, y), line, fill='black', font=font)
+        y += line_height
+
+    if with_qr:
+        qr = cv2.QRCodeEncoder.create().encode(fields['fns_url'])
+        qr_size = int(width * 0.4)
+        qr_img = Image.fromarray(qr).convert('RGB').resize((qr_size, qr_size), Image.NEAREST)
+        img.paste(qr_img, ((width - qr_size) // 2, y + line_height))
+
+    if blur:
+        img = img.filter(ImageFilter.GaussianBlur(blur))
+
+    return img
+
+
+def main():
+    os.makedirs(CORPUS_DIR, exist_ok=True)
+    rng = random.Random(20250813)
+    manifest = {'images': [], 'pdfs': [], 'texts': []}
+
+    for filename, width, height, fmt, with_qr, blur in VARIANTS:
+        fields = make_receipt_fields(rng)
+        img = render_receipt(fields, width, height, with_qr, blur)
+        path = os.path.join(CORPUS_DIR, filename)
+
+        if fmt == 'JPEG':
+            img.save(path, 'JPEG', quality=85)
+        elif fmt == 'PDF':
+            img.save(path, 'PDF', resolution=150)
+        else:
+            img.save(path, fmt)
+
+        entry = {
+            'file': filename,
+            'has_qr': with_qr,
+            'expected': {k: v for k, v in fields.items() if k not in ('full_name_raw', 'amount_value')},
+        }
+        manifest['pdfs' if fmt == 'PDF' else 'images'].append(entry)
+        print(f"✅ {filename}: {os.path.getsize(path) // 1024} КБ")
+
+    # Тексты для стадий разбора (без изображений)
+    for _ in range(50):
+        fields = make_receipt_fields(rng)
+        manifest['texts'].append({'ocr_text': make_ocr_text(fields), 'amount': fields['amount']})
+
+    with open(MANIFEST_PATH, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+    print(f"✅ Корпус сохранен в {CORPUS_DIR}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""
+Бенчмарк запуска бота: время импорта и время до первого ответа.
+
+Каждый замер - отдельный процесс (холодный импорт), внешние сервисы
+заменены фейками из benchmarks/fakes.py. Измеряется:
+- import: `import bot` и какие тяжелые библиотеки он загружает
+- ready: импорт + создание и инициализация Application (post_init)
+- first_response: от начала импорта до ответа на /help
+- first_start: от начала импорта до ответа на /start (нужны клиенты Google)
+
+Примеры (из корня репозитория):
+    python -m benchmarks.startup
+    python -m benchmarks.startup --runs 10 --google-latency-ms 150
+"""
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import time
+
+from benchmarks.common import percentile
+
+# Библиотеки, загрузка которых заметно замедляет запуск
+HEAVY_MODULES = ('cv2', 'pyzbar', 'PIL', 'numpy', 'pytesseract', 'pdf2image',
+                 'googleapiclient', 'google_auth_oauthlib', 'openai')
+
+METRICS = ('import_s', 'ready_s', 'first_response_s', 'first_start_s')
+
+
+async def measure_once(args):
+    """Один замер в текущем (свежем) процессе"""
+    from benchmarks import fakes
+    from benchmarks.load_test import LoadTestEnvironment
+
+    env = LoadTestEnvironment(args)
+    env.install_fakes(patch_google=False)
+    modules_before = set(sys.modules)
+
+    started = time.perf_counter()
+    import bot
+    import_s = time.perf_counter() - started
+    env.bot_module = bot
+
+    loaded = sorted(
+        name for name in HEAVY_MODULES
+        if name in sys.modules and name not in modules_before
+    )
+
+    # Фейковый Google подставляется после импорта (иначе googleapiclient
+    # попал бы в «загруженное заранее»); сама подмена в замер не входит
+    patch_started = time.perf_counter()
+    env.patch_google()
+    started += time.perf_counter() - patch_started
+
+    await env.start()
+    ready_s = time.perf_counter() - started
+
+    chat_id = 30_000
+    await env.send(fakes.command_update(env.next_update_id(), chat_id, '/help'))
+    first_response_s = time.perf_counter() - started
+
+    await env.send(fakes.command_update(env.next_update_id(), chat_id + 1, '/start'))
+    first_start_s = time.perf_counter() - started
+
+    await env.stop()
+    return {
+        'import_s': import_s,
+        'ready_s': ready_s,
+        'first_response_s': first_response_s,
+        'first_start_s': first_start_s,
+        'heavy_modules_on_import': loaded,
+    }
+
+
+def run_child(args):
+    """Запуск замера в отдельном процессе, результат - JSON в stdout"""
+    command = [
+        sys.executable, '-m', 'benchmarks.startup', '--child',
+        '--google-latency-ms', str(args.google_latency_ms),
+        '--telegram-latency-ms', str(args.telegram_latency_ms),
+    ]
+    output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк запуска бота')
+    parser.add_argument('--runs', type=int, default=5, help='Число замеров (процессов)')
+    parser.add_argument('--google-latency-ms', type=float, default=120)
+    parser.add_argument('--telegram-latency-ms', type=float, default=30)
+    parser.add_argument('--json', help='Сохранить результаты в JSON-файл')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # Параметры фейков, которые ожидает LoadTestEnvironment
+    args.google_error_rate = 0.0
+    args.openai_latency_ms = 0.0
+    args.openai_error_rate = 0.0
+
+    if args.child:
+        import logging
+        logging.disable(logging.CRITICAL)
+        print(json.dumps(asyncio.run(measure_once(args))))
+        return 0
+
+    runs = [run_child(args) for _ in range(args.runs)]
+
+    print(f"Замеров: {len(runs)}")
+    for metric in METRICS:
+        values = [r[metric] * 1000 for r in runs]
+        print(
+            f"  {metric:<18} p50 {percentile(values, 50):8.0f} мс   "
+            f"min {min(values):8.0f} мс   max {max(values):8.0f} мс"
+        )
+    loaded = runs[0]['heavy_modules_on_import']
+    print(f"  тяжелые библиотеки при импорте bot: {', '.join(loaded) if loaded else 'нет'}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(runs, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,280 @@
+"""
+Подбор порогов проверки качества фото (image_quality) на корпусе
+
+Корпус собирается из синтетических чеков benchmarks.make_corpus: чек
+«фотографируется» - кладется с небольшим поворотом на фон, кадр уменьшается
+до размера фото с телефона, добавляется шум и сжатие JPEG. Классы:
+- good - годные фото, в том числе с легким размытием, тусклые, с бликом,
+  небольшие (как фото Telegram) и с чеком в половину кадра
+- blur, dark, contrast, resolution, coverage - фото, которые Vision не прочитает:
+  сильное размытие, темнота, засветка, миниатюра, чек далеко в кадре
+Фото проходят тот же путь, что в боте: байты JPEG → image_decode → image_quality.
+
+Для каждой метрики порог выбирается между годными фото и фото своего класса:
+не больше --max-false-reject годных отклоняются, плохих ловится как можно
+больше, порог - посередине между ними. Затем все пороги проверяются вместе:
+доля пропущенных годных и отклоненных плохих по классам, время проверки.
+В конце - строки для .env.
+
+С --photos DIR к корпусу добавляются настоящие фото: DIR/good и DIR/bad
+(плохие - без класса, учитываются только в общей проверке).
+
+Запуск из корня репозитория:
+    python -m benchmarks.tune_quality
+    python -m benchmarks.tune_quality --samples 60 --max-false-reject 0.02
+    python -m benchmarks.tune_quality --photos ~/receipts --json quality.json
+"""
+import argparse
+import io
+import json
+import math
+import os
+import random
+import sys
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+from benchmarks.common import percentile
+
+# Метрика QualityReport → (поле QualityThresholds, класс корпуса, переменная окружения)
+METRICS = {
+    'resolution': ('min_side', 'resolution', 'QUALITY_MIN_SIDE'),
+    'coverage': ('min_coverage', 'coverage', 'QUALITY_MIN_COVERAGE'),
+    'brightness': ('min_brightness', 'dark', 'QUALITY_MIN_BRIGHTNESS'),
+    'contrast': ('min_contrast', 'contrast', 'QUALITY_MIN_CONTRAST'),
+    'sharpness': ('min_sharpness', 'blur', 'QUALITY_MIN_SHARPNESS'),
+}
+CLASSES = ('good', 'blur', 'dark', 'contrast', 'resolution', 'coverage')
+# Высота строки текста синтетического чека на 1000 пикселей его ширины (make_corpus)
+TEXT_HEIGHT = 28
+
+
+def metric_value(report, metric):
+    if metric == 'resolution':
+        return min(report.width, report.height)
+    return getattr(report, metric)
+
+
+def background(rng, size):
+    """Фон кадра: стол или ткань - ровный тон с шумом"""
+    width, height = size
+    tone = rng.uniform(50, 150)
+    np_rng = np.random.default_rng(rng.randrange(2 ** 32))
+    noise = np_rng.normal(tone, 12, (height // 8 + 1, width // 8 + 1, 3)).clip(0, 255).astype(np.uint8)
+    return Image.fromarray(noise).resize(size, Image.BILINEAR)
+
+
+def photograph(receipt, rng, coverage, long_side):
+    """
+    Кадр с чеком: чек занимает долю coverage кадра (портрет 3:4), повернут на
+    несколько градусов и лежит в случайном месте; длинная сторона кадра - long_side
+    Возвращает (кадр, масштаб чека)
+    """
+    rw, rh = receipt.size
+    frame_w = max(rw, int(math.sqrt(rw * rh / coverage * 0.75)))
+    frame_h = max(rh, int(frame_w / 0.75))
+
+    # Кадр сразу в размере фото: чек уменьшается (и только потом поворачивается),
+    # фон рисуется в итоговом размере
+    scale = long_side / max(frame_w, frame_h)
+    receipt = receipt.resize((max(1, round(rw * scale)), max(1, round(rh * scale))), Image.LANCZOS)
+    receipt = receipt.rotate(rng.uniform(-4, 4), resample=Image.BICUBIC, expand=True, fillcolor=(90, 90, 90))
+    frame = background(rng, (max(receipt.width, round(frame_w * scale)), max(receipt.height, round(frame_h * scale))))
+    frame.paste(receipt, (rng.randint(0, frame.width - receipt.width), rng.randint(0, frame.height - receipt.height)))
+    return frame, scale
+
+
+def make_sample(rng, kind):
+    """
+    Одно фото класса kind: (байты JPEG, описание искажения)
+    """
+    from benchmarks.make_corpus import make_receipt_fields, render_receipt
+
+    width = rng.randint(900, 1400)
+    receipt = render_receipt(make_receipt_fields(rng), width, int(width * 1.33), rng.random() < 0.7, 0)
+
+    coverage = rng.uniform(0.02, 0.07) if kind == 'coverage' else rng.uniform(0.3, 0.9)
+    # Размер фото с телефона; миниатюра - короткая сторона 160-360
+    if kind == 'resolution':
+        long_side = rng.randint(210, 480)
+    else:
+        long_side = rng.randint(1024, 2048) if rng.random() < 0.7 else rng.randint(800, 1024)
+    frame, scale = photograph(receipt, rng, coverage, long_side)
+
+    # Размытие - в долях высоты строки текста в итоговом фото
+    text_px = TEXT_HEIGHT * width / 1000 * scale
+    if kind == 'blur':
+        blur = rng.uniform(0.18, 0.35)
+    elif kind == 'good':
+        blur = rng.choice([0, 0, rng.uniform(0, 0.05)])
+    else:
+        blur = rng.uniform(0, 0.03)
+    if blur:
+        frame = frame.filter(ImageFilter.GaussianBlur(blur * text_px))
+
+    pixels = np.asarray(frame).astype(np.float32)
+    if kind == 'dark':
+        pixels *= rng.uniform(0.06, 0.2)
+        note = 'темно'
+    elif kind == 'contrast':
+        # Засветка: все тона сжимаются к белому
+        gain = rng.uniform(0.06, 0.15)
+        pixels = pixels * gain + 255 * (1 - gain)
+        note = 'засветка'
+    elif kind == 'good' and rng.random() < 0.5:
+        if rng.random() < 0.5:
+            pixels *= rng.uniform(0.45, 0.8)
+            note = 'тускло'
+        else:
+            gain = rng.uniform(0.55, 0.85)
+            pixels = pixels * gain + 255 * (1 - gain)
+            note = 'блик'
+    else:
+        note = ''
+    noise = np.random.default_rng(rng.randrange(2 ** 32)).standard_normal(pixels.shape, dtype=np.float32)
+    pixels += noise * rng.uniform(1, 4)
+
+    buffer = io.BytesIO()
+    Image.fromarray(pixels.clip(0, 255).astype(np.uint8)).save(buffer, 'JPEG', quality=rng.randint(70, 92))
+    details = f"{frame.width}×{frame.height}, чек {coverage:.0%} кадра, размытие {blur:.2f}"
+    return buffer.getvalue(), f"{details}, {note}" if note else details
+
+
+def build_corpus(samples, seed, photos_dir=None):
+    """[(класс, байты, описание)]"""
+    rng = random.Random(seed)
+    corpus = [(kind, *make_sample(rng, kind)) for kind in CLASSES for _ in range(samples)]
+
+    if photos_dir:
+        for label in ('good', 'bad'):
+            folder = os.path.join(photos_dir, label)
+            for name in sorted(os.listdir(folder)) if os.path.isdir(folder) else []:
+                with open(os.path.join(folder, name), 'rb') as f:
+                    corpus.append((label, f.read(), name))
+    return corpus
+
+
+def choose_threshold(good, bad, max_false_reject):
+    """
+    Порог «не меньше»: отклоняет не больше max_false_reject годных и как можно
+    больше плохих; посередине между пойманными плохими и годными
+    """
+    good = sorted(good)
+    allowed = int(len(good) * max_false_reject)
+    edge = good[allowed]
+    caught = [value for value in bad if value < edge]
+    if not caught:
+        return edge / 2
+    return (max(caught) + edge) / 2
+
+
+def evaluate(measured, thresholds):
+    """Доля пропущенных годных и отклоненных плохих по классам"""
+    from image_quality import find_problems
+
+    result = {}
+    for kind, report, _ in measured:
+        problems = find_problems(report, thresholds)
+        stats = result.setdefault(kind, {'total': 0, 'rejected': 0, 'expected': 0})
+        stats['total'] += 1
+        stats['rejected'] += bool(problems)
+        # Класс корпуса совпадает с кодом замечания (ADVICE)
+        stats['expected'] += kind in problems
+    return result
+
+
+def run(args):
+    from image_decode import decode_bytes
+    from image_quality import QualityThresholds, measure_quality
+
+    corpus = build_corpus(args.samples, args.seed, args.photos)
+    measured = []
+    timings = []
+    for kind, data, details in corpus:
+        report = measure_quality(decode_bytes(data))
+        measured.append((kind, report, details))
+        timings.append(report.elapsed_ms)
+
+    good = [report for kind, report, _ in measured if kind == 'good']
+    chosen = {}
+    rows = []
+    for metric, (field, kind, _) in METRICS.items():
+        good_values = [metric_value(r, metric) for r in good]
+        bad_values = [metric_value(r, metric) for k, r, _ in measured if k == kind]
+        threshold = choose_threshold(good_values, bad_values, args.max_false_reject)
+        chosen[field] = int(threshold) if metric == 'resolution' else round(threshold, 3 if threshold < 1 else 0)
+        rows.append({
+            'metric': metric,
+            'good_p5': percentile(good_values, 5),
+            'good_p50': percentile(good_values, 50),
+            'bad_p50': percentile(bad_values, 50),
+            'bad_p95': percentile(bad_values, 95),
+            'threshold': chosen[field],
+            'caught': sum(1 for v in bad_values if v < chosen[field]) / len(bad_values),
+            'false_reject': sum(1 for v in good_values if v < chosen[field]) / len(good_values),
+        })
+
+    thresholds = QualityThresholds(**chosen)
+    evaluation = evaluate(measured, thresholds)
+    current = evaluate(measured, QualityThresholds())
+    return {
+        'samples': len(measured),
+        'metrics': rows,
+        'thresholds': chosen,
+        'evaluation': evaluation,
+        'current': current,
+        'check_ms': {'p50': percentile(timings, 50), 'p95': percentile(timings, 95)},
+    }
+
+
+def format_evaluation(title, evaluation):
+    lines = [title]
+    for kind, stats in evaluation.items():
+        if kind == 'good':
+            passed = stats['total'] - stats['rejected']
+            lines.append(f"  good: пропущено {passed}/{stats['total']} ({passed / stats['total']:.0%})")
+        else:
+            expected = f", с нужным советом {stats['expected']}" if kind != 'bad' else ''
+            lines.append(f"  {kind}: отклонено {stats['rejected']}/{stats['total']} "
+                         f"({stats['rejected'] / stats['total']:.0%}){expected}")
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Подбор порогов проверки качества фото')
+    parser.add_argument('--samples', type=int, default=40, help='Фото каждого класса')
+    parser.add_argument('--seed', type=int, default=20250813)
+    parser.add_argument('--max-false-reject', type=float, default=0.0,
+                        help='Доля годных фото, которую метрика может отклонить')
+    parser.add_argument('--photos', help='Папка с настоящими фото: good/ и bad/')
+    parser.add_argument('--json', help='Сохранить результаты в JSON-файл')
+    args = parser.parse_args()
+
+    results = run(args)
+
+    print(f"Корпус: {results['samples']} фото")
+    print(f"{'Метрика':<12}{'годные p5':>11}{'p50':>9}{'плохие p50':>12}{'p95':>9}"
+          f"{'порог':>9}{'поймано':>9}{'ложных':>8}")
+    for row in results['metrics']:
+        print(f"{row['metric']:<12}{row['good_p5']:>11.2f}{row['good_p50']:>9.2f}{row['bad_p50']:>12.2f}"
+              f"{row['bad_p95']:>9.2f}{row['threshold']:>9}{row['caught']:>9.0%}{row['false_reject']:>8.0%}")
+    print()
+    print(format_evaluation('Подобранные пороги:', results['evaluation']))
+    print(format_evaluation('Текущие пороги (окружение):', results['current']))
+    print(f"Проверка: p50 {results['check_ms']['p50']:.1f} мс, p95 {results['check_ms']['p95']:.1f} мс")
+    print()
+    print('# .env')
+    for field, _, env in METRICS.values():
+        print(f"{env}={results['thresholds'][field]}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    good = results['evaluation'].get('good', {})
+    sys.exit(0 if good and good['rejected'] <= good['total'] * args.max_false_reject else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""
+A/B-сравнение режимов ответа OpenAI Vision (VISION_OUTPUT_MODE):
+structured (JSON-схема + короткий промпт) и legacy (прежний текстовый промпт)
+
+Для каждого режима: токены на чек (промпт, из них из кэша, ответ), задержка,
+доля ответов без валидного JSON и точность полей относительно manifest корпуса.
+Режимы чередуются на каждом изображении, чтобы дрейф задержки API влиял на оба одинаково.
+
+По умолчанию запросы идут в локальный фейк OpenAI: задержка - сеть из FaultInjector
+плюс генерация ответа (--decode-ms на токен), токены оцениваются по запросу
+(benchmarks.fakes.estimate_prompt_tokens) - так видна разница в размере промпта
+и ответа, но не качество распознавания и не реальная доля невалидного JSON.
+С --live - реальный OpenAI (нужен OPENAI_API_KEY, запросы платные).
+
+Запуск из корня репозитория:
+    python -m benchmarks.vision_prompt
+    python -m benchmarks.vision_prompt --live --repeat 3 --json vision_ab.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+from benchmarks import fakes
+from benchmarks.common import percentile
+
+CORPUS_DIR = os.path.join(os.path.dirname(__file__), 'corpus')
+MANIFEST_PATH = os.path.join(CORPUS_DIR, 'manifest.json')
+
+MODES = ('structured', 'legacy')
+CHECKED_FIELDS = ('full_name', 'amount', 'seller_inn', 'buyer_inn', 'date')
+
+
+def normalize_field(field, value):
+    """Значение поля для сравнения с ожидаемым (формат суммы у модели может отличаться)"""
+    from receipt_model import extract_amount_number
+
+    value = str(value or '').strip()
+    if field == 'amount':
+        return round(extract_amount_number(value), 2)
+    return value
+
+
+def run_mode(parser, image_path, expected):
+    """Один запрос: (задержка мс, usage, json_ok, число верных полей)"""
+    started = time.perf_counter()
+    success, data, message = parser.parse_receipt(image_path, timeout=120)
+    latency = (time.perf_counter() - started) * 1000
+
+    usage = parser.last_usage
+    json_ok = success or not (message.startswith('Ошибка парсинга JSON') or 'обрезан' in message)
+    correct = sum(
+        1 for field in CHECKED_FIELDS
+        if success and normalize_field(field, data.get(field)) == normalize_field(field, expected.get(field))
+    )
+    return latency, usage, json_ok, success, correct
+
+
+def summarize(samples):
+    """Сводка по запросам одного режима"""
+    def avg(key):
+        values = [s[key] for s in samples if s[key] is not None]
+        return sum(values) / len(values) if values else 0.0
+
+    latencies = [s['latency_ms'] for s in samples]
+    return {
+        'requests': len(samples),
+        'json_failures': sum(1 for s in samples if not s['json_ok']),
+        'json_failure_rate': sum(1 for s in samples if not s['json_ok']) / len(samples),
+        'errors': sum(1 for s in samples if not s['success']),
+        'prompt_tokens': avg('prompt_tokens'),
+        'cached_tokens': avg('cached_tokens'),
+        'completion_tokens': avg('completion_tokens'),
+        'total_tokens': avg('prompt_tokens') + avg('completion_tokens'),
+        'latency_p50_ms': percentile(latencies, 50),
+        'latency_p95_ms': percentile(latencies, 95),
+        'field_accuracy': (sum(s['correct'] for s in samples)
+                           / (len(samples) * len(CHECKED_FIELDS))),
+    }
+
+
+def format_summary(mode, r):
+    return (
+        f"[{mode}] запросов: {r['requests']}, ошибок: {r['errors']}, "
+        f"невалидный JSON: {r['json_failures']} ({r['json_failure_rate'] * 100:.1f}%)\n"
+        f"  токенов на чек: промпт {r['prompt_tokens']:.0f} (из кэша {r['cached_tokens']:.0f}), "
+        f"ответ {r['completion_tokens']:.0f}, всего {r['total_tokens']:.0f}\n"
+        f"  задержка: p50 {r['latency_p50_ms']:.0f} мс, p95 {r['latency_p95_ms']:.0f} мс\n"
+        f"  точность полей: {r['field_accuracy'] * 100:.1f}%"
+    )
+
+
+def format_delta(new, old):
+    def pct(key):
+        return (new[key] - old[key]) / old[key] * 100 if old[key] else 0.0
+
+    return (
+        f"structured против legacy: токенов на чек {pct('total_tokens'):+.1f}% "
+        f"(промпт {pct('prompt_tokens'):+.1f}%, ответ {pct('completion_tokens'):+.1f}%), "
+        f"p50 {pct('latency_p50_ms'):+.1f}%, "
+        f"невалидный JSON {new['json_failure_rate'] * 100:.1f}% против {old['json_failure_rate'] * 100:.1f}%"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='A/B режимов ответа OpenAI Vision')
+    parser.add_argument('--live', action='store_true', help='Реальный OpenAI (OPENAI_API_KEY)')
+    parser.add_argument('--repeat', type=int, default=1, help='Сколько раз прогнать корпус')
+    parser.add_argument('--latency-ms', type=float, default=300, help='Задержка фейка OpenAI')
+    parser.add_argument('--decode-ms', type=float, default=10,
+                        help='Фейк: мс на токен ответа (gpt-4o-mini - порядка 10)')
+    parser.add_argument('--json', help='Сохранить результаты в JSON-файл')
+    args = parser.parse_args()
+
+    with open(MANIFEST_PATH, encoding='utf-8') as f:
+        manifest = json.load(f)
+    images = manifest['images']
+
+    server = None
+    if args.live:
+        if not os.getenv('OPENAI_API_KEY'):
+            sys.exit('Для --live нужен OPENAI_API_KEY')
+    else:
+        # Фейк отвечает чеками по кругу: на каждое изображение - по запросу на режим
+        receipts = [dict(e['expected'], status='Действителен') for e in images for _ in MODES]
+        server = fakes.FakeOpenAIServer(
+            receipts, fakes.FaultInjector(args.latency_ms, args.latency_ms / 4, 0, seed=2),
+            decode_ms_per_token=args.decode_ms
+        ).start()
+        os.environ['OPENAI_API_KEY'] = 'benchmark'
+        os.environ['OPENAI_BASE_URL'] = server.base_url
+
+    from openai_vision import OpenAIVisionParser
+
+    parsers = {mode: OpenAIVisionParser(mode=mode) for mode in MODES}
+    samples = {mode: [] for mode in MODES}
+    try:
+        for _ in range(args.repeat):
+            for entry in images:
+                path = os.path.join(CORPUS_DIR, entry['file'])
+                for mode in MODES:
+                    latency, usage, json_ok, success, correct = run_mode(
+                        parsers[mode], path, entry['expected']
+                    )
+                    details = getattr(usage, 'prompt_tokens_details', None)
+                    samples[mode].append({
+                        'latency_ms': latency,
+                        'prompt_tokens': usage.prompt_tokens if usage else None,
+                        'cached_tokens': getattr(details, 'cached_tokens', None) or 0,
+                        'completion_tokens': usage.completion_tokens if usage else None,
+                        'json_ok': json_ok,
+                        'success': success,
+                        'correct': correct,
+                    })
+    finally:
+        if server:
+            server.stop()
+
+    results = {mode: summarize(samples[mode]) for mode in MODES}
+    print(f"Источник: {'OpenAI' if args.live else 'фейк OpenAI (токены - оценка)'}, "
+          f"изображений: {len(images)} × {args.repeat}")
+    for mode in MODES:
+        print(format_summary(mode, results[mode]))
+    print(format_delta(results['structured'], results['legacy']))
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""
+Сравнение маршрутизации Vision (VISION_ROUTING): off (сразу качество по умолчанию)
+и low_first (сначала detail=low, при пустых/некорректных полях - повтор в высоком)
+
+Для каждого режима: запросов и токенов на чек (промпт, оценка токенов изображения
+по vision_usage, ответ), стоимость, задержка распознавания чека, доля эскалаций,
+доля чеков с ошибками проверки и точность полей относительно manifest корпуса.
+Режимы чередуются на каждом изображении, как в benchmarks.vision_prompt.
+
+По умолчанию запросы идут в локальный фейк OpenAI: ответ на detail=low с долей
+--low-miss теряет одно из обязательных полей (так проверяется эскалация), токены
+изображения в usage фейка - условные. С --live - реальный OpenAI (нужен
+OPENAI_API_KEY, запросы платные): реальная доля эскалаций и точность.
+
+Запуск из корня репозитория:
+    python -m benchmarks.vision_routing
+    python -m benchmarks.vision_routing --low-miss 0.5 --repeat 5
+    python -m benchmarks.vision_routing --live --json vision_routing.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+from benchmarks import fakes
+from benchmarks.common import percentile
+from benchmarks.vision_prompt import CHECKED_FIELDS, CORPUS_DIR, MANIFEST_PATH, normalize_field
+
+ROUTINGS = ('off', 'low_first')
+
+
+def run_routing(parser, routing, image_path, expected):
+    """Один чек: задержка мс, учет vision_usage, success, число верных полей"""
+    from receipt_processor import recognize_receipt
+    from vision_usage import usage_scope
+
+    with usage_scope() as usage:
+        started = time.perf_counter()
+        success, data, _ = recognize_receipt(parser, image_path, timeout=120, routing=routing)
+        latency = (time.perf_counter() - started) * 1000
+
+    correct = sum(
+        1 for field in CHECKED_FIELDS
+        if success and normalize_field(field, data.get(field)) == normalize_field(field, expected.get(field))
+    )
+    return {'latency_ms': latency, 'success': success, 'correct': correct, **usage.as_dict()}
+
+
+def summarize(samples):
+    """Сводка по чекам одного режима"""
+    count = len(samples)
+
+    def per_receipt(key):
+        return sum(s[key] for s in samples) / count
+
+    latencies = [s['latency_ms'] for s in samples]
+    return {
+        'receipts': count,
+        'errors': sum(1 for s in samples if not s['success']),
+        'calls': per_receipt('calls'),
+        'prompt_tokens': per_receipt('prompt_tokens'),
+        'image_tokens': per_receipt('image_tokens'),
+        'completion_tokens': per_receipt('completion_tokens'),
+        'cost_usd': per_receipt('cost_usd'),
+        'escalation_rate': sum(s['escalations'] for s in samples) / count,
+        'unresolved_rate': sum(s['unresolved'] for s in samples) / count,
+        'latency_p50_ms': percentile(latencies, 50),
+        'latency_p95_ms': percentile(latencies, 95),
+        'field_accuracy': sum(s['correct'] for s in samples) / (count * len(CHECKED_FIELDS)),
+    }
+
+
+def format_summary(routing, r):
+    return (
+        f"[{routing}] чеков: {r['receipts']}, ошибок: {r['errors']}, "
+        f"запросов на чек: {r['calls']:.2f}, эскалаций: {r['escalation_rate'] * 100:.1f}%\n"
+        f"  токенов на чек: промпт {r['prompt_tokens']:.0f} (изображение ~{r['image_tokens']:.0f}), "
+        f"ответ {r['completion_tokens']:.0f}; ${r['cost_usd'] * 1000:.3f} за 1000 чеков\n"
+        f"  задержка: p50 {r['latency_p50_ms']:.0f} мс, p95 {r['latency_p95_ms']:.0f} мс\n"
+        f"  точность полей: {r['field_accuracy'] * 100:.1f}%, "
+        f"с ошибками проверки: {r['unresolved_rate'] * 100:.1f}%"
+    )
+
+
+def format_delta(new, old):
+    def pct(key):
+        return (new[key] - old[key]) / old[key] * 100 if old[key] else 0.0
+
+    return (
+        f"low_first против off: токенов изображения {pct('image_tokens'):+.1f}%, "
+        f"промпта {pct('prompt_tokens'):+.1f}%, стоимость {pct('cost_usd'):+.1f}%, "
+        f"p50 {pct('latency_p50_ms'):+.1f}%, точность полей "
+        f"{new['field_accuracy'] * 100:.1f}% против {old['field_accuracy'] * 100:.1f}%"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сравнение маршрутизации OpenAI Vision')
+    parser.add_argument('--live', action='store_true', help='Реальный OpenAI (OPENAI_API_KEY)')
+    parser.add_argument('--repeat', type=int, default=3, help='Сколько раз прогнать корпус')
+    parser.add_argument('--latency-ms', type=float, default=300, help='Задержка фейка OpenAI')
+    parser.add_argument('--decode-ms', type=float, default=10, help='Фейк: мс на токен ответа')
+    parser.add_argument('--low-miss', type=float, default=0.2,
+                        help='Фейк: доля ответов detail=low с пустым полем')
+    parser.add_argument('--json', help='Сохранить результаты в JSON-файл')
+    args = parser.parse_args()
+
+    with open(MANIFEST_PATH, encoding='utf-8') as f:
+        manifest = json.load(f)
+    # PDF распознаются после рендера страницы - здесь только изображения
+    images = [e for e in manifest['images'] if not e['file'].endswith('.pdf')]
+
+    server = None
+    if args.live:
+        if not os.getenv('OPENAI_API_KEY'):
+            sys.exit('Для --live нужен OPENAI_API_KEY')
+    else:
+        # Чеки по кругу: на каждое изображение - по чеку на режим (эскалация получает тот же)
+        receipts = [dict(e['expected'], status='Действителен') for e in images for _ in ROUTINGS]
+        server = fakes.FakeOpenAIServer(
+            receipts, fakes.FaultInjector(args.latency_ms, args.latency_ms / 4, 0, seed=3),
+            decode_ms_per_token=args.decode_ms, low_detail_miss_rate=args.low_miss, seed=3
+        ).start()
+        os.environ['OPENAI_API_KEY'] = 'benchmark'
+        os.environ['OPENAI_BASE_URL'] = server.base_url
+
+    from openai_vision import OpenAIVisionParser
+
+    vision_parser = OpenAIVisionParser()
+    samples = {routing: [] for routing in ROUTINGS}
+    try:
+        for _ in range(args.repeat):
+            for entry in images:
+                path = os.path.join(CORPUS_DIR, entry['file'])
+                for routing in ROUTINGS:
+                    samples[routing].append(run_routing(vision_parser, routing, path, entry['expected']))
+    finally:
+        if server:
+            server.stop()
+
+    results = {routing: summarize(samples[routing]) for routing in ROUTINGS}
+    print(f"Источник: {'OpenAI' if args.live else f'фейк OpenAI (промахи detail=low: {args.low_miss:.0%})'}, "
+          f"изображений: {len(images)} × {args.repeat}")
+    for routing in ROUTINGS:
+        print(format_summary(routing, results[routing]))
+    print(format_delta(results['low_first'], results['off']))
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
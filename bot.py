@@ -1,6 +1,10 @@
 import os
+import re
+import asyncio
 import logging
 import tempfile
+import threading
+import time
 from datetime import datetime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
@@ -18,6 +22,27 @@ from user_manager import UserManager
 from drive_handler import DriveHandler
 from analysis_handler import AnalysisSheetHandler
 from statistics_handler import StatisticsHandler
+from state_backend import get_state_backend, ACTIVE_JOB_STATUSES, JOB_CANCELLED, WORKER_ID
+from analysis_jobs import AnalysisJobQueue, JobCancelled, JobStopped, format_job_status
+from progress_reporter import ProgressReporter
+from scheduler import get_scheduler, INTERACTIVE, BATCH, SCHEDULER_PER_CHAT_IN_FLIGHT
+from memory_budget import get_memory_budget, estimate_footprint
+from scratch_space import get_scratch_space
+from google_transport import transport_stats, format_transport_stats
+from vision_usage import (
+    usage_scope, current_usage, record_chat_usage, format_usage, format_usage_short,
+    usage_period, empty_usage, merge_usage
+)
+from upload_outbox import OutboxWorker, get_upload_outbox, OUTBOX_DONE
+from registry_mirror import get_registry_view, sync_due, sync_registry, REGISTRY_SYNC_INTERVAL
+from fns_verifier import get_fns_verifier, verify_due, format_verify_result, FNS_VERIFY_INTERVAL
+from drive_ingest import (
+    DriveIngest, claim, file_claim_key, processed_namespace, watch_until, ingest_enabled
+)
+from registry_export import (
+    parse_export_args, export_file_name, write_registry_export,
+    FILE_SUFFIXES, TELEGRAM_FILE_LIMIT
+)
 
 load_dotenv()
 
@@ -28,21 +53,90 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Инициализация менеджера пользователей
-user_manager = UserManager()
+# Клиенты Google (OAuth + build()) создаются не при импорте, а при первом
+# обращении или в фоне сразу после запуска (warm_up_clients), чтобы бот
+# начинал отвечать, не дожидаясь их
+_clients_lock = threading.Lock()
+_user_manager = None
+_statistics = None
+_statistics_failed = False
+_warm_up_task = None
+_registry_sync_task = None
+_fns_verify_task = None
+
+
+def get_user_manager():
+    """
+    Менеджер пользователей (создается при первом обращении)
+    """
+    global _user_manager
+    with _clients_lock:
+        if _user_manager is None:
+            _user_manager = UserManager()
+    return _user_manager
+
+
+def get_statistics():
+    """
+    Сбор статистики (создается при первом обращении)
+    Возвращает None, если статистика недоступна
+    """
+    global _statistics, _statistics_failed
+    with _clients_lock:
+        if _statistics is None and not _statistics_failed:
+            try:
+                _statistics = StatisticsHandler()
+            except Exception as e:
+                logger.error(f"Ошибка инициализации статистики: {e}")
+                _statistics_failed = True
+    return _statistics
+
+
+def warm_up_clients():
+    """
+    Создание клиентов Google и загрузка тяжелых библиотек заранее
+    (выполняется в отдельном потоке после запуска бота)
+    """
+    started = time.perf_counter()
+    try:
+        get_user_manager()
+        get_statistics()
+        # Библиотеки распознавания: первый чек не платит за их загрузку
+        import cv2  # noqa: F401
+        import pyzbar.pyzbar  # noqa: F401
+        import openai_vision  # noqa: F401
+    except Exception as e:
+        logger.error(f"Ошибка предварительной инициализации: {e}")
+    logger.info(f"Клиенты и библиотеки загружены за {time.perf_counter() - started:.1f} с")
+
+# Хранилище состояния: структуры пользователей (chat_id -> user_structure),
+# папки анализа (chat_id -> folder_info), дедупликация и очередь задач.
+# STATE_BACKEND=sqlite позволяет запускать несколько воркеров на одном хосте
+state = get_state_backend()
+
+# Планировщик обработки: очереди по чатам, одиночные чеки раньше массового анализа
+scheduler = get_scheduler()
 
-# Инициализация сбора статистики
-try:
-    statistics = StatisticsHandler()
-except Exception as e:
-    logger.error(f"Ошибка инициализации статистики: {e}")
-    statistics = None
+# Бюджет памяти массового анализа (BATCH_MEMORY_BUDGET_MB)
+memory_budget = get_memory_budget()
 
-# Хранилище структуры пользователей (chat_id -> user_structure)
-user_structures = {}
+# Строк в ответе /report (сообщение Telegram - не больше 4096 символов)
+REPORT_MAX_LINES = 60
 
-# Хранилище для папок анализа (user_id -> folder_info)
-analysis_folders = {}
+# Сколько обновлений обрабатывается одновременно: без этого PTB обрабатывает
+# их по одному, и фото одного чата ждет завершения обработки фото другого.
+# Нагрузку на Vision/Google ограничивает планировщик, а не это число
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '64'))
+
+# Сколько файлов одной задачи /full_analyze обрабатывается одновременно
+# (по умолчанию - сколько планировщик дает одному чату)
+ANALYSIS_FILE_CONCURRENCY = max(1, int(os.getenv('ANALYSIS_FILE_CONCURRENCY', str(SCHEDULER_PER_CHAT_IN_FLIGHT))))
+
+# Какой размер фото скачивать: Vision (detail=high) все равно уменьшает
+# изображение до 768 по короткой стороне, QR при этом читается уверенно -
+# берется наименьший размер из присланных Telegram, у которого короткая
+# сторона не меньше PHOTO_MIN_SHORT_SIDE (иначе самый большой)
+PHOTO_MIN_SHORT_SIDE = int(os.getenv('PHOTO_MIN_SHORT_SIDE', '768'))
 
 
 def get_or_init_user_structure(chat_id, username=None, chat_title=None):
@@ -56,18 +150,19 @@ def get_or_init_user_structure(chat_id, username=None, chat_title=None):
         'chat_name': '@username' или 'Название чата'
     }
     """
-    if chat_id in user_structures:
-        return user_structures[chat_id]
+    structure = state.get_user_structure(chat_id)
+    if structure:
+        return structure
     
     # Получаем имя чата
-    chat_name = user_manager.get_chat_name(chat_id, username, chat_title)
+    chat_name = get_user_manager().get_chat_name(chat_id, username, chat_title)
     
     # Создаем или получаем структуру
-    structure = user_manager.get_or_create_user_structure(chat_id, chat_name)
+    structure = get_user_manager().get_or_create_user_structure(chat_id, chat_name)
     structure['chat_name'] = chat_name
     
-    # Сохраняем в памяти
-    user_structures[chat_id] = structure
+    # Сохраняем в общем хранилище
+    state.set_user_structure(chat_id, structure)
     
     logger.info(f"Инициализирована структура для {chat_name}: {structure}")
     
@@ -86,6 +181,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     structure = get_or_init_user_structure(chat_id, username, chat_title)
     
     # Логируем действие
+    statistics = get_statistics()
     if statistics:
         statistics.log_action(
             user_id=chat_id,
@@ -100,7 +196,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "🤖 Я помогаю обрабатывать чеки самозанятых:\n"
         "• Распознаю данные с фото\n"
         "• Загружаю на Google Drive\n"
-        "• Добавляю в таблицу\n\n"
+        "• Добавляю в таблицу\n"
+        "• Проверяю актуальность чеков в ФНС\n\n"
         "📤 Отправь мне:\n"
         "• 📸 Фото чека (или несколько сразу)\n"
         "• 📄 PDF файл\n"
@@ -108,7 +205,6 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "• /full_analyze - массовая обработка из папки\n\n"
         f"📁 Твоя папка: {structure['user_folder_link']}\n"
         f"📊 Твоя таблица: {structure['user_sheet_link']}\n\n"
-        "🚀 <b>Скоро:</b> автоматическая проверка актуальности чеков и другие улучшения!\n\n"
         "💰 Поддержать разработку: https://tbank.ru/cf/9wS7L6U5JP6\n"
         "💬 Предложения и вопросы: @mishaabramyan\n\n"
         "🎬 Другие продукты YOMI:\n"
@@ -123,6 +219,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     Команда /help - справка по боту
     """
     # Логируем действие
+    statistics = get_statistics()
     if statistics:
         statistics.log_action(
             user_id=update.effective_chat.id,
@@ -138,7 +235,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "• Распознавать данные с чеков через AI\n"
         "• Загружать чеки на Google Drive\n"
         "• Добавлять данные в Google Sheets\n"
-        "• Обрабатывать пачки чеков\n\n"
+        "• Обрабатывать пачки чеков\n"
+        "• Проверять, не аннулированы ли чеки в ФНС\n\n"
         "📤 <b>Как пользоваться:</b>\n"
         "1. Отправь фото чека или PDF\n"
         "2. Проверь распознанные данные\n"
@@ -146,6 +244,13 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "🔍 <b>Команды:</b>\n"
         "/start - главное меню\n"
         "/full_analyze - массовая обработка из папки\n"
+        "/status - прогресс массовой обработки\n"
+        "/cancel - отменить массовую обработку\n"
+        "/report - суммы по ИНН покупателя и месяцам\n"
+        "/summary - итоги по реестру чеков\n"
+        "/export - выгрузка реестра в Excel/CSV\n"
+        "/usage - расход OpenAI на распознавание\n"
+        "/verify - проверить статусы чеков в ФНС\n"
         "/help - эта справка\n\n"
         "💡 <b>Советы:</b>\n"
         "• Фотографируй чеки при хорошем освещении\n"
@@ -173,6 +278,7 @@ async def full_analyze(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     try:
         # Логируем начало анализа
+        statistics = get_statistics()
         if statistics:
             statistics.log_action(
                 user_id=chat_id,
@@ -190,13 +296,16 @@ async def full_analyze(update: Update, context: ContextTypes.DEFAULT_TYPE):
         drive = DriveHandler(structure['user_folder_id'])
         folder_id, folder_link = drive.create_analysis_folder(folder_name)
         
-        # Сохраняем информацию о папке
-        analysis_folders[chat_id] = {
+        # Сохраняем информацию о папке (watch_until - до какого времени новые
+        # файлы папки обрабатываются автоматически, см. drive_ingest.py)
+        state.set_analysis_folder(chat_id, {
             'folder_id': folder_id,
             'folder_name': folder_name,
             'folder_link': folder_link,
-            'user_structure': structure
-        }
+            'user_structure': structure,
+            'username': username,
+            'watch_until': watch_until()
+        })
         
         # Отправляем ссылку на папку с кнопкой
         keyboard = [
@@ -204,16 +313,28 @@ async def full_analyze(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        message = (
-            f"✅ Папка создана!\n\n"
-            f"📂 Название: {folder_name}\n"
-            f"🔗 Ссылка: {folder_link}\n\n"
-            f"📋 Инструкция:\n"
-            f"1. Перейди по ссылке выше\n"
-            f"2. Загрузи чеки (фото JPG/PNG или PDF)\n"
-            f"3. Нажми кнопку \"Начать анализ\" ниже\n\n"
-            f"⚠️ Убедись, что загрузил все нужные чеки перед началом анализа!"
-        )
+        if ingest_enabled():
+            message = (
+                f"✅ Папка создана!\n\n"
+                f"📂 Название: {folder_name}\n"
+                f"🔗 Ссылка: {folder_link}\n\n"
+                f"📋 Инструкция:\n"
+                f"1. Перейди по ссылке выше\n"
+                f"2. Загрузи чеки (фото JPG/PNG или PDF) - я обработаю их сразу после загрузки\n"
+                f"3. Когда загрузишь все чеки, нажми кнопку \"Начать анализ\" ниже - "
+                f"дообработаю оставшиеся и пришлю итог"
+            )
+        else:
+            message = (
+                f"✅ Папка создана!\n\n"
+                f"📂 Название: {folder_name}\n"
+                f"🔗 Ссылка: {folder_link}\n\n"
+                f"📋 Инструкция:\n"
+                f"1. Перейди по ссылке выше\n"
+                f"2. Загрузи чеки (фото JPG/PNG или PDF)\n"
+                f"3. Нажми кнопку \"Начать анализ\" ниже\n\n"
+                f"⚠️ Убедись, что загрузил все нужные чеки перед началом анализа!"
+            )
         
         await update.message.reply_text(message, reply_markup=reply_markup)
         
@@ -221,6 +342,7 @@ async def full_analyze(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Ошибка создания папки: {e}")
         
         # Логируем ошибку
+        statistics = get_statistics()
         if statistics:
             statistics.log_action(
                 user_id=chat_id,
@@ -252,46 +374,208 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         
         # Проверяем, что папка существует
-        if chat_id not in analysis_folders:
+        folder_info = state.get_analysis_folder(chat_id)
+        if not folder_info:
             await query.edit_message_text("❌ Папка не найдена. Создай новую через /full_analyze")
             return
         
-        folder_info = analysis_folders[chat_id]
+        # Ставим анализ в очередь (повторное нажатие не создает вторую задачу)
+        job, created = analysis_queue.enqueue(
+            chat_id,
+            {'folder_info': folder_info, 'username': query.from_user.username},
+            dedupe_key=f"analysis:{folder_info['folder_id']}"
+        )
+        
+        if not created:
+            await query.edit_message_text("⏳ Анализ этой папки уже в очереди или выполняется\n/status - прогресс")
+            return
+        
+        position = analysis_queue.queue_position(job)
+        await query.edit_message_text(
+            f"📥 Анализ поставлен в очередь (позиция {position}).\n\n"
+            f"/status - прогресс\n"
+            f"/cancel - отменить анализ"
+        )
+
+
+async def run_analysis_job(bot, job, job_context):
+    """
+    Исполнитель задачи анализа для очереди (см. analysis_jobs.py)
+    """
+    payload = job['payload']
+    return await process_analysis_folder(
+        bot, job['chat_id'], payload.get('username'), payload['folder_info'], job_context
+    )
+
+
+# Очередь задач анализа: воркеры запускаются в on_startup
+analysis_queue = AnalysisJobQueue(run_analysis_job)
+
+
+def analyze_file(drive, processor, file, scratch):
+    """
+    Скачивание и распознавание одного файла из папки анализа
+    (синхронная функция - выполняется в отдельном потоке)
+    scratch - область временных файлов задачи
+    Возвращает (success, receipt, message)
+    """
+    tmp_path = scratch.path(os.path.splitext(file['name'])[1], file.get('size'))
+    
+    try:
+        drive.download_file(file['id'], tmp_path)
+        tmp_path = scratch.settle(tmp_path)
         
-        await query.edit_message_text("🔄 Начинаю обработку чеков...\nЭто может занять несколько минут.")
+        # Обрабатываем чек: JPEG, PNG, WebP, HEIC или PDF - формат определяется
+        # по содержимому, страница PDF рендерится в памяти (image_decode)
+        return processor.process_receipt_image(tmp_path)
+    finally:
+        scratch.remove(tmp_path)
+
+
+async def save_analysis_result(processor, analysis_sheet, spreadsheet_id, file, data, folder_link, folder_name):
+    """
+    Запись распознанного чека в таблицу анализа и корневую таблицу пользователя
+    (два независимых запроса к Sheets - параллельно, в отдельных потоках)
+    """
+    # Добавляем ссылку на файл в Drive
+    data.drive_link = f"https://drive.google.com/file/d/{file['id']}/view"
+    
+    await asyncio.gather(
+        # Добавляем в таблицу анализа
+        asyncio.to_thread(analysis_sheet.add_receipt_to_sheet, spreadsheet_id, data),
+        # Добавляем в корневую таблицу пользователя с гиперссылкой на папку
+        asyncio.to_thread(
+            processor.add_to_user_sheet,
+            data,
+            source_link=folder_link,
+            source_name=f"Папка: {folder_name}"
+        )
+    )
+
+
+async def ensure_analysis_sheet(chat_id, folder_info, owner):
+    """
+    Таблица анализа папки: ее создает первым тот, кто дошел до записи, -
+    задача анализа или автоматическая обработка (drive_ingest); остальные
+    берут ссылку из информации о папке
+    Возвращает (spreadsheet_id, sheet_link)
+    """
+    folder_id = folder_info['folder_id']
+    async with claim(state, f"analysis_sheet:{folder_id}", owner):
+        current = state.get_analysis_folder(chat_id)
+        if not current or current['folder_id'] != folder_id:
+            current = None
+        if current and current.get('spreadsheet_id'):
+            return current['spreadsheet_id'], current['sheet_link']
         
-        # Запускаем обработку
-        await process_analysis_folder(query, folder_info)
+        spreadsheet_id, sheet_link = await asyncio.to_thread(
+            AnalysisSheetHandler().create_analysis_spreadsheet,
+            f"{folder_info['folder_name']}, анализ", folder_id
+        )
+        if current:
+            state.set_analysis_folder(
+                chat_id, {**current, 'spreadsheet_id': spreadsheet_id, 'sheet_link': sheet_link}
+            )
+        return spreadsheet_id, sheet_link
+
+
+async def ingest_analysis_file(chat_id, folder_info, file):
+    """
+    Обработка файла, только что загруженного в папку анализа (drive_ingest):
+    то же, что задача анализа делает с одним файлом
+    Возвращает (success, message)
+    """
+    user_structure = folder_info['user_structure']
+    spreadsheet_id, _ = await ensure_analysis_sheet(chat_id, folder_info, drive_ingest.owner)
+    drive = DriveHandler(user_structure['user_folder_id'])
+    processor = ReceiptProcessor(
+        user_folder_id=user_structure['user_folder_id'],
+        user_sheet_id=user_structure['user_sheet_id']
+    )
+    
+    footprint = estimate_footprint(file.get('size'), file['mimeType'])
+    with usage_scope() as usage, get_scratch_space().scope(f"ingest-{file['id']}") as scratch:
+        async with scheduler.slot(chat_id, BATCH), memory_budget.reserve(footprint):
+            success, data, message = await asyncio.to_thread(
+                analyze_file, drive, processor, file, scratch
+            )
+            if success:
+                await save_analysis_result(
+                    processor, AnalysisSheetHandler(), spreadsheet_id, file, data,
+                    folder_info['folder_link'], folder_info['folder_name']
+                )
+    record_chat_usage(state, chat_id, usage.as_dict())
+    
+    statistics = get_statistics()
+    if statistics:
+        statistics.update_user_stats(
+            user_id=chat_id,
+            username=folder_info.get('username'),
+            action_type='receipt',
+            success=success
+        )
+    return success, message
+
+
+# Автоматическая обработка новых файлов папок анализа: опрос запускается в on_startup
+drive_ingest = DriveIngest(ingest_analysis_file)
 
 
-async def process_analysis_folder(query, folder_info):
+async def process_analysis_folder(bot, chat_id, username, folder_info, job_context):
     """
     Обработка всех файлов из папки анализа
+    Синхронные вызовы Google/OpenAI выполняются в отдельных потоках,
+    чтобы не блокировать обработку остальных обновлений
     """
+    folder_id = folder_info['folder_id']
+    folder_name = folder_info['folder_name']
+    folder_link = folder_info['folder_link']
+    user_structure = folder_info['user_structure']
+    
+    # Индекс уже обработанных файлов папки: их пропускаем (обработаны
+    # автоматически после загрузки или до перезапуска бота)
+    namespace = processed_namespace(folder_id)
+    # Владелец захвата файлов: файл, который сейчас обрабатывает drive_ingest,
+    # дожидаемся, а не обрабатываем второй раз
+    claim_owner = f"{WORKER_ID}:job{job_context.job['id']}"
+    
+    # Статистика
+    total_files = 0
+    processed_count = 0
+    success_count = 0
+    errors = []
+    sheet_link = None
+    progress = None
+    
     try:
         logger.info(f"Начало обработки папки: {folder_info}")
         
-        folder_id = folder_info['folder_id']
-        folder_name = folder_info['folder_name']
-        folder_link = folder_info['folder_link']
-        user_structure = folder_info['user_structure']
-        
         # Получаем список файлов из папки
         drive = DriveHandler(user_structure['user_folder_id'])
-        files = drive.list_files_in_folder(folder_id)
+        files = await asyncio.to_thread(drive.list_files_in_folder, folder_id)
         
         logger.info(f"Найдено файлов: {len(files)}")
         
         if not files:
-            await query.message.reply_text("❌ В папке нет файлов для обработки!")
-            return
+            await bot.send_message(chat_id, "❌ В папке нет файлов для обработки!")
+            state.delete_analysis_folder(chat_id)
+            return {'total': 0}
+        
+        total_files = len(files)
         
-        await query.message.reply_text(f"📊 Найдено файлов: {len(files)}\nНачинаю обработку...")
+        # Одно сообщение с прогрессом, которое обновляется не чаще PROGRESS_UPDATE_INTERVAL
+        title = "Продолжаю анализ после перезапуска бота" if job_context.resumed else "Обработка чеков"
+        progress = ProgressReporter(bot, chat_id, total_files, f"{title} «{folder_name}»")
+        await progress.start()
         
-        # Создаем таблицу для результатов анализа
-        sheet_title = f"{folder_name}, анализ"
+        # Таблица для результатов анализа (при возобновлении или после
+        # автоматической обработки - уже созданная)
         analysis_sheet = AnalysisSheetHandler()
-        spreadsheet_id, sheet_link = analysis_sheet.create_analysis_spreadsheet(sheet_title, folder_id)
+        spreadsheet_id = job_context.progress.get('spreadsheet_id')
+        sheet_link = job_context.progress.get('sheet_link')
+        if not spreadsheet_id:
+            spreadsheet_id, sheet_link = await ensure_analysis_sheet(chat_id, folder_info, claim_owner)
+            job_context.report_progress(spreadsheet_id=spreadsheet_id, sheet_link=sheet_link)
         
         # Создаем процессор с пользовательской структурой
         processor = ReceiptProcessor(
@@ -299,93 +583,90 @@ async def process_analysis_folder(query, folder_info):
             user_sheet_id=user_structure['user_sheet_id']
         )
         
-        # Статистика
-        total_files = len(files)
-        processed_count = 0
-        success_count = 0
-        errors = []
+        job_context.report_progress(total=total_files, done=0, success=0, errors=0)
         
-        # Обрабатываем каждый файл
-        for idx, file in enumerate(files, 1):
+        async def process_file(idx, file):
+            nonlocal processed_count, success_count
+            file_name = file['name']
+            success = False
             try:
-                file_id = file['id']
-                file_name = file['name']
-                file_type = file['mimeType']
-                
-                logger.info(f"Обработка файла {idx}/{total_files}: {file_name}")
-                await query.message.reply_text(f"⏳ Обработка {idx}/{total_files}: {file_name}")
-                
-                # Скачиваем файл
-                with tempfile.NamedTemporaryFile(delete=False, suffix='.tmp') as tmp_file:
-                    tmp_path = tmp_file.name
-                
-                drive.download_file(file_id, tmp_path)
-                
-                # Если PDF - конвертируем в JPG
-                if file_type == 'application/pdf':
-                    from pdf2image import convert_from_path
-                    images = convert_from_path(tmp_path, first_page=1, last_page=1)
+                async with claim(state, file_claim_key(file['id']), claim_owner):
+                    if state.is_processed(namespace, file['id']):
+                        logger.info(f"Файл {file_name} уже обработан, пропускаю")
+                        processed_count += 1
+                        success_count += 1
+                        progress.file_skipped()
+                        return
                     
-                    if not images:
-                        errors.append(f"{file_name}: Не удалось прочитать PDF")
-                        os.unlink(tmp_path)
-                        continue
+                    logger.info(f"Обработка файла {idx}/{total_files}: {file_name}")
+                    progress.file_started(file_name)
                     
-                    # Сохраняем как изображение
-                    img_path = tmp_path.replace('.tmp', '.jpg')
-                    images[0].save(img_path, 'JPEG')
-                    os.unlink(tmp_path)
-                    tmp_path = img_path
-                
-                # Обрабатываем чек
-                success, data, message = processor.process_receipt_image(tmp_path)
-                
-                if success:
-                    # Добавляем ссылку на файл в Drive
-                    file_link = f"https://drive.google.com/file/d/{file_id}/view"
-                    data['drive_link'] = file_link
-                    
-                    # Добавляем в таблицу анализа
-                    analysis_sheet.add_receipt_to_sheet(spreadsheet_id, data)
-                    
-                    # Добавляем в корневую таблицу пользователя с гиперссылкой на папку
-                    processor.add_to_user_sheet(
-                        data,
-                        source_link=folder_link,
-                        source_name=f"Папка: {folder_name}"
-                    )
-                    
-                    # Обновляем статистику пользователя
-                    if statistics:
-                        statistics.update_user_stats(
-                            user_id=query.message.chat_id,
-                            username=query.from_user.username,
-                            action_type='receipt',
-                            success=True
+                    # Слот планировщика, затем место в бюджете памяти по оценке размера файла
+                    footprint = estimate_footprint(file.get('size'), file['mimeType'])
+                    async with scheduler.slot(chat_id, BATCH), memory_budget.reserve(footprint):
+                        success, data, message = await asyncio.to_thread(
+                            analyze_file, drive, processor, file, job_context.scratch
                         )
+                        
+                        if success:
+                            await save_analysis_result(
+                                processor, analysis_sheet, spreadsheet_id,
+                                file, data, folder_link, folder_name
+                            )
                     
-                    success_count += 1
-                    processed_count += 1
-                else:
-                    errors.append(f"{file_name}: {message}")
-                    processed_count += 1
-                    
-                    # Логируем ошибку в статистику
-                    if statistics:
-                        statistics.update_user_stats(
-                            user_id=query.message.chat_id,
-                            username=query.from_user.username,
-                            action_type='receipt',
-                            success=False
-                        )
+                    if success:
+                        state.mark_processed(namespace, file['id'])
+                        success_count += 1
+                    else:
+                        errors.append(f"{file_name}: {message}")
+                
+                # Обновляем статистику пользователя
+                statistics = get_statistics()
+                if statistics:
+                    statistics.update_user_stats(
+                        user_id=chat_id,
+                        username=username,
+                        action_type='receipt',
+                        success=success
+                    )
                 
-                # Удаляем временный файл
-                os.unlink(tmp_path)
+                processed_count += 1
                 
             except Exception as e:
                 logger.error(f"Ошибка обработки файла {file_name}: {e}")
                 errors.append(f"{file_name}: {str(e)}")
                 processed_count += 1
+                success = False
+            finally:
+                if file_name in progress.in_flight:
+                    progress.file_finished(file_name, success)
+                job_context.report_progress(done=processed_count, success=success_count, errors=len(errors))
+        
+        # Файлы обрабатываются ANALYSIS_FILE_CONCURRENCY воркерами: пока один
+        # скачивает файл из Drive, другой пишет результат в Sheets (клиенты
+        # Google потокобезопасны - google_transport). Строки в таблице анализа
+        # идут в порядке завершения, а не в порядке файлов в папке
+        pending = enumerate(files, 1)
+        
+        async def worker():
+            for idx, file in pending:
+                # Отмена (/cancel) или остановка бота - между файлами
+                job_context.checkpoint()
+                await process_file(idx, file)
+        
+        results = await asyncio.gather(
+            *(worker() for _ in range(min(ANALYSIS_FILE_CONCURRENCY, total_files))),
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        
+        transport = transport_stats()
+        if transport and transport['requests']:
+            logger.info(f"Google HTTP: {format_transport_stats(transport)}")
+        
+        await progress.finish("✅ Обработка завершена")
         
         # Формируем итоговое сообщение
         result_message = f"✅ <b>Анализ завершен!</b>\n\n"
@@ -403,26 +684,541 @@ async def process_analysis_folder(query, folder_info):
             if len(errors) > 10:
                 result_message += f"\n... и еще {len(errors) - 10} ошибок"
         
-        await query.message.reply_text(result_message, parse_mode='HTML')
+        await bot.send_message(chat_id, result_message, parse_mode='HTML')
         
-        # Логируем завершение анализа
+        # Логируем завершение анализа (с расходом OpenAI за задачу)
+        statistics = get_statistics()
         if statistics:
+            details = f"Обработано: {success_count}/{total_files}"
+            usage = current_usage()
+            if usage:
+                details += f", {format_usage_short(usage)}"
             statistics.log_action(
-                user_id=query.message.chat_id,
-                username=query.from_user.username,
+                user_id=chat_id,
+                username=username,
                 action="/full_analyze - завершение",
                 result="успех",
-                details=f"Обработано: {success_count}/{total_files}"
+                details=details
             )
         
-        # Удаляем информацию о папке из памяти
-        chat_id = query.message.chat_id
-        if chat_id in analysis_folders:
-            del analysis_folders[chat_id]
-        
+    except JobCancelled:
+        if progress:
+            await progress.finish("🛑 Обработка остановлена")
+        await bot.send_message(
+            chat_id,
+            f"🛑 Анализ отменен.\n\n"
+            f"📊 Обработано чеков: {processed_count}/{total_files}\n"
+            f"✅ Успешно: {success_count}\n"
+            f"❌ Ошибок: {len(errors)}"
+            + (f"\n\n📁 Таблица анализа:\n{sheet_link}" if sheet_link else "")
+        )
+        statistics = get_statistics()
+        if statistics:
+            statistics.log_action(
+                user_id=chat_id,
+                username=username,
+                action="/full_analyze - отмена",
+                result="успех",
+                details=f"Обработано: {processed_count}/{total_files}"
+            )
+        state.delete_analysis_folder(chat_id)
+        state.clear_processed(namespace)
+        raise
+    
+    except JobStopped:
+        # Остановка бота: задача вернется в очередь, индекс обработанных файлов сохраняется
+        if progress:
+            await progress.finish("⏸ Анализ приостановлен: бот перезапускается, продолжу автоматически")
+        raise
+    
     except Exception as e:
         logger.error(f"Ошибка обработки папки: {e}")
-        await query.message.reply_text(f"❌ Произошла ошибка: {str(e)}")
+        if progress:
+            await progress.finish("❌ Обработка прервана")
+        await bot.send_message(chat_id, f"❌ Произошла ошибка: {str(e)}")
+        raise
+    
+    # Удаляем информацию о папке и индекс обработанных файлов
+    state.delete_analysis_folder(chat_id)
+    state.clear_processed(namespace)
+    
+    return {'total': total_files, 'success': success_count, 'errors': len(errors)}
+
+
+async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Команда /status - состояние задач анализа
+    """
+    chat_id = update.effective_chat.id
+    jobs = state.list_jobs(chat_id=chat_id)
+    
+    active = [job for job in jobs if job['status'] in ACTIVE_JOB_STATUSES]
+    if not active and not jobs:
+        await update.message.reply_text("📭 Задач анализа нет.\nЗапусти /full_analyze")
+        return
+    
+    # Активные задачи, а если их нет - последняя завершенная
+    shown = active or jobs[-1:]
+    text = '\n\n'.join(
+        format_job_status(job, analysis_queue.queue_position(job)) for job in shown
+    )
+    await update.message.reply_text(text)
+
+
+async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Команда /cancel - отмена задач анализа этого чата
+    """
+    chat_id = update.effective_chat.id
+    active = state.list_jobs(chat_id=chat_id, statuses=ACTIVE_JOB_STATUSES)
+    
+    if not active:
+        await update.message.reply_text("📭 Нет задач анализа для отмены")
+        return
+    
+    for job in active:
+        job = state.request_job_cancel(job['id'])
+        if job['status'] == JOB_CANCELLED:
+            # Задача не успела начаться
+            state.delete_analysis_folder(chat_id)
+            await update.message.reply_text("🛑 Анализ удален из очереди")
+        else:
+            await update.message.reply_text("🛑 Отменяю анализ - остановлюсь после текущих файлов")
+    
+    statistics = get_statistics()
+    if statistics:
+        statistics.log_action(
+            user_id=chat_id,
+            username=update.effective_user.username,
+            action="/cancel",
+            result="успех",
+            details=f"Отменено задач: {len(active)}"
+        )
+
+
+def format_money(value):
+    """7021.5 → '7 021.50 ₽'"""
+    return f"{value:,.2f}".replace(',', ' ') + ' ₽'
+
+
+async def load_registry_mirror(chat_id, reply):
+    """
+    Локальная копия реестра чата - все листы таблицы (None - реестр еще не создан)
+    Если копия ни разу не загружалась целиком, таблица читается один раз сейчас
+    """
+    structure = state.get_user_structure(chat_id)
+    if not structure or not structure.get('user_sheet_id'):
+        return None
+    
+    sheet_id = structure['user_sheet_id']
+    if not get_registry_view(sheet_id).read_meta().get('full_sync'):
+        await reply("⏳ Загружаю реестр из таблицы...")
+        await asyncio.to_thread(sync_registry, sheet_id, True)
+    # Список листов - после синхронизации (она находит листы периодов)
+    return get_registry_view(sheet_id)
+
+
+async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Команда /report [год] [ИНН] - суммы чеков по ИНН покупателя и месяцам
+    """
+    chat_id = update.effective_chat.id
+    year, inn = None, None
+    for arg in context.args or []:
+        if re.fullmatch(r'\d{4}', arg):
+            year = int(arg)
+        elif re.fullmatch(r'\d{10}|\d{12}', arg):
+            inn = arg
+        else:
+            await update.message.reply_text(
+                "❓ Использование: /report [год] [ИНН]\n"
+                "Например: /report 2025 или /report 9705246070"
+            )
+            return
+    
+    try:
+        mirror = await load_registry_mirror(chat_id, update.message.reply_text)
+    except Exception as e:
+        logger.error(f"Ошибка загрузки реестра (чат {chat_id}): {e}")
+        await update.message.reply_text(f"❌ Не удалось загрузить реестр: {str(e)}")
+        return
+    if mirror is None:
+        await update.message.reply_text("📭 Реестр еще не создан - отправь чек или /start")
+        return
+    
+    rows = mirror.report(inn=inn, year=year)
+    if not rows:
+        await update.message.reply_text("📭 Подходящих чеков в реестре нет")
+        return
+    
+    title = "📊 Суммы по ИНН покупателя и месяцам"
+    if year:
+        title += f" за {year}"
+    lines = [title]
+    total_count, total_amount = 0, 0.0
+    current_inn = None
+    for row_inn, month, count, total in rows:
+        if row_inn != current_inn:
+            current_inn = row_inn
+            lines.append(f"\n🏢 ИНН {row_inn}" if row_inn else "\n🏢 ИНН не распознан")
+        month_label = f"{month[5:7]}.{month[:4]}" if month else "без даты"
+        lines.append(f"  • {month_label}: {count} шт., {format_money(total)}")
+        total_count += count
+        total_amount += total
+    
+    # Сообщение Telegram ограничено 4096 символами
+    if len(lines) > REPORT_MAX_LINES:
+        hidden = len(lines) - REPORT_MAX_LINES
+        lines = lines[:REPORT_MAX_LINES] + [f"... и еще строк: {hidden} (уточни год или ИНН)"]
+    lines.append(f"\n💰 Итого: {total_count} шт., {format_money(total_amount)}")
+    await update.message.reply_text('\n'.join(lines))
+    
+    statistics = get_statistics()
+    if statistics:
+        statistics.log_action(
+            user_id=chat_id,
+            username=update.effective_user.username,
+            action="/report",
+            result="успех",
+            details=' '.join(context.args or [])
+        )
+
+
+async def summary_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Команда /summary - итоги по реестру чеков
+    """
+    chat_id = update.effective_chat.id
+    try:
+        mirror = await load_registry_mirror(chat_id, update.message.reply_text)
+    except Exception as e:
+        logger.error(f"Ошибка загрузки реестра (чат {chat_id}): {e}")
+        await update.message.reply_text(f"❌ Не удалось загрузить реестр: {str(e)}")
+        return
+    if mirror is None:
+        await update.message.reply_text("📭 Реестр еще не создан - отправь чек или /start")
+        return
+    
+    summary = mirror.summary()
+    if not summary['count'] and not summary['cancelled']:
+        await update.message.reply_text("📭 В реестре пока нет чеков")
+        return
+    
+    def format_day(value):
+        return datetime.strptime(value, '%Y-%m-%d').strftime('%d.%m.%Y') if value else '-'
+    
+    text = (
+        f"📊 Реестр чеков\n\n"
+        f"🧾 Чеков: {summary['count']} на {format_money(summary['total'])}\n"
+        f"📅 В этом месяце: {summary['month_count']} на {format_money(summary['month_total'])}\n"
+        f"🏢 Покупателей (ИНН): {summary['inn_count']}\n"
+        f"🗓 Даты чеков: {format_day(summary['first_date'])} - {format_day(summary['last_date'])}"
+    )
+    if summary['cancelled'] or summary['no_date'] or summary['no_inn']:
+        text += (
+            f"\n\n⚠️ Аннулировано: {summary['cancelled']}, "
+            f"без даты: {summary['no_date']}, без ИНН: {summary['no_inn']}"
+        )
+    await update.message.reply_text(text)
+    
+    statistics = get_statistics()
+    if statistics:
+        statistics.log_action(
+            user_id=chat_id,
+            username=update.effective_user.username,
+            action="/summary",
+            result="успех",
+            details=f"Чеков: {summary['count']}"
+        )
+
+
+async def usage_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Команда /usage - расход OpenAI Vision чата: за текущий месяц и за все время
+    """
+    chat_id = update.effective_chat.id
+    periods = await asyncio.to_thread(state.get_usage, chat_id)
+    if not periods:
+        await update.message.reply_text("📭 Запросов к OpenAI из этого чата еще не было")
+        return
+    
+    month = merge_usage(empty_usage(), periods.get(usage_period(), {}))
+    total = empty_usage()
+    for usage in periods.values():
+        merge_usage(total, usage)
+    
+    text = f"🤖 Расход OpenAI Vision\n\n{format_usage('📅 В этом месяце', month)}"
+    if len(periods) > 1:
+        text += f"\n\n{format_usage(f'🗂 С {min(periods)}', total)}"
+    await update.message.reply_text(text)
+
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Команда /export [csv|xlsx] [год | ДД.ММ.ГГГГ [ДД.ММ.ГГГГ]] [ИНН] - выгрузка реестра файлом
+    """
+    chat_id = update.effective_chat.id
+    try:
+        options = parse_export_args(context.args)
+    except ValueError as e:
+        await update.message.reply_text(
+            f"❓ {e}\n\n"
+            "Использование: /export [csv|xlsx] [год или даты] [ИНН]\n"
+            "Например:\n"
+            "/export 2025\n"
+            "/export csv 01.01.2025 31.03.2025\n"
+            "/export 2025 9705246070"
+        )
+        return
+    
+    try:
+        mirror = await load_registry_mirror(chat_id, update.message.reply_text)
+    except Exception as e:
+        logger.error(f"Ошибка загрузки реестра (чат {chat_id}): {e}")
+        await update.message.reply_text(f"❌ Не удалось загрузить реестр: {str(e)}")
+        return
+    if mirror is None:
+        await update.message.reply_text("📭 Реестр еще не создан - отправь чек или /start")
+        return
+    
+    await update.message.reply_text("⏳ Готовлю выгрузку...")
+    fd, path = tempfile.mkstemp(suffix=FILE_SUFFIXES[options['fmt']])
+    os.close(fd)
+    try:
+        count = await asyncio.to_thread(write_registry_export, mirror, path, **options)
+        if not count:
+            await update.message.reply_text("📭 Подходящих чеков в реестре нет")
+            return
+        if os.path.getsize(path) > TELEGRAM_FILE_LIMIT:
+            await update.message.reply_text(
+                "❌ Файл больше 50 МБ - Telegram не даст его отправить.\n"
+                "Уточни период или ИНН"
+            )
+            return
+        
+        with open(path, 'rb') as f:
+            await context.bot.send_document(
+                chat_id,
+                document=f,
+                filename=export_file_name(**options),
+                caption=f"📤 Выгрузка реестра: {count} чеков",
+                write_timeout=120
+            )
+    except Exception as e:
+        logger.error(f"Ошибка выгрузки реестра (чат {chat_id}): {e}")
+        await update.message.reply_text(f"❌ Ошибка выгрузки: {str(e)}")
+        return
+    finally:
+        os.unlink(path)
+    
+    statistics = get_statistics()
+    if statistics:
+        statistics.log_action(
+            user_id=chat_id,
+            username=update.effective_user.username,
+            action="/export",
+            result="успех",
+            details=f"{options['fmt']}, чеков: {count}"
+        )
+
+
+async def verify_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Команда /verify - проверка статусов всех чеков реестра в ФНС
+    (изменившиеся статусы записываются в таблицу)
+    """
+    chat_id = update.effective_chat.id
+    structure = state.get_user_structure(chat_id)
+    if not structure or not structure.get('user_sheet_id'):
+        await update.message.reply_text("📭 Реестр еще не создан - отправь чек или /start")
+        return
+    
+    await update.message.reply_text("🔎 Проверяю чеки в ФНС...")
+    try:
+        stats = await get_fns_verifier().verify_registry(structure['user_sheet_id'])
+    except Exception as e:
+        logger.error(f"Ошибка проверки чеков в ФНС (чат {chat_id}): {e}")
+        await update.message.reply_text(f"❌ Ошибка проверки: {str(e)}")
+        return
+    
+    await update.message.reply_text(format_verify_result(stats))
+    
+    statistics = get_statistics()
+    if statistics:
+        statistics.log_action(
+            user_id=chat_id,
+            username=update.effective_user.username,
+            action="/verify",
+            result="успех",
+            details=f"Проверено: {stats['rows']}, аннулировано: {stats['cancelled']}, "
+                    f"обновлено: {stats['updated']}"
+        )
+
+
+async def registry_sync_loop():
+    """
+    Фоновая синхронизация локальных копий реестров с таблицами
+    (изменения вручную и чеки, записанные другими воркерами)
+    """
+    while True:
+        for chat_id, structure in state.list_user_structures().items():
+            sheet_id = structure.get('user_sheet_id')
+            if not sheet_id:
+                continue
+            mode = sync_due(sheet_id)
+            if not mode:
+                continue
+            try:
+                await asyncio.to_thread(sync_registry, sheet_id, mode == 'full')
+            except Exception as e:
+                logger.warning(f"Ошибка синхронизации реестра (чат {chat_id}): {e}")
+        await asyncio.sleep(REGISTRY_SYNC_INTERVAL)
+
+
+async def fns_verify_loop():
+    """
+    Фоновая проверка в ФНС недавних и еще не проверенных чеков всех реестров
+    """
+    verifier = get_fns_verifier()
+    while True:
+        for chat_id, structure in state.list_user_structures().items():
+            sheet_id = structure.get('user_sheet_id')
+            if not sheet_id or not await asyncio.to_thread(verify_due, sheet_id):
+                continue
+            try:
+                await verifier.verify_registry(sheet_id, recent_only=True)
+            except Exception as e:
+                logger.warning(f"Ошибка проверки чеков в ФНС (чат {chat_id}): {e}")
+        await asyncio.sleep(FNS_VERIFY_INTERVAL)
+
+
+async def process_single_receipt(chat_id, processor, image_path, reply):
+    """
+    Распознавание одиночного чека (фото/PDF) в слоте планировщика
+    image_path - путь к файлу или байты (фото, скачанное в память)
+    reply - корутина для сообщения о позиции в очереди
+    Запись на Drive и в таблицу - потом, через outbox (save_single_receipt)
+    Расход OpenAI добавляется к учету чата и в data.vision_usage (для статистики)
+    
+    Возвращает (success, data, message_text): data - receipt_model.Receipt
+    """
+    async def notify_queued(position):
+        await reply(f"🕐 Сейчас обрабатываются другие чеки, твой в очереди: {position}")
+    
+    async with scheduler.slot(chat_id, INTERACTIVE, on_queued=notify_queued):
+        with usage_scope() as usage:
+            success, data, message_text = await asyncio.to_thread(processor.process_receipt_image, image_path)
+    
+    vision = usage.as_dict()
+    await asyncio.to_thread(record_chat_usage, state, chat_id, vision)
+    if success:
+        data.vision_usage = vision
+    return success, data, message_text
+
+
+def format_receipt_summary(data, footer):
+    """Сообщение с распознанными данными чека; footer - состояние записи"""
+    error_info = ""
+    if data.error_details:
+        error_info = f"\n\n⚠️ Ошибки распознавания:\n{data.error_details}"
+    
+    return (
+        f"✅ <b>Чек обработан!</b>\n\n"
+        f"👤 {data.full_name}\n"
+        f"💰 {data.amount_text}\n"
+        f"📅 {data.date_text}\n"
+        f"📝 {data.services}\n"
+        f"{footer}"
+        f"{error_info}"
+    )
+
+
+async def save_single_receipt(message, chat_id, username, structure, kind, file_path, data):
+    """
+    Распознанный чек сразу показывается пользователю, а файл и данные
+    ставятся в outbox: запись на Drive и в таблицу идет в фоне и переживает
+    сбои Google и перезапуск бота (сообщение потом обновит on_outbox_result)
+    file_path - путь к файлу или байты файла
+    """
+    reply = await message.reply_text(
+        format_receipt_summary(data, "⏳ Сохраняю на Drive и в таблицу..."), parse_mode='HTML'
+    )
+    entry, created = await asyncio.to_thread(
+        get_upload_outbox().enqueue,
+        chat_id, reply.message_id, username, kind, file_path,
+        structure['user_folder_id'], structure['user_sheet_id'], data
+    )
+    if created:
+        outbox_worker.wake()
+        return
+    
+    # Тот же файл уже присылали в этот чат
+    footer = ("📁 Этот чек уже загружен на Drive и в таблицу" if entry['status'] == OUTBOX_DONE
+              else "⏳ Этот чек уже ждет записи на Drive и в таблицу")
+    await reply.edit_text(format_receipt_summary(data, footer), parse_mode='HTML')
+
+
+async def on_outbox_result(bot, entry, status):
+    """
+    Результат записи чека из outbox: обновляем сообщение с данными чека
+    и статистику (о временной недоступности Google сообщаем один раз)
+    """
+    data = entry['data']
+    if status == 'retry':
+        if entry['attempts'] != 1:
+            return
+        footer = "⚠️ Google временно недоступен - чек сохранен и будет записан автоматически"
+    elif status == OUTBOX_DONE:
+        footer = "📁 Загружено на Drive и в таблицу"
+    else:
+        footer = f"❌ Ошибка сохранения:\n{entry['last_error']}"
+    
+    text = format_receipt_summary(data, footer)
+    if entry['message_id']:
+        await bot.edit_message_text(
+            text, chat_id=entry['chat_id'], message_id=entry['message_id'], parse_mode='HTML'
+        )
+    else:
+        await bot.send_message(entry['chat_id'], text, parse_mode='HTML')
+    
+    if status == 'retry':
+        return
+    
+    success = status == OUTBOX_DONE
+    statistics = get_statistics()
+    if statistics:
+        statistics.update_user_stats(
+            user_id=entry['chat_id'],
+            username=entry['username'],
+            action_type='receipt',
+            success=success
+        )
+        statistics.log_action(
+            user_id=entry['chat_id'],
+            username=entry['username'],
+            action="Обработка PDF" if entry['kind'] == 'pdf' else "Обработка фото",
+            result="успех" if success else "ошибка",
+            details=(f"ФИО: {data.full_name}, Сумма: {data.amount_text}" if success
+                     else entry['last_error'])
+                    + (f", {format_usage_short(data.vision_usage)}" if data.vision_usage else "")
+        )
+
+
+# Фоновая запись одиночных чеков: запускается в on_startup
+outbox_worker = OutboxWorker(on_outbox_result)
+
+
+def pick_photo_size(sizes, min_short_side=PHOTO_MIN_SHORT_SIDE):
+    """
+    Размер фото (PhotoSize) для распознавания: наименьший, которого хватает
+    QR и Vision, - больший размер только дольше скачивается и декодируется
+    sizes - message.photo (Telegram присылает размеры по возрастанию)
+    """
+    sizes = sorted(sizes, key=lambda size: size.width * size.height)
+    for size in sizes:
+        if min(size.width, size.height) >= min_short_side:
+            return size
+    return sizes[-1]
 
 
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -430,7 +1226,7 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     Обработка каждого фото отдельно (без группировки)
     """
     message = update.message
-    photo = message.photo[-1]
+    photo = pick_photo_size(message.photo)
     
     # Инициализируем пользователя
     chat_id = update.effective_chat.id
@@ -443,12 +1239,10 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await message.reply_text("⏳ Обрабатываю чек...")
     
     try:
-        # Скачиваем фото
+        # Скачиваем фото в память: QR, Vision и outbox получают байты, без
+        # промежуточного файла (на диск фото пишется один раз - в outbox)
         photo_file = await photo.get_file()
-        
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as tmp_file:
-            await photo_file.download_to_drive(tmp_file.name)
-            tmp_path = tmp_file.name
+        image_bytes = bytes(await photo_file.download_as_bytearray())
         
         # Создаем процессор с пользовательской структурой
         processor = ReceiptProcessor(
@@ -456,73 +1250,20 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
             user_sheet_id=structure['user_sheet_id']
         )
         
-        # Обрабатываем чек
-        success, data, message_text = processor.process_receipt_image(tmp_path)
+        # Распознаем чек
+        success, data, message_text = await process_single_receipt(
+            chat_id, processor, image_bytes, message.reply_text
+        )
         
         if not success:
             await message.reply_text(
                 f"❌ Ошибка обработки:\n{message_text}\n\n"
                 f"Попробуй отправить более четкое фото."
             )
-            os.unlink(tmp_path)
             return
         
-        # Сразу загружаем без подтверждения
-        upload_success, upload_message = processor.upload_and_save(tmp_path, data)
-        
-        if upload_success:
-            # Обновляем статистику
-            if statistics:
-                statistics.update_user_stats(
-                    user_id=chat_id,
-                    username=username,
-                    action_type='receipt',
-                    success=True
-                )
-                statistics.log_action(
-                    user_id=chat_id,
-                    username=username,
-                    action="Обработка фото",
-                    result="успех",
-                    details=f"ФИО: {data.get('full_name')}, Сумма: {data.get('amount')}"
-                )
-            
-            # Успешно загружено
-            error_info = ""
-            if data.get('error_details'):
-                error_info = f"\n\n⚠️ Ошибки распознавания:\n{data['error_details']}"
-            
-            summary = (
-                f"✅ <b>Чек обработан!</b>\n\n"
-                f"👤 {data.get('full_name')}\n"
-                f"💰 {data.get('amount')}\n"
-                f"📅 {data.get('date')}\n"
-                f"📝 {data.get('services')}\n"
-                f"📁 Загружено на Drive и в таблицу"
-                f"{error_info}"
-            )
-            await message.reply_text(summary, parse_mode='HTML')
-        else:
-            # Логируем ошибку
-            if statistics:
-                statistics.update_user_stats(
-                    user_id=chat_id,
-                    username=username,
-                    action_type='receipt',
-                    success=False
-                )
-                statistics.log_action(
-                    user_id=chat_id,
-                    username=username,
-                    action="Обработка фото",
-                    result="ошибка",
-                    details=upload_message
-                )
-            
-            await message.reply_text(f"❌ Ошибка сохранения:\n{upload_message}")
-        
-        # Удаляем временный файл
-        os.unlink(tmp_path)
+        # Загружаем без подтверждения (фото записывается в outbox)
+        await save_single_receipt(message, chat_id, username, structure, 'photo', image_bytes, data)
         
     except Exception as e:
         logger.error(f"Ошибка обработки фото: {e}")
@@ -553,101 +1294,34 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("⏳ Обрабатываю PDF...")
     
     try:
-        # Скачиваем PDF
+        # Скачиваем PDF (временные файлы удаляются при выходе из области)
         file = await document.get_file()
         
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_file:
-            await file.download_to_drive(tmp_file.name)
-            tmp_path = tmp_file.name
-        
-        # Конвертируем PDF в изображение (первую страницу)
-        from pdf2image import convert_from_path
-        images = convert_from_path(tmp_path, first_page=1, last_page=1)
-        
-        if not images:
-            await update.message.reply_text("❌ Не удалось прочитать PDF")
-            os.unlink(tmp_path)
-            return
-        
-        # Сохраняем как изображение
-        img_path = tmp_path.replace('.pdf', '.jpg')
-        images[0].save(img_path, 'JPEG')
-        
-        # Создаем процессор с пользовательской структурой
-        processor = ReceiptProcessor(
-            user_folder_id=structure['user_folder_id'],
-            user_sheet_id=structure['user_sheet_id']
-        )
-        
-        # Обрабатываем как изображение
-        success, data, message_text = processor.process_receipt_image(img_path)
-        
-        if not success:
-            await update.message.reply_text(
-                f"❌ Ошибка обработки:\n{message_text}"
-            )
-            os.unlink(tmp_path)
-            os.unlink(img_path)
-            return
-        
-        # Удаляем временное изображение
-        os.unlink(img_path)
-        
-        # Загружаем оригинальный PDF
-        upload_success, upload_message = processor.upload_and_save(tmp_path, data)
-        
-        if upload_success:
-            # Обновляем статистику
-            if statistics:
-                statistics.update_user_stats(
-                    user_id=chat_id,
-                    username=username,
-                    action_type='receipt',
-                    success=True
-                )
-                statistics.log_action(
-                    user_id=chat_id,
-                    username=username,
-                    action="Обработка PDF",
-                    result="успех",
-                    details=f"ФИО: {data.get('full_name')}, Сумма: {data.get('amount')}"
-                )
+        with get_scratch_space().scope('pdf') as scratch:
+            tmp_path = scratch.path('.pdf', document.file_size)
+            await file.download_to_drive(tmp_path)
+            # Размер документа Telegram может быть неизвестен - квота по настоящему
+            tmp_path = scratch.settle(tmp_path)
             
-            error_info = ""
-            if data.get('error_details'):
-                error_info = f"\n\n⚠️ Ошибки распознавания:\n{data['error_details']}"
+            # Создаем процессор с пользовательской структурой
+            processor = ReceiptProcessor(
+                user_folder_id=structure['user_folder_id'],
+                user_sheet_id=structure['user_sheet_id']
+            )
             
-            summary = (
-                f"✅ <b>Чек обработан!</b>\n\n"
-                f"👤 {data.get('full_name')}\n"
-                f"💰 {data.get('amount')}\n"
-                f"📅 {data.get('date')}\n"
-                f"📝 {data.get('services')}\n"
-                f"📁 Загружено на Drive и в таблицу"
-                f"{error_info}"
+            # Распознаем первую страницу (рендер PDF в памяти - image_decode)
+            success, data, message_text = await process_single_receipt(
+                chat_id, processor, tmp_path, update.message.reply_text
             )
-            await update.message.reply_text(summary, parse_mode='HTML')
-        else:
-            # Логируем ошибку
-            if statistics:
-                statistics.update_user_stats(
-                    user_id=chat_id,
-                    username=username,
-                    action_type='receipt',
-                    success=False
-                )
-                statistics.log_action(
-                    user_id=chat_id,
-                    username=username,
-                    action="Обработка PDF",
-                    result="ошибка",
-                    details=upload_message
+            
+            if not success:
+                await update.message.reply_text(
+                    f"❌ Ошибка обработки:\n{message_text}"
                 )
+                return
             
-            await update.message.reply_text(f"❌ Ошибка сохранения:\n{upload_message}")
-        
-        # Удаляем временный PDF
-        os.unlink(tmp_path)
+            # Загружаем оригинальный PDF (файл переходит в outbox)
+            await save_single_receipt(update.message, chat_id, username, structure, 'pdf', tmp_path, data)
         
     except Exception as e:
         logger.error(f"Ошибка обработки PDF: {e}")
@@ -690,9 +1364,101 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 
+def register_handlers(application):
+    """
+    Регистрация обработчиков бота
+    (используется в main() и в нагрузочном тесте benchmarks/load_test.py)
+    """
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("full_analyze", full_analyze))
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("status", status_command))
+    application.add_handler(CommandHandler("cancel", cancel_command))
+    application.add_handler(CommandHandler("report", report_command))
+    application.add_handler(CommandHandler("summary", summary_command))
+    application.add_handler(CommandHandler("export", export_command))
+    application.add_handler(CommandHandler("usage", usage_command))
+    application.add_handler(CommandHandler("verify", verify_command))
+    application.add_handler(CallbackQueryHandler(button_callback))
+    application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
+    application.add_handler(MessageHandler(filters.Document.ALL, handle_document))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
+
+
+def get_webhook_config():
+    """
+    Настройки webhook-режима из .env (BOT_MODE=webhook)
+    Возвращает словарь параметров для application.run_webhook или None при ошибке
+    """
+    base_url = os.getenv('WEBHOOK_URL')
+    secret_token = os.getenv('WEBHOOK_SECRET_TOKEN')
+    url_path = os.getenv('WEBHOOK_PATH', 'telegram').strip('/')
+    
+    if not base_url:
+        logger.error("WEBHOOK_URL не найден в .env")
+        return None
+    
+    # Telegram присылает секрет в заголовке X-Telegram-Bot-Api-Secret-Token,
+    # запросы без него (или с другим значением) сервер отклоняет с 403
+    if not secret_token or not re.fullmatch(r'[A-Za-z0-9_-]{1,256}', secret_token):
+        logger.error("WEBHOOK_SECRET_TOKEN не задан или некорректен (1-256 символов: A-Z, a-z, 0-9, _, -)")
+        return None
+    
+    return {
+        'listen': os.getenv('WEBHOOK_LISTEN', '0.0.0.0'),
+        'port': int(os.getenv('WEBHOOK_PORT', '8443')),
+        'url_path': url_path,
+        'webhook_url': f"{base_url.rstrip('/')}/{url_path}",
+        'secret_token': secret_token,
+        'max_connections': int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40')),
+    }
+
+
+async def on_startup(application):
+    """
+    Вызывается после инициализации приложения: запуск воркеров анализа
+    (они же подхватывают задачи, не завершенные до перезапуска) и фоновая
+    инициализация клиентов Google - бот уже принимает обновления.
+    Перед запуском воркеров удаляются временные файлы прошлых запусков.
+    Запускаются запись чеков из outbox (в том числе не записанных до перезапуска)
+    и синхронизация копий реестров (REGISTRY_SYNC_INTERVAL=0 - отключена),
+    фоновая проверка чеков в ФНС (FNS_VERIFY_INTERVAL=0 - отключена)
+    и опрос изменений Drive для папок анализа (DRIVE_INGEST_INTERVAL=0 - отключен)
+    """
+    global _warm_up_task, _registry_sync_task, _fns_verify_task
+    _warm_up_task = asyncio.create_task(asyncio.to_thread(warm_up_clients))
+    # Временные файлы упавших процессов - до первой задачи и первого чека
+    await asyncio.to_thread(get_scratch_space().reclaim_orphans)
+    await analysis_queue.start(application.bot)
+    await outbox_worker.start(application.bot)
+    if REGISTRY_SYNC_INTERVAL > 0:
+        _registry_sync_task = asyncio.create_task(registry_sync_loop())
+    if FNS_VERIFY_INTERVAL > 0:
+        _fns_verify_task = asyncio.create_task(fns_verify_loop())
+    if ingest_enabled():
+        await drive_ingest.start(application.bot)
+
+
+async def on_stop(application):
+    """
+    Вызывается после остановки приложения: к этому моменту сервер уже не принимает
+    новые обновления, а все полученные обработаны (application.stop() дожидается очереди).
+    Незавершенные задачи анализа и чеки outbox возвращаются в очередь
+    """
+    if _registry_sync_task:
+        _registry_sync_task.cancel()
+    if _fns_verify_task:
+        _fns_verify_task.cancel()
+    await drive_ingest.stop()
+    await analysis_queue.stop()
+    await outbox_worker.stop()
+    logger.info("🛑 Бот остановлен, все полученные обновления обработаны")
+
+
 def main():
     """
     Запуск бота
+    Режим выбирается через BOT_MODE: polling (по умолчанию) или webhook
     """
     # Получаем токен из .env
     token = os.getenv('TELEGRAM_BOT_TOKEN')
@@ -701,21 +1467,45 @@ def main():
         logger.error("TELEGRAM_BOT_TOKEN не найден в .env")
         return
     
+    mode = os.getenv('BOT_MODE', 'polling').lower()
+    if mode not in ('polling', 'webhook'):
+        logger.error(f"Неизвестный BOT_MODE: {mode} (ожидается polling или webhook)")
+        return
+    
     # Создаем приложение
-    application = Application.builder().token(token).build()
+    application = (
+        Application.builder()
+        .token(token)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .build()
+    )
     
     # Регистрируем обработчики
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("full_analyze", full_analyze))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CallbackQueryHandler(button_callback))
-    application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
-    application.add_handler(MessageHandler(filters.Document.ALL, handle_document))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
+    register_handlers(application)
     
     # Запускаем бота
-    logger.info("🤖 Бот запущен!")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if mode == 'webhook':
+        webhook_config = get_webhook_config()
+        if not webhook_config:
+            return
+        
+        logger.info(
+            f"🤖 Бот запущен в режиме webhook: {webhook_config['listen']}:{webhook_config['port']}"
+            f"/{webhook_config['url_path']}"
+        )
+        # По SIGINT/SIGTERM сначала останавливается HTTP-сервер (новые обновления
+        # не принимаются), затем дообрабатываются уже полученные. Вебхук в Telegram
+        # не удаляется: остальные экземпляры за балансировщиком продолжают работу
+        application.run_webhook(
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=False,
+            **webhook_config
+        )
+    else:
+        logger.info("🤖 Бот запущен!")
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == '__main__':
@@ -1,17 +1,25 @@
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
-from google_auth import get_google_credentials
+from google_transport import build_service
 import os
 from datetime import datetime
 
+# Типы файлов папки анализа, которые бот обрабатывает (изображения и PDF)
+ANALYSIS_MIME_TYPES = (
+    'image/jpeg',
+    'image/png',
+    'image/jpg',
+    'application/pdf',
+    'image/heic',  # iPhone фото
+    'image/heif',  # iPhone фото
+    'image/webp'   # Веб-формат
+)
+
 class DriveHandler:
     def __init__(self, root_folder_id):
         """
         Инициализация handler для Google Drive
         root_folder_id - ID корневой папки проекта (или папки пользователя)
         """
-        creds = get_google_credentials()
-        self.service = build('drive', 'v3', credentials=creds)
+        self.service = build_service('drive', 'v3')
         self.root_folder_id = root_folder_id
     
     def get_or_create_folder(self, folder_name, parent_id):
@@ -37,15 +45,20 @@ class DriveHandler:
         folder = self.service.files().create(body=folder_metadata, fields='id').execute()
         return folder.get('id')
     
-    def upload_file(self, file_path, buyer_inn, receipt_date, full_name):
+    def upload_file(self, file_path, buyer_inn, receipt_date, full_name, upload_key=None,
+                    check_existing=False):
         """
         Загрузка файла на Drive с правильной структурой
         ВНИМАНИЕ: root_folder_id теперь это папка пользователя!
         
-        file_path - путь к локальному файлу
+        file_path - путь к локальному файлу или байты файла (фото, скачанное
+        в память): расширение и тип файла - по содержимому
         buyer_inn - ИНН покупателя
         receipt_date - дата чека (объект datetime)
         full_name - ФИО в формате "Фамилия И.О."
+        upload_key - ключ идемпотентности (сохраняется в appProperties файла)
+        check_existing - сначала искать файл с тем же upload_key (прошлая
+        попытка могла загрузить файл, но ответ не дошел)
         
         Структура внутри папки пользователя:
         Папка пользователя (@username)
@@ -60,20 +73,38 @@ class DriveHandler:
         
         # Формируем название файла: Фамилия И.О. дата
         date_str = receipt_date.strftime("%d.%m.%Y")
-        file_extension = os.path.splitext(file_path)[1]
+        in_memory = isinstance(file_path, (bytes, bytearray))
+        if in_memory:
+            from image_decode import media_type
+            file_extension, mimetype = media_type(file_path)
+        else:
+            file_extension = os.path.splitext(file_path)[1]
         new_filename = f"{full_name} {date_str}{file_extension}"
         
-        # Загружаем файл
-        file_metadata = {
-            'name': new_filename,
-            'parents': [month_folder_id]
-        }
-        media = MediaFileUpload(file_path, resumable=True)
-        file = self.service.files().create(
-            body=file_metadata,
-            media_body=media,
-            fields='id, webViewLink'
-        ).execute()
+        file = None
+        if upload_key and check_existing:
+            file = self.find_uploaded_file(upload_key, month_folder_id)
+        
+        if file is None:
+            # Загружаем файл
+            file_metadata = {
+                'name': new_filename,
+                'parents': [month_folder_id]
+            }
+            if upload_key:
+                file_metadata['appProperties'] = {'upload_key': upload_key}
+            if in_memory:
+                import io
+                from googleapiclient.http import MediaIoBaseUpload
+                media = MediaIoBaseUpload(io.BytesIO(file_path), mimetype=mimetype, resumable=True)
+            else:
+                from googleapiclient.http import MediaFileUpload
+                media = MediaFileUpload(file_path, resumable=True)
+            file = self.service.files().create(
+                body=file_metadata,
+                media_body=media,
+                fields='id, webViewLink'
+            ).execute()
         
         return {
             'file_id': file.get('id'),
@@ -82,6 +113,16 @@ class DriveHandler:
             'folder_path': f"{buyer_inn}/{month_folder_name}"
         }
     
+    def find_uploaded_file(self, upload_key, folder_id):
+        """
+        Файл, загруженный с ключом upload_key в папку folder_id, или None
+        """
+        query = (f"'{folder_id}' in parents and trashed=false and "
+                 f"appProperties has {{ key='upload_key' and value='{upload_key}' }}")
+        results = self.service.files().list(q=query, fields="files(id, webViewLink)").execute()
+        files = results.get('files', [])
+        return files[0] if files else None
+    
     def create_analysis_folder(self, folder_name):
         """
         Создание папки для массового анализа ВНУТРИ папки пользователя
@@ -103,7 +144,7 @@ class DriveHandler:
     def list_files_in_folder(self, folder_id):
         """
         Получение списка всех файлов из папки
-        Возвращает список файлов: [{'id': '...', 'name': '...', 'mimeType': '...'}, ...]
+        Возвращает список файлов: [{'id': '...', 'name': '...', 'mimeType': '...', 'size': '...'}, ...]
         """
         import logging
         logger = logging.getLogger(__name__)
@@ -111,7 +152,7 @@ class DriveHandler:
         query = f"'{folder_id}' in parents and trashed=false and mimeType != 'application/vnd.google-apps.folder'"
         results = self.service.files().list(
             q=query,
-            fields="files(id, name, mimeType)",
+            fields="files(id, name, mimeType, size)",
             pageSize=1000
         ).execute()
         
@@ -122,17 +163,7 @@ class DriveHandler:
             logger.info(f"Файл: {f['name']}, тип: {f['mimeType']}")
         
         # Фильтруем только изображения и PDF (расширенный список)
-        allowed_types = [
-            'image/jpeg',
-            'image/png', 
-            'image/jpg',
-            'application/pdf',
-            'image/heic',  # iPhone фото
-            'image/heif',  # iPhone фото
-            'image/webp'   # Веб-формат
-        ]
-        
-        filtered = [f for f in files if f['mimeType'] in allowed_types]
+        filtered = [f for f in files if f['mimeType'] in ANALYSIS_MIME_TYPES]
         
         logger.info(f"Файлов после фильтрации: {len(filtered)}")
         
@@ -0,0 +1,328 @@
+"""
+Автоматическая обработка чеков, загруженных в папки анализа (/full_analyze)
+
+Раньше файлы папки обрабатывались только после кнопки «Начать анализ»:
+задача перечисляла всю папку и обрабатывала файлы разом. Здесь бот следит
+за лентой изменений Drive (changes.list) и обрабатывает новый файл в
+отслеживаемой папке через несколько секунд после загрузки:
+
+- Раз в DRIVE_INGEST_INTERVAL секунд читаются только изменения с прошлого
+  опроса: позиция в ленте (page token) хранится в StateBackend и переживает
+  перезапуск; папки заново не перечисляются
+- Отслеживаются папки, созданные /full_analyze, в течение
+  DRIVE_INGEST_WATCH_HOURS часов - пока по папке не запущен анализ кнопкой
+- Обработанный файл отмечается в том же индексе, что и у задачи анализа
+  (analysis:<папка>), поэтому кнопка «Начать анализ» его пропускает
+  и только дообрабатывает остальное и присылает итог
+- Файл, который сейчас обрабатывается, захвачен (StateBackend.acquire_job):
+  задача анализа ждет его, а не обрабатывает второй раз
+- Ленту опрашивает один процесс из нескольких (владение DRIVE_INGEST_LEADER
+  продлевается каждым опросом и переходит к другому процессу, если этот упал)
+
+Файл, который не удалось обработать автоматически (ошибка, остановка бота),
+обработает задача анализа после нажатия кнопки.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+
+from dotenv import load_dotenv
+
+from drive_handler import ANALYSIS_MIME_TYPES
+from state_backend import get_state_backend, ACTIVE_JOB_STATUSES, WORKER_ID
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Период опроса ленты изменений Drive, секунд (0 - автоматическая обработка отключена)
+DRIVE_INGEST_INTERVAL = float(os.getenv('DRIVE_INGEST_INTERVAL', '5'))
+# Сколько часов после /full_analyze папка отслеживается
+DRIVE_INGEST_WATCH_HOURS = float(os.getenv('DRIVE_INGEST_WATCH_HOURS', '72'))
+# Изменений на страницу changes.list (не больше 1000)
+DRIVE_INGEST_PAGE_SIZE = int(os.getenv('DRIVE_INGEST_PAGE_SIZE', '1000'))
+# Срок захвата файла на время обработки (если процесс упал - файл снова свободен)
+DRIVE_INGEST_CLAIM_TTL = int(os.getenv('DRIVE_INGEST_CLAIM_TTL', '600'))
+# Сколько ждать обработки текущих файлов при остановке бота
+DRIVE_INGEST_SHUTDOWN_TIMEOUT = float(os.getenv('DRIVE_INGEST_SHUTDOWN_TIMEOUT', '30'))
+
+# Ключ владения опросом ленты (один процесс опрашивает, остальные ждут)
+DRIVE_INGEST_LEADER = 'drive_ingest'
+
+CHANGES_FIELDS = (
+    'nextPageToken,newStartPageToken,'
+    'changes(fileId,removed,file(id,name,mimeType,size,parents,trashed))'
+)
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+
+def ingest_enabled():
+    return DRIVE_INGEST_INTERVAL > 0
+
+
+def watch_until():
+    """До какого времени (unix) отслеживать новую папку анализа; None - не отслеживать"""
+    if not ingest_enabled():
+        return None
+    return time.time() + DRIVE_INGEST_WATCH_HOURS * 3600
+
+
+def processed_namespace(folder_id):
+    """Индекс обработанных файлов папки (общий с задачей анализа)"""
+    return f"analysis:{folder_id}"
+
+
+def file_claim_key(file_id):
+    return f"drive_file:{file_id}"
+
+
+@asynccontextmanager
+async def claim(state, key, owner, wait=True, ttl=DRIVE_INGEST_CLAIM_TTL, poll_interval=0.5):
+    """
+    Захват ключа на время блока (между процессами - через StateBackend.acquire_job)
+    wait=True - ждать, пока ключ освободится; wait=False - сразу вернуть False
+    Возвращает True, если ключ захвачен
+    """
+    while not state.acquire_job(key, owner, ttl):
+        if not wait:
+            yield False
+            return
+        await asyncio.sleep(poll_interval)
+    try:
+        yield True
+    finally:
+        state.release_job(key, owner)
+
+
+def new_analysis_files(changes, folders):
+    """
+    Новые и измененные файлы из изменений ленты, лежащие в папках folders
+    Возвращает {folder_id: [файлы]} (файл - как в DriveHandler.list_files_in_folder)
+    """
+    found = {}
+    seen = set()
+    for change in changes:
+        f = change.get('file')
+        if change.get('removed') or not f or f.get('trashed'):
+            continue
+        if f.get('mimeType') == FOLDER_MIME_TYPE or f['mimeType'] not in ANALYSIS_MIME_TYPES:
+            continue
+        if f['id'] in seen:
+            continue
+        for parent in f.get('parents', []):
+            if parent in folders:
+                seen.add(f['id'])
+                found.setdefault(parent, []).append({
+                    'id': f['id'], 'name': f.get('name', f['id']),
+                    'mimeType': f['mimeType'], 'size': f.get('size'),
+                })
+                break
+    return found
+
+
+class DriveIngest:
+    """
+    Опрос ленты изменений Drive и обработка новых файлов папок анализа
+
+    handler - корутина handler(chat_id, folder_info, file), обрабатывающая
+    один файл и возвращающая (success, message); успешно обработанный файл
+    отмечается в индексе папки здесь
+    """
+
+    def __init__(self, handler, state=None, interval=DRIVE_INGEST_INTERVAL,
+                 page_size=DRIVE_INGEST_PAGE_SIZE):
+        self.handler = handler
+        self.state = state or get_state_backend()
+        self.interval = interval
+        self.page_size = page_size
+        # Отдельный владелец: задача анализа в том же процессе не должна
+        # считать захваченный здесь файл своим
+        self.owner = f"{WORKER_ID}:ingest"
+        self.leader_ttl = max(30, int(interval * 6))
+        self.stats = Counter()
+        self.bot = None
+        self._service = None
+        self._task = None
+        self._batches = set()
+
+    @property
+    def service(self):
+        if self._service is None:
+            from google_transport import build_service
+            self._service = build_service('drive', 'v3')
+        return self._service
+
+    async def start(self, bot):
+        """Запуск опроса (вызывается из on_startup)"""
+        self.bot = bot
+        self._task = asyncio.create_task(self._loop())
+        logger.info(f"Автоматическая обработка папок анализа: опрос Drive каждые {self.interval:g} с")
+
+    async def stop(self):
+        """
+        Остановка опроса: текущие файлы дорабатываются (не дольше
+        DRIVE_INGEST_SHUTDOWN_TIMEOUT), остальные обработает задача анализа
+        """
+        if not self._task:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        if self._batches:
+            _, pending = await asyncio.wait(self._batches, timeout=DRIVE_INGEST_SHUTDOWN_TIMEOUT)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        self.state.release_job(DRIVE_INGEST_LEADER, self.owner)
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.poll_once()
+            except Exception as e:
+                logger.warning(f"Ошибка опроса изменений Drive: {e}")
+            await asyncio.sleep(self.interval)
+
+    def watched_folders(self):
+        """
+        Отслеживаемые папки: {folder_id: (chat_id, folder_info)}
+        Папка с задачей анализа в очереди или в работе больше не отслеживается
+        """
+        now = time.time()
+        folders = {}
+        for chat_id, info in self.state.list_analysis_folders().items():
+            if (info.get('watch_until') or 0) < now:
+                continue
+            busy = any(
+                job.get('dedupe_key') == processed_namespace(info['folder_id'])
+                for job in self.state.list_jobs(chat_id=chat_id, statuses=ACTIVE_JOB_STATUSES)
+            )
+            if not busy:
+                folders[info['folder_id']] = (chat_id, info)
+        return folders
+
+    def fetch_changes(self, token):
+        """
+        Изменения ленты с позиции token (все страницы)
+        Возвращает (изменения, новая позиция)
+        """
+        changes = []
+        while True:
+            result = self.service.changes().list(
+                pageToken=token,
+                pageSize=self.page_size,
+                spaces='drive',
+                includeRemoved=False,
+                fields=CHANGES_FIELDS
+            ).execute()
+            changes.extend(result.get('changes', []))
+            if 'nextPageToken' in result:
+                token = result['nextPageToken']
+                continue
+            return changes, result.get('newStartPageToken', token)
+
+    def _start_token(self):
+        return self.service.changes().getStartPageToken().execute()['startPageToken']
+
+    async def poll_once(self):
+        """
+        Один опрос ленты: новые файлы отслеживаемых папок отдаются на обработку
+        Возвращает число файлов, отданных на обработку (None - опрашивает другой процесс)
+        """
+        if not self.state.acquire_job(DRIVE_INGEST_LEADER, self.owner, self.leader_ttl):
+            return None
+
+        token = self.state.get_drive_page_token()
+        if token is None:
+            # Первый запуск: изменения отслеживаются с текущего момента
+            token = await asyncio.to_thread(self._start_token)
+            self.state.set_drive_page_token(token)
+            return 0
+
+        try:
+            changes, new_token = await asyncio.to_thread(self.fetch_changes, token)
+        except Exception as e:
+            status = getattr(getattr(e, 'resp', None), 'status', None)
+            if status in (400, 404):
+                # Позиция устарела или недействительна - начинаем с текущего момента
+                logger.warning(f"Позиция в ленте изменений Drive недействительна: {e}")
+                self.state.set_drive_page_token(None)
+                return 0
+            raise
+        self.stats['polls'] += 1
+        self.stats['changes'] += len(changes)
+
+        count = 0
+        if changes:
+            folders = self.watched_folders()
+            for folder_id, files in new_analysis_files(changes, folders).items():
+                chat_id, folder_info = folders[folder_id]
+                task = asyncio.create_task(self._ingest_folder(chat_id, folder_info, files))
+                self._batches.add(task)
+                task.add_done_callback(self._batches.discard)
+                count += len(files)
+
+        # Позиция сдвигается, как только файлы отданы на обработку: то, что
+        # не обработается (ошибка, остановка), дообработает задача анализа
+        if new_token != token:
+            self.state.set_drive_page_token(new_token)
+        return count
+
+    async def _ingest_folder(self, chat_id, folder_info, files):
+        """Обработка новых файлов одной папки и одно сообщение об итогах"""
+        results = await asyncio.gather(
+            *(self._ingest_file(chat_id, folder_info, f) for f in files),
+            return_exceptions=True
+        )
+        done = []
+        for f, result in zip(files, results):
+            if isinstance(result, asyncio.CancelledError):
+                continue
+            if isinstance(result, BaseException):
+                logger.error(f"Ошибка автоматической обработки {f['name']}: {result}")
+                result = (False, str(result))
+            if result is not None:
+                done.append((f['name'], *result))
+
+        if done and self.bot:
+            try:
+                await self.bot.send_message(chat_id, format_ingest_result(folder_info['folder_name'], done))
+            except Exception as e:
+                logger.error(f"Не удалось отправить сообщение в чат {chat_id}: {e}")
+
+    async def _ingest_file(self, chat_id, folder_info, file):
+        """
+        Обработка одного файла, если он еще не обработан и не захвачен
+        Возвращает (success, message) или None - файл пропущен
+        """
+        namespace = processed_namespace(folder_info['folder_id'])
+        async with claim(self.state, file_claim_key(file['id']), self.owner, wait=False) as claimed:
+            if not claimed or self.state.is_processed(namespace, file['id']):
+                self.stats['skipped'] += 1
+                return None
+
+            logger.info(f"Новый файл в папке «{folder_info['folder_name']}»: {file['name']}")
+            success, message = await self.handler(chat_id, folder_info, file)
+            if success:
+                self.state.mark_processed(namespace, file['id'])
+            self.stats['processed' if success else 'errors'] += 1
+            return success, message
+
+
+def format_ingest_result(folder_name, done):
+    """
+    Сообщение о файлах, обработанных автоматически
+    done - [(имя файла, success, message)]
+    """
+    success = sum(1 for _, ok, _ in done if ok)
+    lines = [f"📥 Новые чеки в папке «{folder_name}»: обработано {len(done)} (✅ {success}, ❌ {len(done) - success})"]
+    errors = [(name, message) for name, ok, message in done if not ok]
+    for name, message in errors[:5]:
+        lines.append(f"• {name}: {message}")
+    if len(errors) > 5:
+        lines.append(f"... и еще {len(errors) - 5} ошибок")
+    lines.append("\nКогда загрузишь все чеки - нажми «Начать анализ» для итога")
+    return '\n'.join(lines)
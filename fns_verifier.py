@@ -0,0 +1,332 @@
+"""
+Проверка статуса чеков реестра в ФНС («Мой налог»)
+
+Статус в реестре («Действителен») берется с изображения чека, а чек могут
+аннулировать и после того, как его прислали. Верификатор проверяет чеки
+по ссылке ФНС из QR (колонка «Ссылка ФНС»): ответ lknpd.nalog.ru на
+/receipt/{ИНН}/{ID}/json с cancellationInfo - чек аннулирован,
+404 - такого чека в ФНС нет.
+
+- Запросы идут параллельно, не больше FNS_VERIFY_CONCURRENCY одновременно,
+  по keep-alive соединениям одного клиента httpx
+- Ответы ФНС хранятся в StateBackend (общем для воркеров): FNS_VERIFY_CACHE_TTL
+  часов чек не запрашивается заново, затем запрос условный (If-None-Match /
+  If-Modified-Since) - ответ 304 подтверждает прежний статус без тела.
+  Аннулирование окончательно: аннулированный чек больше не запрашивается
+- Изменившиеся статусы записываются в колонку «Статус» пачками по
+  FNS_VERIFY_BATCH_ROWS строк (SheetsHandler.update_statuses) и в локальную
+  копию реестра
+- Фоновая проверка раз в FNS_VERIFY_INTERVAL секунд берет только недавние
+  чеки (не старше FNS_VERIFY_RECENT_DAYS дней) и еще не проверенные;
+  /verify проверяет весь реестр
+
+FNS_API_URL можно направить на локальный заменитель (benchmarks/fakes.py: FakeFnsServer).
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import date, timedelta
+
+from dotenv import load_dotenv
+
+from qr_parser import parse_fns_url
+from registry_mirror import CANCELLED_STATUS, get_mirror, get_registry_view, sync_registry
+from registry_shards import shard_key
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+FNS_API_URL = os.getenv('FNS_API_URL', 'https://lknpd.nalog.ru/api/v1').rstrip('/')
+# Одновременных запросов к ФНС
+FNS_VERIFY_CONCURRENCY = int(os.getenv('FNS_VERIFY_CONCURRENCY', '8'))
+FNS_VERIFY_TIMEOUT = float(os.getenv('FNS_VERIFY_TIMEOUT', '15'))
+# Повторов при сетевой ошибке, 429 и 5xx (пауза 1, 2, 4... секунды)
+FNS_VERIFY_RETRIES = int(os.getenv('FNS_VERIFY_RETRIES', '2'))
+# Сколько часов ответ ФНС считается актуальным без повторного запроса
+FNS_VERIFY_CACHE_TTL = float(os.getenv('FNS_VERIFY_CACHE_TTL', '24'))
+# Фоновая проверка: период в секундах (0 - отключена) и какие чеки считать недавними
+FNS_VERIFY_INTERVAL = int(os.getenv('FNS_VERIFY_INTERVAL', '21600'))
+FNS_VERIFY_RECENT_DAYS = int(os.getenv('FNS_VERIFY_RECENT_DAYS', '45'))
+# Строк в одном batchUpdate колонки «Статус»
+FNS_VERIFY_BATCH_ROWS = int(os.getenv('FNS_VERIFY_BATCH_ROWS', '500'))
+
+VALID_STATUS = 'Действителен'
+NOT_FOUND_STATUS = 'Не найден в ФНС'
+
+# Ответы, после которых запрос стоит повторить
+RETRY_HTTP_STATUSES = (429, 500, 502, 503, 504)
+
+
+def receipt_key(fns_url):
+    """Ключ чека 'ИНН/ID' по ссылке ФНС или None (ссылки нет или она не из QR чека)"""
+    parsed = parse_fns_url(fns_url) if fns_url else None
+    return f"{parsed['seller_inn']}/{parsed['receipt_id']}" if parsed else None
+
+
+def verify_due(sheet_id, now=None):
+    """Пора ли фоновой проверке (учитывается проверка любым воркером)"""
+    now = now or time.time()
+    return now - get_mirror(sheet_id).read_meta().get('fns_verify', 0) >= FNS_VERIFY_INTERVAL
+
+
+class FnsVerifier:
+    """
+    Проверка чеков реестра в ФНС
+
+    Использование:
+        verifier = get_fns_verifier()
+        stats = await verifier.verify_registry(sheet_id)
+        stats = await verifier.verify_registry(sheet_id, recent_only=True)
+    """
+
+    def __init__(self, state=None, base_url=FNS_API_URL, concurrency=FNS_VERIFY_CONCURRENCY,
+                 cache_ttl=FNS_VERIFY_CACHE_TTL * 3600, timeout=FNS_VERIFY_TIMEOUT,
+                 retries=FNS_VERIFY_RETRIES):
+        if state is None:
+            from state_backend import get_state_backend
+            state = get_state_backend()
+        self.state = state
+        self.base_url = base_url.rstrip('/')
+        self.concurrency = max(1, concurrency)
+        self.cache_ttl = cache_ttl
+        self.timeout = timeout
+        self.retries = retries
+
+    def is_fresh(self, check, now):
+        """Можно ли взять статус из кэша без запроса"""
+        return check['status'] == CANCELLED_STATUS or now - check['checked_at'] < self.cache_ttl
+
+    # --- запросы к ФНС ---
+
+    async def fetch(self, client, key, previous=None):
+        """
+        Запрос статуса одного чека; previous - прошлая проверка (условный запрос)
+        Возвращает (проверка, исход): исход fetched, not_modified или error
+        (при error проверка - None)
+        """
+        import httpx
+
+        inn, receipt_id = key.split('/')
+        headers = {}
+        if previous and previous.get('etag'):
+            headers['If-None-Match'] = previous['etag']
+        if previous and previous.get('last_modified'):
+            headers['If-Modified-Since'] = previous['last_modified']
+
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(2 ** (attempt - 1))
+            try:
+                response = await client.get(f"{self.base_url}/receipt/{inn}/{receipt_id}/json",
+                                            headers=headers)
+            except httpx.HTTPError as e:
+                error = f"{type(e).__name__}: {e}"
+                continue
+
+            if response.status_code == 304 and previous:
+                return dict(previous, checked_at=time.time()), 'not_modified'
+            if response.status_code == 404:
+                return {'status': NOT_FOUND_STATUS, 'checked_at': time.time()}, 'fetched'
+            if response.status_code == 200:
+                try:
+                    cancelled = bool(response.json().get('cancellationInfo'))
+                except ValueError:
+                    error = "ответ ФНС - не JSON"
+                    break
+                return {
+                    'status': CANCELLED_STATUS if cancelled else VALID_STATUS,
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                    'checked_at': time.time(),
+                }, 'fetched'
+
+            error = f"HTTP {response.status_code}"
+            if response.status_code not in RETRY_HTTP_STATUSES:
+                break
+
+        logger.warning(f"ФНС: чек {key} не проверен: {error}")
+        return None, 'error'
+
+    def _cached_checks(self, keys, now):
+        """(свежие проверки из кэша, [(ключ, прошлая проверка)] для запроса)"""
+        fresh, pending = {}, []
+        for key in keys:
+            previous = self.state.get_receipt_check(key)
+            if previous and self.is_fresh(previous, now):
+                fresh[key] = previous
+            else:
+                pending.append((key, previous))
+        return fresh, pending
+
+    def _save_checks(self, checks):
+        for key, check in checks.items():
+            self.state.set_receipt_check(key, check)
+
+    async def check_receipts(self, keys):
+        """
+        Статусы чеков по ключам receipt_key
+        Возвращает ({ключ: проверка}, счетчики cached/fetched/not_modified/error);
+        чеки, которые не удалось проверить, в результат не входят
+        """
+        import httpx
+
+        checks, pending = await asyncio.to_thread(self._cached_checks, keys, time.time())
+        stats = Counter(cached=len(checks))
+        if not pending:
+            return checks, stats
+
+        fetched = {}
+        limits = httpx.Limits(max_connections=self.concurrency,
+                              max_keepalive_connections=self.concurrency)
+        async with httpx.AsyncClient(timeout=self.timeout, limits=limits) as client:
+            items = iter(pending)
+
+            async def worker():
+                for key, previous in items:
+                    check, outcome = await self.fetch(client, key, previous)
+                    stats[outcome] += 1
+                    if check:
+                        fetched[key] = check
+
+            await asyncio.gather(*(worker() for _ in range(min(self.concurrency, len(pending)))))
+
+        await asyncio.to_thread(self._save_checks, fetched)
+        checks.update(fetched)
+        return checks, stats
+
+    # --- реестр ---
+
+    def collect_rows(self, sheet_id, recent_only=False, today=None):
+        """
+        Строки реестра для проверки: [{'shard', 'record', 'key'}] и счетчики
+        (no_url - строки без ссылки ФНС). Аннулированные чеки не проверяются;
+        recent_only - только чеки не старше FNS_VERIFY_RECENT_DAYS и еще не проверенные
+        """
+        cutoff = ((today or date.today()) - timedelta(days=FNS_VERIFY_RECENT_DAYS)).isoformat()
+        rows, stats = [], Counter()
+        for mirror in get_registry_view(sheet_id).mirrors:
+            for record in mirror.iter_records():
+                if record['status'] == CANCELLED_STATUS:
+                    continue
+                key = receipt_key(record['fns_url'])
+                if key is None:
+                    stats['no_url'] += 1
+                    continue
+                recent = record['date'] is not None and record['date'] >= cutoff
+                if recent_only and not recent and self.state.get_receipt_check(key) is not None:
+                    continue
+                rows.append({'shard': mirror.sheet_id, 'record': record, 'key': key})
+        return rows, stats
+
+    def write_statuses(self, sheet_id, changes):
+        """
+        Запись изменившихся статусов в таблицу и копию реестра
+        changes - [(строка collect_rows, новый статус)]
+        Возвращает число записанных строк
+        """
+        from sheets_handler import SheetsHandler
+
+        sheets = SheetsHandler(sheet_id)
+        tabs = {shard_key(sheet_id, period): tab for period, tab in sheets.data_tabs()}
+        written = 0
+        for start in range(0, len(changes), FNS_VERIFY_BATCH_ROWS):
+            batch = [(row, status) for row, status in changes[start:start + FNS_VERIFY_BATCH_ROWS]
+                     if row['shard'] in tabs]
+            updates = [(tabs[row['shard']], row['record']['row'], row['record']['fns_url'], status)
+                       for row, status in batch]
+            matched = set(sheets.update_statuses(updates))
+
+            records = defaultdict(list)
+            for (row, status), update in zip(batch, updates):
+                if update in matched:
+                    records[row['shard']].append(dict(row['record'], status=status))
+            for shard, shard_records in records.items():
+                get_mirror(shard).append(shard_records)
+            written += len(matched)
+        return written
+
+    async def verify_registry(self, sheet_id, recent_only=False, today=None):
+        """
+        Проверка чеков реестра и запись изменившихся статусов
+        Перед проверкой копия реестра дочитывается из таблицы
+        Возвращает счетчики: rows (проверено строк), valid/cancelled/not_found,
+        updated (статус изменен), skipped (строку успели изменить вручную),
+        no_url, cached/fetched/not_modified/error (ответы ФНС)
+        """
+        started = time.monotonic()
+        await asyncio.to_thread(sync_registry, sheet_id)
+        rows, stats = await asyncio.to_thread(self.collect_rows, sheet_id, recent_only, today)
+        checks, check_stats = await self.check_receipts({row['key'] for row in rows})
+        stats.update(check_stats)
+
+        changes = []
+        for row in rows:
+            check = checks.get(row['key'])
+            if check is None:
+                continue
+            stats['rows'] += 1
+            stats[{VALID_STATUS: 'valid', CANCELLED_STATUS: 'cancelled'}.get(check['status'], 'not_found')] += 1
+            if check['status'] != row['record']['status']:
+                changes.append((row, check['status']))
+
+        if changes:
+            stats['updated'] = await asyncio.to_thread(self.write_statuses, sheet_id, changes)
+            stats['skipped'] = len(changes) - stats['updated']
+        await asyncio.to_thread(get_mirror(sheet_id).write_meta, fns_verify=time.time())
+
+        logger.info(
+            f"ФНС: реестр {sheet_id} проверен за {time.monotonic() - started:.1f} с: "
+            f"{format_verify_stats(stats)}"
+        )
+        return stats
+
+
+def format_verify_stats(stats):
+    """Строка счетчиков проверки для логов"""
+    return (
+        f"строк {stats['rows']}, аннулировано {stats['cancelled']}, не найдено {stats['not_found']}, "
+        f"изменено {stats['updated']}; запросов {stats['fetched'] + stats['not_modified'] + stats['error']} "
+        f"(304: {stats['not_modified']}, ошибок {stats['error']}), из кэша {stats['cached']}"
+    )
+
+
+def format_verify_result(stats):
+    """Сообщение пользователю о результате /verify"""
+    if not stats['rows'] and not stats['error']:
+        if stats['no_url']:
+            return f"📭 Проверять нечего: у {stats['no_url']} чеков нет ссылки ФНС (QR не распознан)"
+        return "📭 В реестре нет чеков для проверки"
+
+    lines = [
+        "🔎 Проверка чеков в ФНС\n",
+        f"✅ Действительны: {stats['valid']}",
+        f"❌ Аннулированы: {stats['cancelled']}",
+    ]
+    if stats['not_found']:
+        lines.append(f"❓ Не найдены в ФНС: {stats['not_found']}")
+    lines.append(f"\n✏️ Статус обновлен в таблице: {stats['updated']}")
+    if stats['skipped']:
+        lines.append(f"⚠️ Не обновлено (строку изменили вручную): {stats['skipped']}")
+    if stats['error']:
+        lines.append(f"⚠️ ФНС не ответила по {stats['error']} чекам - проверю позже")
+    if stats['no_url']:
+        lines.append(f"ℹ️ Без ссылки ФНС (QR не распознан): {stats['no_url']}")
+    return '\n'.join(lines)
+
+
+_verifier = None
+_verifier_lock = threading.Lock()
+
+
+def get_fns_verifier():
+    """Верификатор процесса (создается при первом обращении)"""
+    global _verifier
+    with _verifier_lock:
+        if _verifier is None:
+            _verifier = FnsVerifier()
+        return _verifier
@@ -0,0 +1,187 @@
+"""
+HTTP-транспорт клиентов Google API
+
+googleapiclient по умолчанию создает для каждого сервиса свой httplib2.Http,
+а httplib2 не потокобезопасен: два потока с одним сервисом портят друг другу
+соединение. Здесь все сервисы (build_service) ходят через один пул
+авторизованных httplib2.Http: на время запроса поток берет из пула свободный
+Http и возвращает его после ответа. Так один Http никогда не используется
+двумя потоками сразу, а keep-alive соединения переиспользуются между
+запросами и сервисами. Размер пула (GOOGLE_HTTP_POOL_SIZE) ограничивает
+число одновременных запросов к Google, GOOGLE_HTTP_TIMEOUT - таймаут сокета.
+"""
+import os
+import queue
+import threading
+import time
+
+from google_auth import get_google_credentials
+
+# Сколько запросов к Google выполняется одновременно (соединений в пуле)
+GOOGLE_HTTP_POOL_SIZE = int(os.getenv('GOOGLE_HTTP_POOL_SIZE', '8'))
+# Таймаут сокета запроса к Google, секунд
+GOOGLE_HTTP_TIMEOUT = float(os.getenv('GOOGLE_HTTP_TIMEOUT', '60'))
+
+
+def new_http(timeout=GOOGLE_HTTP_TIMEOUT):
+    """httplib2.Http, настроенный как в googleapiclient.http.build_http"""
+    import httplib2
+
+    http = httplib2.Http(timeout=timeout)
+    # 308 в Drive означает продолжение resumable-загрузки, а не редирект
+    http.redirect_codes = http.redirect_codes - {308}
+    return http
+
+
+class PooledHttp:
+    """
+    Пул авторизованных httplib2.Http с интерфейсом httplib2.Http
+    (request/close/credentials) - его принимает build(http=...)
+    """
+
+    def __init__(self, credentials, size=GOOGLE_HTTP_POOL_SIZE, timeout=GOOGLE_HTTP_TIMEOUT):
+        self.credentials = credentials
+        self.size = max(1, size)
+        self.timeout = timeout
+        # LIFO: следующий запрос получает Http с самым "теплым" соединением
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self.stats = {'requests': 0, 'connections': 0, 'reused': 0, 'waits': 0, 'wait_s': 0.0}
+
+    def _new_authorized(self):
+        from google_auth_httplib2 import AuthorizedHttp
+        return AuthorizedHttp(self.credentials, http=new_http(self.timeout))
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                return self._new_authorized()
+        started = time.monotonic()
+        http = self._idle.get()
+        with self._lock:
+            self.stats['waits'] += 1
+            self.stats['wait_s'] += time.monotonic() - started
+        return http
+
+    def request(self, uri, *args, **kwargs):
+        import httplib2
+
+        scheme, authority, _, _ = httplib2.urlnorm(uri)
+        conn_key = f"{scheme}:{authority}"
+        http = self._acquire()
+        reused = conn_key in http.http.connections
+        try:
+            return http.request(uri, *args, **kwargs)
+        finally:
+            # httplib2 убирает соединение после ошибки - следующий запрос откроет новое
+            opened = not reused and conn_key in http.http.connections
+            with self._lock:
+                self.stats['requests'] += 1
+                self.stats['reused'] += int(reused)
+                self.stats['connections'] += int(opened)
+            self._idle.put(http)
+
+    def close(self):
+        """
+        Закрыть свободные соединения (googleapiclient вызывает при закрытии
+        сервиса; пул общий, поэтому Http остаются в пуле и откроют соединение снова)
+        """
+        idle = []
+        while True:
+            try:
+                idle.append(self._idle.get_nowait())
+            except queue.Empty:
+                break
+        for http in idle:
+            http.http.close()
+            self._idle.put(http)
+
+    def snapshot(self):
+        """Статистика пула: запросы, новые соединения, доля переиспользованных"""
+        with self._lock:
+            stats = dict(self.stats)
+            stats['pool'] = self._created
+        stats['reuse_rate'] = stats['reused'] / stats['requests'] if stats['requests'] else 0.0
+        return stats
+
+
+class CachedResource:
+    """
+    Клиент googleapiclient, который не пересоздает вложенные коллекции:
+    service.spreadsheets().values() при каждом вызове строит методы коллекции
+    заново (с разбором схем для docstring - ~10 мс CPU под GIL на вызов).
+    Коллекция создается один раз; методы запросов (get, append, ...)
+    возвращают новый HttpRequest, поэтому общую коллекцию можно вызывать
+    из разных потоков
+    """
+
+    def __init__(self, resource):
+        self._resource = resource
+        self._collections = {}
+
+    def __getattr__(self, name):
+        attr = getattr(self._resource, name)
+        description = getattr(self._resource, '_resourceDesc', None) or {}
+        if name not in description.get('resources', {}):
+            return attr
+
+        def collection():
+            cached = self._collections.get(name)
+            if cached is None:
+                # Гонка безопасна: в худшем случае коллекция создастся дважды
+                cached = self._collections.setdefault(name, CachedResource(attr()))
+            return cached
+
+        return collection
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_services = {}
+
+
+def get_google_http():
+    """Общий пул HTTP для всех клиентов Google (создается при первом обращении)"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = PooledHttp(get_google_credentials())
+    return _pool
+
+
+def build_service(service_name, version):
+    """
+    Клиент Google API на общем пуле соединений - вместо
+    build(service_name, version, credentials=creds)
+    Клиент создается один раз на процесс: разбор discovery-документа
+    дорогой, а с пулом HTTP клиент можно использовать из разных потоков
+    """
+    from googleapiclient.discovery import build
+
+    http = get_google_http()
+    with _pool_lock:
+        service = _services.get((service_name, version))
+        if service is None:
+            service = CachedResource(build(service_name, version, http=http, cache_discovery=False))
+            _services[(service_name, version)] = service
+    return service
+
+
+def transport_stats():
+    """Статистика пула (None, если к Google еще не обращались)"""
+    return _pool.snapshot() if _pool else None
+
+
+def format_transport_stats(stats):
+    """Строка статистики пула для логов и /status"""
+    return (
+        f"запросов {stats['requests']}, соединений открыто {stats['connections']}, "
+        f"переиспользовано {stats['reuse_rate'] * 100:.0f}%, пул {stats['pool']}/{GOOGLE_HTTP_POOL_SIZE}, "
+        f"ожиданий {stats['waits']} ({stats['wait_s']:.1f} с)"
+    )
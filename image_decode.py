@@ -0,0 +1,240 @@
+"""
+Единое декодирование изображений чеков
+
+Формат определяется по первым байтам файла, а не по расширению или
+mimeType: из папки анализа приходят HEIC/HEIF (iPhone), WebP, PNG и PDF.
+Каждый формат декодируется своим способом (JPEG - сразу в уменьшенном
+масштабе через draft, HEIC - pillow-heif, PDF - первая страница через
+pdf2image из байт), результат приводится к одному виду - DecodedImage:
+RGB-изображение не больше DECODE_MAX_SIDE по длинной стороне и JPEG для
+Vision. Его используют QR, OCR и Vision, поэтому файл декодируется один раз.
+
+Результаты хранятся в LRU-кэше по хэшу содержимого (DECODE_CACHE_MB):
+повторный запрос в высоком качестве, одновременные QR и Vision и повторно
+присланный файл не декодируют и не перекодируют его заново.
+"""
+import hashlib
+import io
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+# Длинная сторона нормализованного изображения (Vision все равно уменьшает до 2048)
+DECODE_MAX_SIDE = int(os.getenv('DECODE_MAX_SIDE', '2048'))
+# Кэш декодированных изображений по хэшу содержимого
+DECODE_CACHE_MB = int(os.getenv('DECODE_CACHE_MB', '64'))
+# Качество JPEG при перекодировании (HEIC, PNG, WebP, PDF) для Vision
+DECODE_JPEG_QUALITY = int(os.getenv('DECODE_JPEG_QUALITY', '90'))
+# Разрешение рендера страницы PDF
+PDF_DPI = int(os.getenv('PDF_DPI', '200'))
+
+# Бренды контейнера ISO BMFF, которые декодирует pillow-heif
+HEIF_BRANDS = {b'heic', b'heix', b'hevc', b'hevx', b'heim', b'heis', b'mif1', b'msf1'}
+
+
+class ImageDecodeError(Exception):
+    """Файл не удалось прочитать как изображение чека"""
+
+
+def sniff_format(data):
+    """
+    Формат по сигнатуре: jpeg, png, webp, heif, pdf, gif, bmp, tiff или None
+    """
+    if data[:3] == b'\xff\xd8\xff':
+        return 'jpeg'
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'png'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    if data[4:8] == b'ftyp' and data[8:12] in HEIF_BRANDS:
+        return 'heif'
+    if data[:5] == b'%PDF-':
+        return 'pdf'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if data[:2] == b'BM':
+        return 'bmp'
+    if data[:4] in (b'II*\x00', b'MM\x00*'):
+        return 'tiff'
+    return None
+
+
+# Расширение и MIME-тип файла по формату (загрузка байт на Drive)
+FORMAT_MEDIA = {
+    'jpeg': ('.jpg', 'image/jpeg'),
+    'png': ('.png', 'image/png'),
+    'webp': ('.webp', 'image/webp'),
+    'heif': ('.heic', 'image/heic'),
+    'pdf': ('.pdf', 'application/pdf'),
+    'gif': ('.gif', 'image/gif'),
+    'bmp': ('.bmp', 'image/bmp'),
+    'tiff': ('.tiff', 'image/tiff'),
+}
+
+
+def media_type(data):
+    """(расширение, MIME-тип) файла по сигнатуре"""
+    return FORMAT_MEDIA.get(sniff_format(data), ('', 'application/octet-stream'))
+
+
+class DecodedImage:
+    """
+    Нормализованное изображение чека
+    image - RGB (PIL), не больше DECODE_MAX_SIDE; jpeg - байты для Vision
+    (исходный JPEG без перекодирования, если его не пришлось уменьшать или поворачивать)
+    """
+
+    def __init__(self, source_format, image, jpeg, digest):
+        self.format = source_format
+        self.image = image
+        self.jpeg = jpeg
+        self.digest = digest
+
+    @property
+    def size(self):
+        return self.image.size
+
+    @property
+    def nbytes(self):
+        width, height = self.image.size
+        return width * height * 3 + len(self.jpeg)
+
+    def gray(self):
+        """Оттенки серого (numpy) для OpenCV"""
+        import numpy as np
+
+        return np.asarray(self.image.convert('L'))
+
+
+def _fit(image):
+    """Уменьшение до DECODE_MAX_SIDE по длинной стороне"""
+    if max(image.size) > DECODE_MAX_SIDE:
+        image.thumbnail((DECODE_MAX_SIDE, DECODE_MAX_SIDE))
+    return image
+
+
+def _open_pil(data, source_format):
+    """
+    (RGB-изображение, можно ли отправить в Vision исходные байты) - исходный
+    JPEG годится, если он не больше DECODE_MAX_SIDE и не повернут через EXIF
+    """
+    from PIL import Image, ImageOps
+
+    if source_format == 'heif':
+        try:
+            from pillow_heif import register_heif_opener
+        except ImportError:
+            raise ImageDecodeError("HEIC/HEIF не поддерживается: установите pillow-heif")
+        register_heif_opener()
+
+    image = Image.open(io.BytesIO(data))
+    passthrough = (source_format == 'jpeg' and max(image.size) <= DECODE_MAX_SIDE
+                   and image.getexif().get(0x0112, 1) == 1)
+    if source_format == 'jpeg':
+        # Декодирование JPEG сразу в уменьшенном масштабе (1/2, 1/4, 1/8)
+        image.draft('RGB', (DECODE_MAX_SIDE, DECODE_MAX_SIDE))
+    # Поворот по EXIF (фото с телефона), затем RGB без альфа-канала
+    image = ImageOps.exif_transpose(image)
+    return image.convert('RGB'), passthrough
+
+
+def _render_pdf(data):
+    from pdf2image import convert_from_bytes
+
+    try:
+        pages = convert_from_bytes(data, dpi=PDF_DPI, first_page=1, last_page=1)
+    except Exception as e:
+        raise ImageDecodeError(f"Не удалось прочитать PDF: {e}")
+    if not pages:
+        raise ImageDecodeError("Не удалось прочитать PDF")
+    return pages[0].convert('RGB')
+
+
+def decode_bytes(data, digest=None):
+    """
+    Декодирование байт файла в DecodedImage (без кэша)
+    """
+    source_format = sniff_format(data)
+    if source_format is None:
+        raise ImageDecodeError("Неизвестный формат файла (ожидается фото или PDF)")
+
+    if source_format == 'pdf':
+        image, passthrough = _render_pdf(data), False
+    else:
+        try:
+            image, passthrough = _open_pil(data, source_format)
+        except ImageDecodeError:
+            raise
+        except Exception as e:
+            raise ImageDecodeError(f"Не удалось прочитать изображение ({source_format}): {e}")
+
+    image = _fit(image)
+    if passthrough:
+        jpeg = data
+    else:
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=DECODE_JPEG_QUALITY)
+        jpeg = buffer.getvalue()
+
+    return DecodedImage(source_format, image, jpeg, digest or hashlib.sha256(data).hexdigest())
+
+
+class DecodeCache:
+    """
+    LRU-кэш DecodedImage по хэшу содержимого, ограниченный по памяти
+    """
+
+    def __init__(self, limit_bytes=DECODE_CACHE_MB * MB):
+        self.limit = limit_bytes
+        self.used = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, digest):
+        with self._lock:
+            decoded = self._items.get(digest)
+            if decoded is not None:
+                self._items.move_to_end(digest)
+            return decoded
+
+    def put(self, decoded):
+        if decoded.nbytes > self.limit:
+            return
+        with self._lock:
+            if decoded.digest in self._items:
+                return
+            self._items[decoded.digest] = decoded
+            self.used += decoded.nbytes
+            while self.used > self.limit:
+                _, evicted = self._items.popitem(last=False)
+                self.used -= evicted.nbytes
+
+
+_decode_cache = DecodeCache()
+
+
+def load_image(source):
+    """
+    DecodedImage для пути к файлу, байт файла или уже декодированного изображения
+    (повторное декодирование того же содержимого берется из кэша)
+    """
+    if isinstance(source, DecodedImage):
+        return source
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        data = bytes(source)
+    else:
+        with open(source, 'rb') as f:
+            data = f.read()
+
+    digest = hashlib.sha256(data).hexdigest()
+    decoded = _decode_cache.get(digest)
+    if decoded is None:
+        decoded = decode_bytes(data, digest)
+        _decode_cache.put(decoded)
+        logger.debug(f"Декодировано {decoded.format} {decoded.size[0]}×{decoded.size[1]}")
+    return decoded
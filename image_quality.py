@@ -0,0 +1,204 @@
+"""
+Проверка качества фото чека до запроса к Vision
+
+Размытое, темное, засвеченное, слишком мелкое фото или снимок, где чек занимает
+малую часть кадра, Vision все равно не прочитает: получится строка
+«Не распознано», а запрос (и повторный в высоком качестве) будет оплачен.
+Проверка идет локально по уже декодированному изображению (image_decode) и
+занимает миллисекунды:
+- разрешение - короткая сторона изображения, пикселей
+- площадь чека - доля кадра, которую занимает самая большая светлая область
+  (бумага чека): порог Оцу, закрытие текста морфологией, внешний контур
+- яркость - средняя яркость внутри чека (в основном бумага)
+- контраст - разброс яркости внутри чека между 1-м и 99-м перцентилями
+  (текст на бумаге; не зависит от того, сколько на чеке текста)
+- резкость - дисперсия лапласиана внутри чека
+
+Метрики считаются на копии, уменьшенной до QUALITY_ANALYSIS_SIDE по длинной
+стороне, поэтому пороги не зависят от размера исходного фото. PDF (рендер
+страницы) не проверяется. Пороги подобраны на корпусе benchmarks/tune_quality.py.
+
+QUALITY_GATE:
+- reject - фото с замечаниями не отправляется в Vision, пользователь сразу
+  получает совет, как переснять
+- warn - чек распознается, советы добавляются к ошибкам распознавания
+- off - проверка выключена
+"""
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+QUALITY_GATE = os.getenv('QUALITY_GATE', 'reject')
+# Длинная сторона копии для расчета метрик
+QUALITY_ANALYSIS_SIDE = int(os.getenv('QUALITY_ANALYSIS_SIDE', '1024'))
+# Пороги (benchmarks/tune_quality.py), округлены в сторону мягкости: годное фото
+# дороже отклонить, чем лишний раз отправить в Vision
+QUALITY_MIN_SIDE = int(os.getenv('QUALITY_MIN_SIDE', '480'))
+QUALITY_MIN_COVERAGE = float(os.getenv('QUALITY_MIN_COVERAGE', '0.15'))
+QUALITY_MIN_BRIGHTNESS = float(os.getenv('QUALITY_MIN_BRIGHTNESS', '75'))
+QUALITY_MIN_CONTRAST = float(os.getenv('QUALITY_MIN_CONTRAST', '70'))
+QUALITY_MIN_SHARPNESS = float(os.getenv('QUALITY_MIN_SHARPNESS', '90'))
+
+# Совет пользователю по каждому замечанию (в порядке проверки)
+ADVICE = {
+    'resolution': "фото слишком маленькое - отправь его как фото, а не миниатюру, или сними ближе",
+    'coverage': "чек занимает малую часть кадра - сними ближе, чтобы чек заполнил кадр",
+    'dark': "слишком темно - включи свет или вспышку",
+    'contrast': "текст почти не виден (блик или засветка) - убери блик, сними под другим углом",
+    'blur': "фото размыто - держи телефон неподвижно и дождись фокусировки",
+}
+
+
+@dataclass(frozen=True)
+class QualityThresholds:
+    """Пороги проверки (по умолчанию - из переменных окружения)"""
+    min_side: int = QUALITY_MIN_SIDE
+    min_coverage: float = QUALITY_MIN_COVERAGE
+    min_brightness: float = QUALITY_MIN_BRIGHTNESS
+    min_contrast: float = QUALITY_MIN_CONTRAST
+    min_sharpness: float = QUALITY_MIN_SHARPNESS
+
+
+@dataclass(slots=True)
+class QualityReport:
+    """
+    Метрики одного изображения; problems - коды замечаний (ключи ADVICE)
+    """
+    width: int
+    height: int
+    sharpness: float
+    brightness: float
+    contrast: float
+    coverage: float
+    elapsed_ms: float = 0.0
+    problems: list = field(default_factory=list)
+
+    @property
+    def ok(self):
+        return not self.problems
+
+    def advice(self):
+        """Советы по замечаниям через «; » (как ошибки распознавания)"""
+        return '; '.join(ADVICE[problem] for problem in self.problems)
+
+
+def find_problems(report, thresholds=None):
+    """Коды замечаний по метрикам report (порядок - как в ADVICE)"""
+    thresholds = thresholds or QualityThresholds()
+    checks = {
+        'resolution': min(report.width, report.height) < thresholds.min_side,
+        'coverage': report.coverage < thresholds.min_coverage,
+        'dark': report.brightness < thresholds.min_brightness,
+        'contrast': report.contrast < thresholds.min_contrast,
+        'blur': report.sharpness < thresholds.min_sharpness,
+    }
+    # Темнота и засветка сами снижают контраст и резкость - совет только о причине
+    if checks['dark']:
+        checks['contrast'] = checks['blur'] = False
+    elif checks['contrast']:
+        checks['blur'] = False
+    return [problem for problem, failed in checks.items() if failed]
+
+
+def _analysis_gray(image):
+    """Копия в оттенках серого (numpy), не больше QUALITY_ANALYSIS_SIDE"""
+    import cv2
+    import numpy as np
+
+    # Резкость зависит от масштаба, поэтому размер копии у всех фото один
+    gray = np.asarray(image.convert('L'))
+    height, width = gray.shape
+    scale = QUALITY_ANALYSIS_SIDE / max(height, width)
+    if scale < 1:
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        gray = cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
+    return gray
+
+
+def _receipt_region(gray):
+    """
+    (доля кадра, срез) самой большой светлой области - бумаги чека
+    """
+    import cv2
+
+    height, width = gray.shape
+    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+    _, mask = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    # Строки текста внутри чека закрываются, чтобы чек был одной областью
+    side = max(3, min(height, width) // 40)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_RECT, (side, side)))
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return 0.0, (slice(None), slice(None))
+
+    largest = max(contours, key=cv2.contourArea)
+    x, y, w, h = cv2.boundingRect(largest)
+    coverage = cv2.contourArea(largest) / float(width * height)
+    return coverage, (slice(y, y + h), slice(x, x + w))
+
+
+def measure_quality(image):
+    """
+    Метрики качества (без порогов)
+    image - DecodedImage или PIL-изображение
+    """
+    import cv2
+    import numpy as np
+
+    started = time.perf_counter()
+    pil_image = getattr(image, 'image', image)
+    width, height = pil_image.size
+
+    gray = _analysis_gray(pil_image)
+    coverage, region = _receipt_region(gray)
+    receipt = gray[region]
+    if receipt.size < 64:
+        receipt = gray
+    low, high = np.percentile(receipt, (1, 99))
+
+    return QualityReport(
+        width=width,
+        height=height,
+        sharpness=float(cv2.Laplacian(receipt, cv2.CV_64F).var()),
+        brightness=float(receipt.mean()),
+        contrast=float(high - low),
+        coverage=coverage,
+        elapsed_ms=(time.perf_counter() - started) * 1000,
+    )
+
+
+def check_quality(image, thresholds=None):
+    """
+    Проверка изображения перед Vision: QualityReport с замечаниями
+    None - проверка выключена (QUALITY_GATE=off), PDF или не удалась
+    (ошибка проверки не мешает распознаванию)
+    """
+    if QUALITY_GATE == 'off' or getattr(image, 'format', None) == 'pdf':
+        return None
+    try:
+        report = measure_quality(image)
+    except Exception as e:
+        logger.warning(f"Проверка качества изображения не удалась: {e}")
+        return None
+
+    report.problems = find_problems(report, thresholds)
+    if report.problems:
+        logger.info(
+            f"Качество фото: {', '.join(report.problems)} ({report.width}×{report.height}, "
+            f"резкость {report.sharpness:.0f}, яркость {report.brightness:.0f}, "
+            f"контраст {report.contrast:.0f}, площадь чека {report.coverage:.0%}, "
+            f"{report.elapsed_ms:.0f} мс)"
+        )
+    return report
+
+
+def format_rejection(report):
+    """Сообщение об отклоненном фото"""
+    return f"Фото не подходит для распознавания: {report.advice()}"
@@ -0,0 +1,152 @@
+"""
+Бюджет памяти для массовой обработки
+
+На время обработки одного чека в памяти одновременно находятся: исходные
+байты файла, JPEG для Vision и его base64 (~1.34x), декодированное
+изображение (image_decode: не больше DECODE_MAX_SIDE по длинной стороне) и
+оттенки серого в QR-распознавании, а для PDF - еще и отрендеренная страница.
+Файл массового анализа начинает обрабатываться, только если его оценка
+помещается в бюджет вместе с уже обрабатываемыми файлами. Кэш декодированных
+изображений (DECODE_CACHE_MB) живет дольше обработки файла, поэтому его
+размер вычитается из BATCH_MEMORY_BUDGET_MB.
+"""
+import asyncio
+import os
+import threading
+from contextlib import asynccontextmanager
+
+from image_decode import DECODE_CACHE_MB, DECODE_MAX_SIDE
+
+MB = 1024 * 1024
+
+BATCH_MEMORY_BUDGET_MB = int(os.getenv('BATCH_MEMORY_BUDGET_MB', '512'))
+
+# Размер файла, если Drive его не сообщил
+DEFAULT_FILE_SIZE = 5 * MB
+# Во сколько раз декодированное изображение больше файла (RGB, 3 байта на пиксель)
+DECODE_RATIO = {'image/png': 4}
+DEFAULT_DECODE_RATIO = 10
+# Страница A4, отрендеренная pdf2image при 200 dpi: 1654 x 2339 x 3 байта
+PDF_PAGE_BYTES = 1654 * 2339 * 3
+# JPEG страницы PDF для Vision (image_decode, в памяти)
+PDF_JPEG_BYTES = 1 * MB
+# Декодированное изображение не больше DECODE_MAX_SIDE по длинной стороне
+MAX_DECODED_BYTES = DECODE_MAX_SIDE * DECODE_MAX_SIDE * 3
+# Интерпретатор, буферы HTTP-клиентов и ответ Vision
+OVERHEAD_BYTES = 2 * MB
+
+
+def estimate_footprint(size, mime_type):
+    """
+    Оценка пиковой памяти на обработку одного файла (байты)
+    size - размер файла (байты или строка, как в ответе Drive), None - неизвестен
+    """
+    size = int(size) if size else DEFAULT_FILE_SIZE
+
+    if mime_type == 'application/pdf':
+        # PDF + рендер страницы, дальше - уменьшенное изображение и JPEG
+        rendered = min(PDF_PAGE_BYTES, MAX_DECODED_BYTES)
+        encoded = PDF_JPEG_BYTES
+        source = size + PDF_PAGE_BYTES
+    else:
+        ratio = DECODE_RATIO.get(mime_type, DEFAULT_DECODE_RATIO)
+        rendered = min(size * ratio, MAX_DECODED_BYTES)
+        encoded = size
+        source = size
+
+    # Файл + base64 JPEG для Vision; изображение PIL + оттенки серого (1/3)
+    return int(source + encoded * 1.34 + rendered * (1 + 1 / 3) + OVERHEAD_BYTES)
+
+
+class MemoryBudget:
+    """
+    Ограничение суммарной оценки памяти одновременно обрабатываемых файлов
+
+    Использование:
+        async with budget.reserve(estimate_footprint(file['size'], file['mimeType'])):
+            ...
+    Файл, который больше всего бюджета, обрабатывается в одиночку
+    """
+
+    def __init__(self, limit_bytes=(BATCH_MEMORY_BUDGET_MB - DECODE_CACHE_MB) * MB):
+        self.limit = max(1, limit_bytes)
+        self.used = 0
+        self.peak_used = 0
+        self.waits = 0
+        self._condition = None
+
+    @asynccontextmanager
+    async def reserve(self, nbytes):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        nbytes = min(nbytes, self.limit)
+
+        async with self._condition:
+            if self.used + nbytes > self.limit:
+                self.waits += 1
+            await self._condition.wait_for(lambda: self.used + nbytes <= self.limit)
+            self.used += nbytes
+            self.peak_used = max(self.peak_used, self.used)
+
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self.used -= nbytes
+                self._condition.notify_all()
+
+
+_budget = None
+
+
+def get_memory_budget():
+    """Бюджет процесса (создается при первом обращении)"""
+    global _budget
+    if _budget is None:
+        _budget = MemoryBudget()
+    return _budget
+
+
+def read_rss_bytes():
+    """
+    Текущий RSS процесса в байтах (Linux, /proc/self/statm)
+    Возвращает 0, если /proc недоступен
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+class RssSampler:
+    """
+    Фоновый замер пикового RSS (включая память C-библиотек: cv2, PIL, poppler),
+    которую tracemalloc не видит
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+        self.start_rss = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start_rss = read_rss_bytes()
+        self.peak = self.start_rss
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, read_rss_bytes())
+        return False
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, read_rss_bytes())
+            self._stop.wait(self.interval)
@@ -1,14 +1,17 @@
-import pytesseract
-from PIL import Image
 import re
 from datetime import datetime
 
 def extract_text_from_image(image_path):
     """
     Извлечение текста из изображения через OCR
+    image_path - путь к файлу, байты или DecodedImage (image_decode)
     """
     try:
-        img = Image.open(image_path)
+        # Загружаются только при использовании OCR
+        import pytesseract
+        from image_decode import load_image
+        
+        img = load_image(image_path).image
         text = pytesseract.image_to_string(img, lang='rus')
         return text
     except Exception as e:
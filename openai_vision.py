@@ -1,37 +1,57 @@
-from openai import OpenAI
+from openai import OpenAI, APIConnectionError, InternalServerError, RateLimitError
 import base64
+import io
 import json
 import os
+import time
 from dotenv import load_dotenv
-from datetime import datetime
+from vision_usage import record_vision_call
+from image_decode import load_image, ImageDecodeError
 
 load_dotenv()
 
-class OpenAIVisionParser:
-    def __init__(self):
-        """
-        Инициализация OpenAI клиента
-        """
-        self.client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
-    
-    def encode_image(self, image_path):
-        """
-        Кодирование изображения в base64
-        """
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
-    
-    def parse_receipt(self, image_path):
-        """
-        Парсинг чека через GPT-4o-mini Vision
-        Возвращает словарь с данными чека
-        """
-        try:
-            # Кодируем изображение
-            base64_image = self.encode_image(image_path)
-            
-            # Промпт для извлечения данных
-            prompt = """
+# Режим ответа Vision:
+# structured - ответ строго по JSON-схеме (response_format=json_schema), короткий промпт
+# legacy - прежний текстовый промпт и разбор JSON из текста (для A/B-сравнения)
+VISION_OUTPUT_MODE = os.getenv('VISION_OUTPUT_MODE', 'structured')
+# Лимит токенов ответа: JSON чека по схеме занимает ~100-150 токенов
+VISION_MAX_TOKENS = int(os.getenv('VISION_MAX_TOKENS', '300'))
+
+# Запрос в низком качестве (detail=low): OpenAI все равно уменьшает изображение
+# до 512×512, поэтому отправляем уже уменьшенное - меньше байт на загрузку
+VISION_LOW_MAX_SIDE = int(os.getenv('VISION_LOW_MAX_SIDE', '512'))
+
+VISION_MODEL = 'gpt-4o-mini'
+
+# Схема задает только поля и типы (она тоже считается в токены промпта),
+# форматы полей - одной строкой промпта. Схема и промпт не меняются от запроса
+# к запросу и идут перед изображением: одинаковый префикс OpenAI кэширует
+RECEIPT_SCHEMA = {
+    'name': 'receipt',
+    'strict': True,
+    'schema': {
+        'type': 'object',
+        'properties': {
+            'full_name': {'type': 'string'},
+            'amount': {'type': 'string'},
+            'services': {'type': 'string'},
+            'seller_inn': {'type': 'string'},
+            'buyer_inn': {'type': 'string'},
+            'date': {'type': 'string'},
+            'status': {'type': 'string', 'enum': ['Действителен', 'Аннулирован']},
+        },
+        'required': ['full_name', 'amount', 'services', 'seller_inn', 'buyer_inn', 'date', 'status'],
+        'additionalProperties': False,
+    },
+}
+
+STRUCTURED_PROMPT = (
+    "Чек самозанятого. full_name продавца: Фамилия И.О.; amount: сумма строки услуги "
+    "(не «Итого»), как 7 021.00 ₽; date: dd.mm.yyyy; seller_inn - после «ЧЕК», "
+    "buyer_inn - после «Покупатель». Нет значения - пустая строка."
+)
+
+LEGACY_PROMPT = """
 Проанализируй этот чек самозанятого и извлеки следующие данные в формате JSON:
 
 {
@@ -50,54 +70,172 @@ class OpenAIVisionParser:
 - ИНН покупателя идет ВТОРЫМ (после "Покупатель")
 - Верни ТОЛЬКО JSON, без дополнительного текста
 """
-            
-            # Запрос к OpenAI
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
+
+
+class OpenAIVisionParser:
+    def __init__(self, mode=None):
+        """
+        Инициализация OpenAI клиента
+        mode - 'structured' или 'legacy' (по умолчанию VISION_OUTPUT_MODE)
+        """
+        self.client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+        self.mode = mode or VISION_OUTPUT_MODE
+        # usage последнего запроса (токены промпта/ответа, в том числе из кэша)
+        self.last_usage = None
+        # Исключение API последнего parse_receipt (None - ответ получен)
+        self.last_error = None
+
+    def encode_image(self, image_path):
+        """
+        Кодирование изображения в base64 (JPEG из image_decode: HEIC, PNG,
+        WebP и PDF перекодированы, подпись image/jpeg в запросе верна)
+        image_path - путь к файлу, байты или DecodedImage
+        """
+        return base64.b64encode(load_image(image_path).jpeg).decode('utf-8')
+
+    @staticmethod
+    def encode_image_low(image_path, max_side=VISION_LOW_MAX_SIDE):
+        """
+        Уменьшенное изображение для запроса detail=low: (base64 JPEG, (ширина, высота))
+        """
+        image = load_image(image_path).image.copy()
+        image.thumbnail((max_side, max_side))
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=85)
+        return base64.b64encode(buffer.getvalue()).decode('utf-8'), image.size
+
+    def build_request(self, base64_image, detail=None):
+        """
+        Параметры chat.completions.create для текущего режима
+        detail - качество изображения (low/high; None - по умолчанию OpenAI)
+        """
+        image = {
+            "type": "image_url",
+            "image_url": {
+                "url": f"data:image/jpeg;base64,{base64_image}"
+            }
+        }
+        if detail:
+            image["image_url"]["detail"] = detail
+
+        if self.mode == 'legacy':
+            return {
+                "messages": [
                     {
                         "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": prompt
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64_image}"
-                                }
-                            }
-                        ]
+                        "content": [{"type": "text", "text": LEGACY_PROMPT}, image]
                     }
                 ],
-                max_tokens=500,
-                temperature=0
+                "max_tokens": 500,
+            }
+
+        return {
+            "messages": [
+                {"role": "system", "content": STRUCTURED_PROMPT},
+                {"role": "user", "content": [image]}
+            ],
+            "response_format": {"type": "json_schema", "json_schema": RECEIPT_SCHEMA},
+            "max_tokens": VISION_MAX_TOKENS,
+        }
+
+    @staticmethod
+    def parse_content(content):
+        """
+        JSON из текстового ответа (режим legacy): модель может обернуть его в ```json
+        """
+        content = content.strip()
+
+        # Убираем возможные markdown блоки
+        if content.startswith('```json'):
+            content = content[7:]
+        if content.startswith('```'):
+            content = content[3:]
+        if content.endswith('```'):
+            content = content[:-3]
+
+        return json.loads(content.strip())
+
+    @staticmethod
+    def image_size(image_path):
+        """(ширина, высота) изображения, отправляемого в Vision"""
+        try:
+            return load_image(image_path).size
+        except Exception:
+            return None
+
+    def request(self, base64_image, image_size=None, timeout=None, detail=None):
+        """
+        Запрос к OpenAI с учетом (vision_usage): токены, время, повторы клиента
+        """
+        started = time.perf_counter()
+        try:
+            raw = self.client.chat.completions.with_raw_response.create(
+                model=VISION_MODEL,
+                temperature=0,
+                timeout=timeout,
+                **self.build_request(base64_image, detail)
             )
-            
-            # Извлекаем JSON из ответа
-            content = response.choices[0].message.content.strip()
-            
-            # Убираем возможные markdown блоки
-            if content.startswith('```json'):
-                content = content[7:]
-            if content.startswith('```'):
-                content = content[3:]
-            if content.endswith('```'):
-                content = content[:-3]
-            
-            # Парсим JSON
-            data = json.loads(content.strip())
-            
-            # Добавляем объект даты для Drive
+            response = raw.parse()
+        except Exception as e:
+            # Число повторов при ошибке клиент не сообщает: ошибки, которые он
+            # повторяет (сеть, 429, 5xx), доходят сюда после всех повторов
+            retryable = isinstance(e, (APIConnectionError, RateLimitError, InternalServerError))
+            record_vision_call(VISION_MODEL, (time.perf_counter() - started) * 1000,
+                               image_size=image_size, detail=detail or 'auto',
+                               retries=self.client.max_retries if retryable else 0, failed=True)
+            raise
+
+        self.last_usage = response.usage
+        record_vision_call(VISION_MODEL, (time.perf_counter() - started) * 1000, response.usage,
+                           image_size=image_size, retries=raw.retries_taken, detail=detail or 'auto')
+        return response
+
+    def parse_receipt(self, image_path, timeout=None, detail=None):
+        """
+        Парсинг чека через GPT-4o-mini Vision
+        image_path - путь к файлу, байты или DecodedImage (image_decode)
+        timeout - таймаут запроса в секундах (None - по умолчанию клиента)
+        detail - качество изображения: low (уменьшенное, дешевле), high,
+        None - по умолчанию OpenAI
+        Возвращает словарь с данными чека
+        """
+        self.last_error = None
+        try:
+            # Декодируем один раз: повторный запрос берет изображение из кэша
+            image_path = load_image(image_path)
+
+            # Кодируем изображение
+            if detail == 'low':
+                base64_image, image_size = self.encode_image_low(image_path)
+            else:
+                base64_image, image_size = self.encode_image(image_path), self.image_size(image_path)
+
+            # Запрос к OpenAI
             try:
-                data['date_obj'] = datetime.strptime(data['date'], '%d.%m.%Y')
-            except:
-                data['date_obj'] = datetime.now()
-            
+                response = self.request(base64_image, image_size, timeout, detail)
+            except Exception as e:
+                self.last_error = e
+                raise
+
+            choice = response.choices[0]
+            if getattr(choice.message, 'refusal', None):
+                return False, {}, f"OpenAI отказался разбирать изображение: {choice.message.refusal}"
+            if choice.finish_reason == 'length':
+                return False, {}, "Ответ OpenAI обрезан (VISION_MAX_TOKENS)"
+
+            # Парсим JSON (в режиме structured ответ уже JSON по схеме)
+            if self.mode == 'legacy':
+                data = self.parse_content(choice.message.content)
+            else:
+                data = json.loads(choice.message.content)
+
             return True, data, "OK"
-            
+
+        except ImageDecodeError as e:
+            # Файл не читается - повтор запроса не поможет
+            self.last_error = e
+            return False, {}, str(e)
         except json.JSONDecodeError as e:
             return False, {}, f"Ошибка парсинга JSON: {str(e)}"
         except Exception as e:
-            return False, {}, f"Ошибка OpenAI: {str(e)}"
\ No newline at end of file
+            return False, {}, f"Ошибка OpenAI: {str(e)}"
@@ -0,0 +1,154 @@
+"""
+Прогресс массового анализа в одном сообщении
+
+Вместо отдельного сообщения на каждый файл бот отправляет одно сообщение
+и редактирует его не чаще раза в PROGRESS_UPDATE_INTERVAL секунд - так число
+запросов к Telegram зависит от длительности анализа, а не от числа файлов,
+и бот не упирается в лимиты Telegram на сообщения в чат.
+"""
+import asyncio
+import logging
+import os
+import time
+
+from telegram.error import BadRequest, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Минимальный интервал между обновлениями сообщения (секунды)
+PROGRESS_UPDATE_INTERVAL = float(os.getenv('PROGRESS_UPDATE_INTERVAL', '5'))
+
+
+def format_duration(seconds):
+    """Длительность для человека: «45 с», «3 мин», «1 ч 20 мин»"""
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds} с"
+    minutes = round(seconds / 60)
+    if minutes < 60:
+        return f"{minutes} мин"
+    return f"{minutes // 60} ч {minutes % 60} мин"
+
+
+class ProgressReporter:
+    """
+    Одно сообщение с прогрессом: обработано, ошибки, файлы в работе,
+    скорость и оценка оставшегося времени
+
+    Обработчик только сообщает о событиях (file_started/file_finished),
+    а сообщение обновляет фоновая задача с ограничением частоты
+    """
+
+    def __init__(self, bot, chat_id, total, title, interval=PROGRESS_UPDATE_INTERVAL):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.total = total
+        self.title = title
+        self.interval = interval
+
+        self.done = 0
+        self.failed = 0
+        self.skipped = 0
+        self.in_flight = []
+        self.edits = 0
+
+        self._message_id = None
+        self._last_text = None
+        self._started = time.monotonic()
+        self._not_before = 0.0
+        self._task = None
+
+    async def start(self):
+        """Отправка сообщения и запуск фонового обновления"""
+        self._started = time.monotonic()
+        text = self.render()
+        message = await self.bot.send_message(self.chat_id, text)
+        self._message_id = message.message_id
+        self._last_text = text
+        self._task = asyncio.create_task(self._refresh_loop())
+
+    def file_started(self, name):
+        self.in_flight.append(name)
+
+    def file_finished(self, name, success=True):
+        if name in self.in_flight:
+            self.in_flight.remove(name)
+        self.done += 1
+        if not success:
+            self.failed += 1
+
+    def file_skipped(self):
+        """Файл обработан до перезапуска: считается, но не влияет на скорость"""
+        self.done += 1
+        self.skipped += 1
+
+    def render(self, status=None):
+        """Текст сообщения"""
+        elapsed = time.monotonic() - self._started
+        processed_now = self.done - self.skipped
+        percent = int(self.done * 100 / self.total) if self.total else 100
+        filled = percent // 10
+
+        lines = [
+            status or f"⏳ {self.title}",
+            f"{'▓' * filled}{'░' * (10 - filled)} {percent}%",
+            f"Обработано: {self.done}/{self.total} (✅ {self.done - self.failed}, ❌ {self.failed})",
+        ]
+
+        if self.in_flight and status is None:
+            names = ', '.join(self.in_flight[:3])
+            if len(self.in_flight) > 3:
+                names += f" и еще {len(self.in_flight) - 3}"
+            lines.append(f"В работе: {names}")
+
+        if processed_now and elapsed > 0:
+            rate = processed_now / elapsed
+            lines.append(f"Скорость: {rate * 60:.1f} файлов/мин")
+            remaining = self.total - self.done
+            if remaining and status is None:
+                lines.append(f"Осталось: ~{format_duration(remaining / rate)}")
+        if status is not None:
+            lines.append(f"Время: {format_duration(elapsed)}")
+
+        return '\n'.join(lines)
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self._edit(self.render())
+
+    async def _edit(self, text):
+        if self._message_id is None or text == self._last_text:
+            return
+        if time.monotonic() < self._not_before:
+            return
+
+        try:
+            await self.bot.edit_message_text(text, chat_id=self.chat_id, message_id=self._message_id)
+            self._last_text = text
+            self.edits += 1
+        except RetryAfter as e:
+            # Telegram просит подождать - пропускаем обновления до истечения паузы
+            self._not_before = time.monotonic() + e.retry_after
+            logger.warning(f"Прогресс в чате {self.chat_id}: flood control, пауза {e.retry_after} с")
+        except BadRequest as e:
+            if 'not modified' not in str(e).lower():
+                logger.warning(f"Не удалось обновить прогресс в чате {self.chat_id}: {e}")
+        except Exception as e:
+            logger.warning(f"Не удалось обновить прогресс в чате {self.chat_id}: {e}")
+
+    async def finish(self, status):
+        """
+        Остановка обновления и последняя правка сообщения
+        status - первая строка итогового текста («✅ Обработка завершена» и т.п.)
+        """
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Итог показываем даже во время паузы flood control
+        self._not_before = 0.0
+        await self._edit(self.render(status))
@@ -1,26 +1,28 @@
-from pyzbar.pyzbar import decode
-from PIL import Image
-import cv2
 import re
+from image_decode import load_image
 
 def extract_qr_from_image(image_path):
     """
     Извлечение URL из QR-кода на изображении
+    image_path - путь к файлу, байты или DecodedImage (image_decode):
+    HEIC, WebP, PNG и PDF читаются так же, как JPEG
     Возвращает URL или None
     """
+    # zbar и OpenCV загружаются при первом распознавании, а не при запуске бота
+    from pyzbar.pyzbar import decode
+    import cv2
+    
     try:
-        # Пробуем через PIL
-        img = Image.open(image_path)
-        decoded_objects = decode(img)
+        # Изображение, уже декодированное для Vision (или из кэша)
+        image = load_image(image_path)
+        decoded_objects = decode(image.image)
         
         if decoded_objects:
             qr_data = decoded_objects[0].data.decode('utf-8')
             return qr_data
         
-        # Если не получилось, пробуем через OpenCV с улучшением
-        img_cv = cv2.imread(image_path)
-        gray = cv2.cvtColor(img_cv, cv2.COLOR_BGR2GRAY)
-        gray = cv2.equalizeHist(gray)
+        # Если не получилось, пробуем через OpenCV с улучшением (в оттенках серого)
+        gray = cv2.equalizeHist(image.gray())
         
         decoded_objects = decode(gray)
         if decoded_objects:
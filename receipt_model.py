@@ -0,0 +1,248 @@
+"""
+Данные распознанного чека (Receipt)
+
+Между Vision, валидацией, outbox и таблицами чек передается одной записью:
+сумма (Decimal), дата (date) и ИНН разбираются один раз - при создании из
+ответа Vision (Receipt.from_dict), а не в каждом месте записи. Строки таблиц
+собираются прямо из полей записи: 10 колонок реестра (registry_row) и 9 колонок
+таблицы анализа (analysis_row). Сумма и дата в сообщениях и в таблицах - в
+одном формате («7 021.00 ₽», «13.08.2025»), как бы их ни написал Vision.
+
+Поля записи - __slots__ (dataclass(slots=True)): без словаря атрибутов на
+каждый чек, что заметно при тысячах чеков в задаче анализа и в outbox.
+Нераспознанные сумма и дата хранятся исходным текстом (raw_amount, raw_date) -
+в таблицу попадает то, что прочитал Vision.
+
+Те же функции разбирают значения, прочитанные из таблицы (registry_mirror,
+registry_shards): Sheets отдает даты сериальными числами, суммы - числами,
+а ИНН - числом без ведущего нуля.
+"""
+import re
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from decimal import Decimal, InvalidOperation
+
+NOT_RECOGNIZED = 'Не распознано'
+
+DATE_FORMAT = '%d.%m.%Y'
+DATE_RE = re.compile(r'(\d{1,2})\.(\d{1,2})\.(\d{4})')
+# Пробелы (в том числе неразрывные), знак рубля и «руб.» в сумме
+AMOUNT_NOISE_RE = re.compile(r'[\s₽]|руб\.?', re.IGNORECASE)
+CENTS = Decimal('0.01')
+# Нулевой день сериальных дат Google Sheets
+SHEETS_EPOCH = date(1899, 12, 30)
+
+
+def parse_amount(value):
+    """
+    Сумма чека Decimal с копейками: '7 021,00 ₽' → Decimal('7021.00')
+    None - суммы нет или она не разбирается
+    """
+    if isinstance(value, Decimal):
+        return value.quantize(CENTS)
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        amount = Decimal(str(value))
+        return amount.quantize(CENTS) if amount.is_finite() else None
+    if not isinstance(value, str) or not value or value == NOT_RECOGNIZED:
+        return None
+
+    clean = AMOUNT_NOISE_RE.sub('', value).replace(',', '.')
+    try:
+        amount = Decimal(clean)
+    except InvalidOperation:
+        return None
+    return amount.quantize(CENTS) if amount.is_finite() else None
+
+
+def extract_amount_number(amount_str):
+    """
+    Извлекает число из строки суммы (0 - не распознано)
+    Например: "7 021.00 ₽" → 7021.00
+    """
+    amount = parse_amount(amount_str)
+    return float(amount) if amount is not None else 0.0
+
+
+def format_amount(amount):
+    """Decimal('7021.00') → '7 021.00 ₽'"""
+    return f"{amount:,.2f}".replace(',', ' ') + ' ₽'
+
+
+def parse_receipt_date(value):
+    """
+    Дата чека из строки '13.08.2025', date/datetime или сериального числа Sheets
+    None - не разбирается
+    """
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        try:
+            return SHEETS_EPOCH + timedelta(days=int(value))
+        except (OverflowError, ValueError):
+            return None
+    if not isinstance(value, str):
+        return None
+
+    value = value.strip()
+    match = DATE_RE.fullmatch(value)
+    if match:
+        day, month, year = map(int, match.groups())
+        try:
+            return date(year, month, day)
+        except ValueError:
+            return None
+    for fmt in ('%Y-%m-%d', '%d.%m.%y'):
+        try:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+def inn_digits(value):
+    """
+    ИНН строкой из 10 или 12 цифр, '' - если не распознан
+    Число (ячейка Sheets, USER_ENTERED) теряет ведущий ноль - он восстанавливается
+    """
+    if value is None or isinstance(value, bool):
+        return ''
+    if isinstance(value, float):
+        if not value.is_integer():
+            return ''
+        value = int(value)
+    if isinstance(value, int):
+        digits = str(value)
+        if len(digits) in (9, 11):
+            digits = '0' + digits
+        return digits if len(digits) in (10, 12) else ''
+
+    digits = re.sub(r'[\s-]', '', str(value))
+    return digits if digits.isdigit() and len(digits) in (10, 12) else ''
+
+
+def normalize_inn(value):
+    """ИНН из 10 или 12 цифр без пробелов; иное - исходным текстом (ошибка видна в таблице)"""
+    if value is None or value == '':
+        return ''
+    return inn_digits(value) or str(value).strip()
+
+
+@dataclass(slots=True)
+class Receipt:
+    """
+    Распознанный чек
+
+    date/amount - None, если не распознаны (исходный текст - raw_date/raw_amount)
+    """
+    date: date = None
+    amount: Decimal = None
+    full_name: str = NOT_RECOGNIZED
+    buyer_inn: str = NOT_RECOGNIZED
+    services: str = NOT_RECOGNIZED
+    status: str = NOT_RECOGNIZED
+    seller_inn: str = ''
+    fns_url: str = ''
+    drive_link: str = ''
+    error_details: str = ''
+    raw_date: str = ''
+    raw_amount: str = ''
+    # Расход OpenAI на распознавание (vision_usage) - для статистики
+    vision_usage: dict = None
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Чек из словаря: ответ Vision (после validate_and_clean_data), запись
+        outbox (to_dict) или старая запись outbox со строковыми полями
+        """
+        raw_date = data.get('date') or ''
+        raw_amount = data.get('amount') or ''
+        receipt_date = parse_receipt_date(raw_date)
+        amount = parse_amount(raw_amount)
+        return cls(
+            date=receipt_date,
+            amount=amount,
+            full_name=data.get('full_name') or NOT_RECOGNIZED,
+            buyer_inn=normalize_inn(data.get('buyer_inn')) or NOT_RECOGNIZED,
+            services=data.get('services') or NOT_RECOGNIZED,
+            status=data.get('status') or NOT_RECOGNIZED,
+            seller_inn=normalize_inn(data.get('seller_inn')),
+            fns_url=data.get('fns_url') or '',
+            drive_link=data.get('drive_link') or '',
+            error_details=data.get('error_details') or '',
+            raw_date='' if receipt_date else str(raw_date),
+            raw_amount='' if amount is not None else str(raw_amount),
+            vision_usage=data.get('vision_usage'),
+        )
+
+    def to_dict(self):
+        """Словарь для хранения (JSON в outbox) и отчетов; from_dict восстанавливает чек"""
+        return {
+            'date': self.date_text,
+            'amount': self.amount_text,
+            'full_name': self.full_name,
+            'buyer_inn': self.buyer_inn,
+            'services': self.services,
+            'status': self.status,
+            'seller_inn': self.seller_inn,
+            'fns_url': self.fns_url,
+            'drive_link': self.drive_link,
+            'error_details': self.error_details,
+            'vision_usage': self.vision_usage,
+        }
+
+    @property
+    def date_text(self):
+        """Дата для таблиц и сообщений: '13.08.2025' (или как ее прочитал Vision)"""
+        if self.date:
+            return self.date.strftime(DATE_FORMAT)
+        return self.raw_date or NOT_RECOGNIZED
+
+    @property
+    def amount_text(self):
+        """Сумма для сообщений: '7 021.00 ₽' (или как ее прочитал Vision)"""
+        if self.amount is not None:
+            return format_amount(self.amount)
+        return self.raw_amount or NOT_RECOGNIZED
+
+    @property
+    def amount_value(self):
+        """Сумма числом для колонки «Сумма» (0 - не распознана)"""
+        return float(self.amount) if self.amount is not None else 0
+
+    @property
+    def date_obj(self):
+        """Дата для папки и имени файла на Drive (нет даты - текущая)"""
+        receipt_date = self.date or date.today()
+        return datetime(receipt_date.year, receipt_date.month, receipt_date.day)
+
+    def registry_row(self, timestamp, source):
+        """Строка реестра, колонки A:J (см. SheetsHandler.build_receipt_row)"""
+        return [
+            self.date_text,
+            self.full_name,
+            self.buyer_inn,
+            self.services,
+            self.amount_value,
+            self.status,
+            self.fns_url,
+            self.drive_link,
+            timestamp,
+            source,
+        ]
+
+    def analysis_row(self):
+        """Строка таблицы анализа, колонки A:I (без времени и источника, с ошибками)"""
+        return [
+            self.date_text,
+            self.full_name,
+            self.buyer_inn,
+            self.services,
+            self.amount_value,
+            self.status,
+            self.fns_url,
+            self.drive_link,
+            self.error_details,
+        ]
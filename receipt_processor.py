@@ -2,11 +2,151 @@ from qr_parser import extract_qr_from_image, parse_fns_url
 from ocr_handler import extract_text_from_image, parse_receipt_data, validate_and_clean_data
 from drive_handler import DriveHandler
 from sheets_handler import SheetsHandler
+from receipt_model import Receipt, parse_amount
+from vision_usage import record_routing, record_quality_rejection
+from image_decode import load_image
+from image_quality import QUALITY_GATE, check_quality, format_rejection
 import os
+import re
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from datetime import datetime
 from dotenv import load_dotenv
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# QR-код и Vision не зависят друг от друга и выполняются одновременно.
+# Vision отвечает секунды, и QR к этому времени обычно готов; если нет - после
+# ответа Vision QR ждем не дольше QR_GRACE секунд, а медленный или упавший QR
+# только оставляет чек без ссылки ФНС
+QR_GRACE = float(os.getenv('QR_GRACE', '0.2'))
+# Таймаут одного запроса к Vision (клиент OpenAI повторяет запрос при сбоях)
+VISION_TIMEOUT = float(os.getenv('VISION_TIMEOUT', '60'))
+# Потоков распознавания QR на процесс (cv2/zbar отпускают GIL)
+QR_WORKERS = int(os.getenv('QR_WORKERS', str(min(4, os.cpu_count() or 1))))
+# Маршрутизация Vision:
+# low_first - сначала дешевый запрос в низком качестве (detail=low), в высоком -
+# только если обязательных полей нет или они не проходят проверку формата
+# off - сразу в качестве по умолчанию (как раньше)
+VISION_ROUTING = os.getenv('VISION_ROUTING', 'low_first')
+
+_qr_executor = None
+_qr_executor_lock = threading.Lock()
+
+
+def get_qr_executor():
+    """
+    Пул потоков распознавания QR (создается при первом обращении)
+    """
+    global _qr_executor
+    with _qr_executor_lock:
+        if _qr_executor is None:
+            _qr_executor = ThreadPoolExecutor(max_workers=QR_WORKERS, thread_name_prefix='qr')
+    return _qr_executor
+
+
+def start_qr_decode(image):
+    """
+    Запуск распознавания QR в пуле; контекст (contextvars) вызывающего потока
+    переносится в поток пула, как в asyncio.to_thread
+    image - путь к файлу или DecodedImage
+    """
+    context = contextvars.copy_context()
+    return get_qr_executor().submit(context.run, extract_qr_from_image, image)
+
+
+def join_qr_decode(future, grace=QR_GRACE):
+    """
+    Результат распознавания QR после ответа Vision: ждем не дольше grace секунд
+    Возвращает URL или None (QR не найден, не успел или упал)
+    """
+    try:
+        return future.result(timeout=grace)
+    except FutureTimeoutError:
+        # Еще не начавшийся QR снимается с очереди, выполняющийся - доработает впустую
+        future.cancel()
+        logger.warning(f"QR не распознан за {grace:.1f} с после Vision - чек сохраняется без ссылки ФНС")
+        return None
+    except Exception as e:
+        logger.warning(f"Ошибка распознавания QR: {e}")
+        return None
+
+
+def escalation_reasons(data):
+    """
+    Чем плох ответ Vision: пустые обязательные поля (validate_and_clean_data)
+    и ошибки формата суммы, даты и ИНН. Пустой список - ответ годится
+    """
+    # validate_and_clean_data меняет словарь - проверяем копию
+    _, error_details = validate_and_clean_data(dict(data))
+    reasons = [error for error in error_details.split('; ') if error]
+
+    amount = data.get('amount')
+    if amount:
+        value = parse_amount(amount)
+        if value is None or value <= 0:
+            reasons.append("Некорректный формат суммы")
+
+    date = data.get('date')
+    if date:
+        try:
+            datetime.strptime(date, '%d.%m.%Y')
+        except ValueError:
+            reasons.append("Некорректный формат даты")
+
+    seller_inn = data.get('seller_inn')
+    if seller_inn and not re.match(r'^\d{12}$', seller_inn):
+        reasons.append("Некорректный формат ИНН продавца")
+
+    return reasons
+
+
+def recognize_receipt(vision_parser, image_path, timeout=VISION_TIMEOUT, routing=None):
+    """
+    Распознавание чека через Vision с маршрутизацией (VISION_ROUTING)
+    При low_first ответ низкого качества проверяется escalation_reasons и при
+    замечаниях запрос повторяется в высоком; ошибка API не повторяется -
+    запрос в высоком качестве упрется в ту же ошибку
+    Ответ в высоком качестве заменяет ответ в низком, только если он разобран:
+    при ошибке повтора (API, таймаут, JSON) остается ответ в низком качестве,
+    а его замечания переходят в error_details
+    Возвращает (success, data, message), как parse_receipt
+    """
+    routing = routing or VISION_ROUTING
+    if routing != 'low_first':
+        success, data, message = vision_parser.parse_receipt(image_path, timeout=timeout)
+        if vision_parser.last_error is None:
+            record_routing(escalated=False, unresolved=success and bool(escalation_reasons(data)))
+        return success, data, message
+
+    success, data, message = vision_parser.parse_receipt(image_path, timeout=timeout, detail='low')
+    if not success and vision_parser.last_error is not None:
+        return success, data, message
+
+    reasons = escalation_reasons(data) if success else [message]
+    if not reasons:
+        record_routing(escalated=False, unresolved=False)
+        return success, data, message
+
+    logger.info(f"Vision: ответа в низком качестве недостаточно ({'; '.join(reasons)}) - "
+                f"повтор в высоком")
+    high_success, high_data, high_message = vision_parser.parse_receipt(
+        image_path, timeout=timeout, detail='high'
+    )
+    if high_success or not success:
+        record_routing(escalated=True, unresolved=high_success and bool(escalation_reasons(high_data)))
+        return high_success, high_data, high_message
+
+    logger.warning(f"Vision: повтор в высоком качестве не удался ({high_message}) - "
+                   f"остается ответ в низком")
+    record_routing(escalated=True, unresolved=True)
+    return success, dict(data, error_details='; '.join(reasons)), message
+
+
 class ReceiptProcessor:
     def __init__(self, user_folder_id=None, user_sheet_id=None):
         """
@@ -29,39 +169,60 @@ class ReceiptProcessor:
     def process_receipt_image(self, image_path):
         """
         Обработка чека из изображения через OpenAI Vision
+        image_path - фото (JPEG, PNG, WebP, HEIC) или PDF: формат определяется
+        по содержимому (image_decode)
+        Возвращает (success, receipt, message): receipt - receipt_model.Receipt
+        (при ошибке - None)
         """
         try:
             from openai_vision import OpenAIVisionParser
             
-            # 1. Парсинг QR-кода для получения URL
-            qr_url = extract_qr_from_image(image_path)
-            qr_data = parse_fns_url(qr_url) if qr_url else {}
+            # 0. Декодирование: одно изображение для QR и Vision
+            image = load_image(image_path)
+            
+            # Проверка качества: размытое, темное или мелкое фото не отправляем в Vision
+            quality = check_quality(image)
+            if quality and not quality.ok and QUALITY_GATE == 'reject':
+                record_quality_rejection()
+                return False, None, format_rejection(quality)
+            
+            # 1. Парсинг QR-кода для получения URL - в фоне, одновременно с Vision
+            qr_future = start_qr_decode(image)
             
             # 2. Парсинг данных через OpenAI Vision
             vision_parser = OpenAIVisionParser()
-            success, receipt_data, message = vision_parser.parse_receipt(image_path)
+            success, receipt_data, message = recognize_receipt(vision_parser, image)
             
             if not success:
-                return False, receipt_data, message
+                qr_future.cancel()
+                return False, None, message
             
-            # 3. Добавляем URL из QR в данные
+            # 3. Добавляем URL из QR в данные (после Vision QR ждем не дольше QR_GRACE)
+            qr_url = join_qr_decode(qr_future)
+            qr_data = parse_fns_url(qr_url) if qr_url else {}
             if qr_data:
                 receipt_data['fns_url'] = qr_data.get('fns_url', '')
             
             # 4. Валидация (теперь всегда возвращает True)
             is_valid, error_details = validate_and_clean_data(receipt_data)
 
-            # Добавляем информацию об ошибках в данные
-            receipt_data['error_details'] = error_details
+            # Добавляем информацию об ошибках в данные: замечания к ответу низкого
+            # качества, если повтор не удался (recognize_receipt), и советы по качеству фото
+            parts = [error_details, receipt_data.get('error_details')]
+            if quality and not quality.ok:
+                parts.append(quality.advice())
+            errors = [error for part in parts if part for error in part.split('; ')]
+            receipt_data['error_details'] = '; '.join(dict.fromkeys(errors))
 
-            return True, receipt_data, "OK"
+            # 5. Сумма, дата и ИНН разбираются один раз - дальше чек идет записью
+            return True, Receipt.from_dict(receipt_data), "OK"
             
         except Exception as e:
-            return False, {}, f"Ошибка обработки: {str(e)}"
+            return False, None, f"Ошибка обработки: {str(e)}"
 
-    def upload_and_save(self, image_path, receipt_data, source_link=None, source_name=None):
+    def upload_and_save(self, image_path, receipt, source_link=None, source_name=None):
         """
-        Загрузка чека на Drive и сохранение в Sheets
+        Загрузка чека (receipt_model.Receipt) на Drive и сохранение в Sheets
         
         source_link - ссылка на папку анализа (если чек из папки)
         source_name - название источника (если чек из папки)
@@ -72,16 +233,16 @@ class ReceiptProcessor:
             # 1. Загружаем файл на Drive
             drive_result = self.drive.upload_file(
                 file_path=image_path,
-                buyer_inn=receipt_data['buyer_inn'],
-                receipt_date=receipt_data['date_obj'],
-                full_name=receipt_data['full_name']
+                buyer_inn=receipt.buyer_inn,
+                receipt_date=receipt.date_obj,
+                full_name=receipt.full_name
             )
             
             # 2. Добавляем ссылку на Drive в данные
-            receipt_data['drive_link'] = drive_result['web_link']
+            receipt.drive_link = drive_result['web_link']
             
             # 3. Сохраняем в Google Sheets (с информацией об источнике)
-            self.sheets.add_receipt_data(receipt_data, source_link, source_name)
+            self.sheets.add_receipt_data(receipt, source_link, source_name)
             
             result_message = f"""
 ✅ Чек успешно обработан!
@@ -96,17 +257,17 @@ class ReceiptProcessor:
         except Exception as e:
             return False, f"Ошибка при сохранении: {str(e)}"
     
-    def add_to_user_sheet(self, receipt_data, source_link=None, source_name=None):
+    def add_to_user_sheet(self, receipt, source_link=None, source_name=None):
         """
         Добавление записи в корневую таблицу пользователя
         (используется при анализе папки для дублирования записей)
         
-        receipt_data - данные чека
+        receipt - чек (receipt_model.Receipt)
         source_link - ссылка на папку анализа
         source_name - название источника
         """
         try:
-            self.sheets.add_receipt_data(receipt_data, source_link, source_name)
+            self.sheets.add_receipt_data(receipt, source_link, source_name)
             return True
         except Exception as e:
             return False
\ No newline at end of file
@@ -0,0 +1,154 @@
+"""
+Выгрузка реестра чеков в файл (/export)
+
+Строки читаются из локальной копии реестра (registry_mirror) по одной и сразу
+пишутся в файл, поэтому реестр в сотни тысяч строк не собирается в памяти:
+- csv: CSV, сжатый gzip (разделитель ';', десятичная запятая и UTF-8 с BOM -
+  так файл без настройки открывает русский Excel)
+- xlsx: openpyxl в режиме write_only (строки сбрасываются на диск по мере записи,
+  сам формат уже сжат zip)
+"""
+import csv
+import gzip
+import logging
+import re
+from datetime import date, datetime
+
+from registry_mirror import COLUMNS, HEADERS
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ('csv', 'xlsx')
+FILE_SUFFIXES = {'csv': '.csv.gz', 'xlsx': '.xlsx'}
+
+# Лимит Telegram на отправку файла ботом
+TELEGRAM_FILE_LIMIT = 50 * 1024 * 1024
+
+# Символы, с которых Excel/openpyxl начинают формулу
+FORMULA_PREFIXES = ('=', '+', '@')
+
+
+def parse_export_args(args):
+    """
+    Аргументы /export: формат (csv/xlsx), год, даты ДД.ММ.ГГГГ (с/по), ИНН
+    Возвращает словарь fmt, date_from, date_to, inn; ValueError - при ошибке
+    """
+    options = {'fmt': 'xlsx', 'date_from': None, 'date_to': None, 'inn': None}
+    dates = []
+    for arg in args or []:
+        value = arg.strip().lower()
+        if value in EXPORT_FORMATS:
+            options['fmt'] = value
+        elif re.fullmatch(r'\d{4}', value):
+            year = int(value)
+            options['date_from'], options['date_to'] = date(year, 1, 1), date(year, 12, 31)
+        elif re.fullmatch(r'\d{2}\.\d{2}\.\d{4}', value):
+            try:
+                dates.append(datetime.strptime(value, '%d.%m.%Y').date())
+            except ValueError:
+                raise ValueError(f"Некорректная дата: {arg}")
+        elif re.fullmatch(r'\d{10}|\d{12}', value):
+            options['inn'] = value
+        else:
+            raise ValueError(f"Непонятный параметр: {arg}")
+
+    if len(dates) > 2:
+        raise ValueError("Укажи не больше двух дат: начало и конец периода")
+    if dates:
+        options['date_from'] = dates[0]
+        options['date_to'] = dates[1] if len(dates) == 2 else None
+    if options['date_from'] and options['date_to'] and options['date_from'] > options['date_to']:
+        raise ValueError("Дата начала позже даты конца")
+    return options
+
+
+def export_file_name(fmt, date_from=None, date_to=None, inn=None):
+    """Имя файла выгрузки: 'Реестр чеков 01.01.2025-31.12.2025 9705246070.xlsx'"""
+    parts = ['Реестр чеков']
+    if date_from or date_to:
+        start = date_from.strftime('%d.%m.%Y') if date_from else '...'
+        end = date_to.strftime('%d.%m.%Y') if date_to else '...'
+        parts.append(f"{start}-{end}")
+    if inn:
+        parts.append(inn)
+    return ' '.join(parts) + FILE_SUFFIXES[fmt]
+
+
+def _safe_text(value):
+    """Текст не должен превратиться в формулу при открытии файла"""
+    if value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def _csv_row(record):
+    row = []
+    for column in COLUMNS:
+        value = record.get(column)
+        if column == 'date':
+            value = datetime.strptime(value, '%Y-%m-%d').strftime('%d.%m.%Y') if value else ''
+        elif column == 'amount':
+            # Нераспознанная сумма в копии - 0.0 (extract_amount_number), но записи
+            # без суммы (старый журнал) выгружаются пустой ячейкой, как в xlsx
+            value = '' if value is None else f"{value:.2f}".replace('.', ',')
+        else:
+            value = _safe_text(value or '')
+        row.append(value)
+    return row
+
+
+def _xlsx_row(record):
+    row = []
+    for column in COLUMNS:
+        value = record.get(column)
+        if column == 'date':
+            value = date.fromisoformat(value) if value else None
+        elif column != 'amount':
+            value = _safe_text(value or '')
+        row.append(value)
+    return row
+
+
+def write_registry_export(mirror, path, fmt='xlsx', date_from=None, date_to=None, inn=None):
+    """
+    Запись выгрузки в файл path (синхронная функция - выполнять в потоке)
+    mirror - RegistryMirror; фильтр по датам и ИНН считается по столбцам копии,
+    полные записи читаются из журнала по одной
+    Возвращает число выгруженных чеков
+    """
+    rows = mirror.select_rows(date_from=date_from, date_to=date_to, inn=inn)
+    records = mirror.iter_records(rows)
+
+    if fmt == 'csv':
+        with gzip.open(path, 'wt', encoding='utf-8-sig', newline='', compresslevel=6) as f:
+            writer = csv.writer(f, delimiter=';')
+            writer.writerow(HEADERS)
+            for record in records:
+                writer.writerow(_csv_row(record))
+    elif fmt == 'xlsx':
+        from openpyxl import Workbook
+        from openpyxl.cell import WriteOnlyCell
+
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet('Реестр чеков')
+        sheet.column_dimensions['A'].width = 12
+        sheet.column_dimensions['B'].width = 24
+        sheet.column_dimensions['C'].width = 14
+        sheet.column_dimensions['D'].width = 30
+        sheet.append(HEADERS)
+
+        date_cell = WriteOnlyCell(sheet)
+        date_cell.number_format = 'DD.MM.YYYY'
+        amount_cell = WriteOnlyCell(sheet)
+        amount_cell.number_format = '#,##0.00'
+        for record in records:
+            row = _xlsx_row(record)
+            date_cell.value, amount_cell.value = row[0], row[4]
+            # WriteOnlyCell копируется при записи строки, поэтому ячейки можно переиспользовать
+            sheet.append([date_cell, *row[1:4], amount_cell, *row[5:]])
+        workbook.save(path)
+    else:
+        raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+
+    logger.info(f"Реестр {mirror.sheet_id}: выгружено {len(rows)} строк в {fmt}")
+    return len(rows)
@@ -0,0 +1,644 @@
+"""
+Локальная копия реестра чеков пользователя (корневой таблицы Google Sheets)
+
+Отчеты /report и /summary не читают таблицу: они считаются по локальной
+копии. Для каждого листа с чеками в REGISTRY_MIRROR_DIR хранится журнал -
+по строке JSON на строку листа (повторная запись той же строки заменяет
+предыдущую): <sheet_id>.jsonl для листа до разбиения по периодам и
+<sheet_id>_<период>.jsonl для листов периодов (registry_shards). Отчеты
+читают все листы таблицы сразу (get_registry_view). Журнал пополняется:
+- при записи чека (SheetsHandler.add_receipt_data) - номер строки берется
+  из updatedRange ответа Sheets
+- фоновой синхронизацией раз в REGISTRY_SYNC_INTERVAL секунд: на каждом листе
+  читаются только строки начиная с первой отсутствующей в копии (правки
+  вручную и чеки, записанные другими воркерами)
+- полной синхронизацией раз в REGISTRY_FULL_SYNC_HOURS часов: журнал
+  перезаписывается содержимым таблицы (удаленные и исправленные строки)
+
+В памяти хранится только индекс журнала: для каждой строки - смещение ее
+последней записи и типизированные поля (дата, сумма, ИНН, признак
+действительности). Из индекса строятся столбцы numpy, агрегаты считаются
+векторно; полные записи (для выгрузки) читаются с диска по смещению.
+Запись в журнал защищена flock: с одним каталогом могут работать
+несколько воркеров. Полная синхронизация читает таблицу без блокировки и
+берет ее только на замену журнала.
+"""
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date
+
+from receipt_model import extract_amount_number, inn_digits, parse_receipt_date
+from registry_shards import LEGACY, shard_key
+
+try:
+    import fcntl
+except ImportError:  # Windows: блокировка между процессами недоступна
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+REGISTRY_MIRROR_DIR = os.getenv('REGISTRY_MIRROR_DIR', 'registry_mirror')
+REGISTRY_SYNC_INTERVAL = int(os.getenv('REGISTRY_SYNC_INTERVAL', '900'))
+REGISTRY_FULL_SYNC_HOURS = float(os.getenv('REGISTRY_FULL_SYNC_HOURS', '24'))
+# Строк таблицы за один запрос при синхронизации
+REGISTRY_SYNC_PAGE_ROWS = int(os.getenv('REGISTRY_SYNC_PAGE_ROWS', '5000'))
+
+# Колонки A:J корневой таблицы (см. SheetsHandler.add_receipt_data)
+COLUMNS = ('date', 'full_name', 'buyer_inn', 'services', 'amount',
+           'status', 'fns_url', 'drive_link', 'added', 'source')
+
+# Заголовки этих колонок в таблице (см. SheetsHandler.setup_headers)
+HEADERS = ('Дата', 'ФИО', 'ИНН покупателя', 'Наименование услуг', 'Сумма',
+           'Статус', 'Ссылка ФНС', 'Ссылка Drive', 'Добавлено (МСК)', 'Источник')
+
+# Первая строка таблицы - заголовки
+FIRST_DATA_ROW = 2
+
+CANCELLED_STATUS = 'Аннулирован'
+
+def iso_date(value):
+    """Дата чека в формате ISO (YYYY-MM-DD) или None - так она хранится в журнале"""
+    receipt_date = parse_receipt_date(value)
+    return receipt_date.isoformat() if receipt_date else None
+
+
+def row_number_from_range(updated_range):
+    """Номер первой строки из диапазона вида "'Лист1'!A5:J5" или None"""
+    match = re.search(r'![A-Z]+(\d+)', updated_range or '')
+    if not match:
+        match = re.match(r'[A-Z]+(\d+)', updated_range or '')
+    return int(match.group(1)) if match else None
+
+
+def hyperlink_text(value):
+    """
+    Текст ячейки-гиперссылки: бот пишет в колонку «Источник» формулу
+    =HYPERLINK("url"; "текст"), а Sheets при чтении отдает ее текст
+    """
+    match = re.fullmatch(r'=HYPERLINK\("[^"]*"\s*[;,]\s*"([^"]*)"\)', value.strip(), re.IGNORECASE)
+    return match.group(1) if match else value
+
+
+def record_from_values(row, values):
+    """
+    Запись журнала из значений строки таблицы (колонки A:J)
+    Пустая строка записывается с признаком empty, чтобы синхронизация
+    не перечитывала ее каждый раз
+    """
+    values = list(values or [])
+    if not any(v not in ('', None) for v in values):
+        return {'row': row, 'empty': True}
+
+    values += [''] * (len(COLUMNS) - len(values))
+    record = dict(zip(COLUMNS, values))
+    record['row'] = row
+    record['date'] = iso_date(record['date'])
+    record['amount'] = extract_amount_number(record['amount'])
+    record['buyer_inn'] = inn_digits(record['buyer_inn'])
+    for key in ('full_name', 'services', 'status', 'fns_url', 'drive_link', 'added', 'source'):
+        record[key] = '' if record[key] is None else str(record[key])
+    record['source'] = hyperlink_text(record['source'])
+    return record
+
+
+class RegistryQueries:
+    """
+    Агрегаты по типизированным столбцам реестра (columns()) - общие для
+    копии одного листа и для всех листов таблицы
+    """
+
+    def _mask(self, columns, inn=None, year=None, date_from=None, date_to=None, valid_only=True):
+        import numpy as np
+
+        mask = columns['valid'].copy() if valid_only else np.ones(len(columns['row']), dtype=bool)
+        if inn:
+            mask &= columns['inn'] == inn
+        if year:
+            date_from, date_to = date(year, 1, 1), date(year, 12, 31)
+        # Строки без даты под фильтр по датам не попадают (NaT не сравнивается)
+        if date_from:
+            mask &= columns['day'] >= np.datetime64(date_from, 'D')
+        if date_to:
+            mask &= columns['day'] <= np.datetime64(date_to, 'D')
+        return mask
+
+    def report(self, inn=None, year=None):
+        """
+        Суммы по ИНН покупателя и месяцу (аннулированные чеки не учитываются)
+        Возвращает список (inn, month, count, total); month - 'YYYY-MM' или None
+        """
+        import numpy as np
+
+        columns = self.columns()
+        mask = self._mask(columns, inn, year)
+        if not mask.any():
+            return []
+
+        inns, inn_index = np.unique(columns['inn'][mask], return_inverse=True)
+        months, month_index = np.unique(
+            columns['day'][mask].astype('datetime64[M]'), return_inverse=True
+        )
+        key = inn_index * len(months) + month_index
+        size = len(inns) * len(months)
+        counts = np.bincount(key, minlength=size)
+        totals = np.bincount(key, weights=columns['amount'][mask], minlength=size)
+
+        result = []
+        for k in np.flatnonzero(counts):
+            month = months[k % len(months)]
+            result.append((
+                str(inns[k // len(months)]),
+                None if np.isnat(month) else str(month),
+                int(counts[k]),
+                float(totals[k]),
+            ))
+        return result
+
+    def summary(self, today=None):
+        """Общие итоги реестра"""
+        import numpy as np
+
+        columns = self.columns()
+        valid = columns['valid']
+        day = columns['day']
+        amount = columns['amount']
+
+        today = np.datetime64(today or date.today(), 'D')
+        month_start = today.astype('datetime64[M]').astype('datetime64[D]')
+        this_month = valid & (day >= month_start) & (day <= today)
+        dated = day[valid & ~np.isnat(day)]
+
+        return {
+            'count': int(valid.sum()),
+            'total': float(amount[valid].sum()),
+            'cancelled': int((~valid).sum()),
+            'no_date': int((valid & np.isnat(day)).sum()),
+            'no_inn': int((valid & (columns['inn'] == '')).sum()),
+            'inn_count': len(set(columns['inn'][valid].tolist()) - {''}),
+            'month_count': int(this_month.sum()),
+            'month_total': float(amount[this_month].sum()),
+            'first_date': str(dated.min()) if dated.size else None,
+            'last_date': str(dated.max()) if dated.size else None,
+        }
+
+
+class RegistryMirror(RegistryQueries):
+    """
+    Локальная копия одного листа таблицы-реестра
+    (sheet_id - ключ листа: registry_shards.shard_key)
+
+    Использование:
+        mirror = get_mirror(sheet_id)
+        mirror.append([record_from_values(5, row_values)])
+        rows = mirror.report(year=2025)
+    """
+
+    def __init__(self, sheet_id, directory=REGISTRY_MIRROR_DIR):
+        self.sheet_id = sheet_id
+        base = os.path.join(directory, re.sub(r'[^A-Za-z0-9_-]', '_', sheet_id))
+        self.directory = directory
+        self.journal_path = base + '.jsonl'
+        self.meta_path = base + '.meta.json'
+        self.lock_path = base + '.lock'
+
+        self._lock = threading.Lock()
+        # row -> (смещение записи в журнале, пустая, дата, сумма, ИНН, действителен)
+        self._index = {}
+        self._offset = 0
+        self._inode = None
+        self._columns = None
+
+    # --- журнал ---
+
+    @contextmanager
+    def _file_lock(self):
+        """Эксклюзивная блокировка журнала (между потоками и процессами)"""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.lock_path, 'a') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def append(self, records):
+        """Дописать записи в журнал (повторная запись строки заменяет прежнюю)"""
+        if not records:
+            return
+        lines = ''.join(json.dumps(r, ensure_ascii=False) + '\n' for r in records)
+        with self._file_lock():
+            with open(self.journal_path, 'a', encoding='utf-8') as f:
+                f.write(lines)
+        self.refresh()
+
+    def _generation(self):
+        """
+        (inode, размер) журнала: inode меняется только при перезаписи,
+        размер растет при дописывании; (None, 0) - журнала еще нет
+        """
+        try:
+            stat = os.stat(self.journal_path)
+        except FileNotFoundError:
+            return None, 0
+        return stat.st_ino, stat.st_size
+
+    def replace(self, pages):
+        """
+        Перезаписать журнал целиком (полная синхронизация)
+        pages - итерируемое списков записей (страницы чтения таблицы)
+        Возвращает число записей
+
+        Страницы читаются из таблицы во временный файл без блокировки журнала -
+        запись чеков не ждет чтения всего листа. Блокировка берется только на
+        замену: записи, дописанные в журнал за время чтения, переносятся в конец
+        нового журнала (повторная запись строки заменяет прочитанную), а если
+        журнал за это время перезаписал другой воркер, новый файл отбрасывается
+        """
+        count = 0
+        with self._file_lock():
+            inode, size = self._generation()
+        fd, tmp_path = tempfile.mkstemp(
+            dir=self.directory, prefix=os.path.basename(self.journal_path) + '.', suffix='.tmp'
+        )
+        try:
+            with open(fd, 'w', encoding='utf-8') as f:
+                for page in pages:
+                    f.write(''.join(json.dumps(r, ensure_ascii=False) + '\n' for r in page))
+                    count += len(page)
+
+            with self._file_lock():
+                current_inode, _ = self._generation()
+                if inode is not None and current_inode != inode:
+                    logger.info(f"Реестр {self.sheet_id}: журнал уже перезаписан другим воркером")
+                else:
+                    if current_inode is not None:
+                        with open(self.journal_path, 'rb') as journal, open(tmp_path, 'ab') as f:
+                            journal.seek(size)
+                            f.write(journal.read())
+                    os.replace(tmp_path, self.journal_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        self.refresh()
+        return count
+
+    def refresh(self):
+        """
+        Дочитать журнал с места, на котором остановились
+        (записи других воркеров); после перезаписи журнала - читается заново
+        """
+        with self._lock:
+            try:
+                f = open(self.journal_path, 'rb')
+            except FileNotFoundError:
+                return
+
+            with f:
+                stat = os.fstat(f.fileno())
+                if stat.st_ino != self._inode or stat.st_size < self._offset:
+                    self._index = {}
+                    self._offset = 0
+                    self._inode = stat.st_ino
+                    self._columns = None
+                if stat.st_size == self._offset:
+                    return
+                f.seek(self._offset)
+                data = f.read(stat.st_size - self._offset)
+
+            # Последняя строка может быть дописана не до конца
+            complete = data[:data.rfind(b'\n') + 1]
+            position = self._offset
+            for line in complete.splitlines(keepends=True):
+                offset, position = position, position + len(line)
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.warning(f"Реестр {self.sheet_id}: поврежденная строка журнала пропущена")
+                    continue
+                if record.get('empty'):
+                    self._index[record['row']] = (offset, True, None, 0.0, '', False)
+                else:
+                    self._index[record['row']] = (
+                        offset, False, record['date'], record['amount'],
+                        record['buyer_inn'], record['status'] != CANCELLED_STATUS,
+                    )
+
+            self._offset += len(complete)
+            if complete:
+                self._columns = None
+
+    def exists(self):
+        return os.path.exists(self.journal_path)
+
+    def iter_records(self, rows=None):
+        """
+        Записи по порядку строк; читаются из журнала по одной,
+        поэтому выгрузка любого размера не держит реестр в памяти
+        rows - номера строк (по умолчанию - все непустые)
+        """
+        self.refresh()
+        with self._lock:
+            inode = self._inode
+            if rows is None:
+                rows = sorted(row for row, entry in self._index.items() if not entry[1])
+            positions = [self._index[row][0] for row in rows if row in self._index]
+
+        if inode is None:
+            return
+        with open(self.journal_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_ino != inode:
+                # Журнал только что перезаписан - смещения устарели
+                yield from self.iter_records(rows)
+                return
+            for position in positions:
+                f.seek(position)
+                yield json.loads(f.readline())
+
+    def find_drive_links(self, links, last_rows=1000):
+        """Какие из ссылок Drive есть в последних last_rows непустых строках"""
+        self.refresh()
+        with self._lock:
+            rows = sorted(row for row, entry in self._index.items() if not entry[1])[-last_rows:]
+        return {r['drive_link'] for r in self.iter_records(rows) if r['drive_link'] in links}
+
+    def first_missing_row(self):
+        """Первая строка таблицы, которой нет в копии"""
+        self.refresh()
+        with self._lock:
+            row = FIRST_DATA_ROW
+            while row in self._index:
+                row += 1
+            return row
+
+    # --- время синхронизации (общее для воркеров) ---
+
+    def read_meta(self):
+        try:
+            with open(self.meta_path, encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def write_meta(self, **fields):
+        with self._file_lock():
+            meta = self.read_meta()
+            meta.update(fields)
+            self._save_meta(meta)
+
+    def _save_meta(self, meta):
+        tmp_path = f"{self.meta_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self.meta_path)
+
+    def shards(self):
+        """Периоды листов таблицы, у которых есть копии (хранятся в meta таблицы)"""
+        return self.read_meta().get('shards', [])
+
+    def add_shard(self, period):
+        """Запомнить лист периода: его копия войдет в get_registry_view"""
+        if period in self.shards():
+            return
+        with self._file_lock():
+            meta = self.read_meta()
+            meta['shards'] = sorted(set(meta.get('shards', [])) | {period})
+            self._save_meta(meta)
+
+    # --- столбцы ---
+
+    def columns(self):
+        """
+        Типизированные столбцы numpy: row, day (datetime64[D], NaT - дата
+        не распознана), amount (float64), inn (строка), valid (не аннулирован)
+        """
+        self.refresh()
+        with self._lock:
+            if self._columns is None:
+                self._columns = self._build_columns()
+            return self._columns
+
+    def _build_columns(self):
+        import numpy as np
+
+        rows = sorted(row for row, entry in self._index.items() if not entry[1])
+        entries = [self._index[row] for row in rows]
+        return {
+            'row': np.array(rows, dtype=np.int64),
+            'day': np.array([e[2] or 'NaT' for e in entries], dtype='datetime64[D]'),
+            'amount': np.array([e[3] for e in entries], dtype=np.float64),
+            'inn': np.array([e[4] for e in entries], dtype='<U12'),
+            'valid': np.array([e[5] for e in entries], dtype=bool),
+        }
+
+    def select_rows(self, date_from=None, date_to=None, inn=None):
+        """
+        Номера строк, подходящих под фильтр (включая аннулированные чеки)
+        date_from, date_to - datetime.date (включительно)
+        """
+        columns = self.columns()
+        mask = self._mask(columns, inn, date_from=date_from, date_to=date_to, valid_only=False)
+        return columns['row'][mask].tolist()
+
+
+class RegistryView(RegistryQueries):
+    """
+    Все листы таблицы-реестра как один реестр: столбцы копий листов
+    склеиваются, строки обозначаются парами (номер копии, номер строки)
+    """
+
+    def __init__(self, sheet_id, mirrors):
+        self.sheet_id = sheet_id
+        self.mirrors = mirrors
+        self._parts = None
+        self._columns = None
+
+    def read_meta(self):
+        return self.mirrors[0].read_meta()
+
+    def columns(self):
+        """Столбцы как у RegistryMirror.columns() и shard - номер копии листа"""
+        import numpy as np
+
+        parts = [mirror.columns() for mirror in self.mirrors]
+        if self._parts is None or any(a is not b for a, b in zip(parts, self._parts)):
+            columns = {
+                key: np.concatenate([part[key] for part in parts])
+                for key in ('row', 'day', 'amount', 'inn', 'valid')
+            }
+            columns['shard'] = np.repeat(
+                np.arange(len(parts), dtype=np.int64), [len(part['row']) for part in parts]
+            )
+            self._parts, self._columns = parts, columns
+        return self._columns
+
+    def select_rows(self, date_from=None, date_to=None, inn=None):
+        """Строки под фильтр - пары (копия, строка) для iter_records"""
+        columns = self.columns()
+        mask = self._mask(columns, inn, date_from=date_from, date_to=date_to, valid_only=False)
+        return list(zip(columns['shard'][mask].tolist(), columns['row'][mask].tolist()))
+
+    def iter_records(self, rows=None):
+        """Записи всех листов (старый лист, затем периоды) или строк select_rows"""
+        if rows is None:
+            for mirror in self.mirrors:
+                yield from mirror.iter_records()
+            return
+        # Пары идут по порядку копий - каждая копия читается одним проходом
+        start = 0
+        while start < len(rows):
+            shard = rows[start][0]
+            end = start
+            while end < len(rows) and rows[end][0] == shard:
+                end += 1
+            yield from self.mirrors[shard].iter_records([row for _, row in rows[start:end]])
+            start = end
+
+    def find_drive_links(self, links, last_rows=1000):
+        found = set()
+        for mirror in self.mirrors:
+            found |= mirror.find_drive_links(links, last_rows)
+        return found
+
+
+_mirrors = {}
+_mirrors_lock = threading.Lock()
+
+
+def get_mirror(sheet_id):
+    """Копия листа (одна на процесс для каждого ключа листа)"""
+    with _mirrors_lock:
+        if sheet_id not in _mirrors:
+            _mirrors[sheet_id] = RegistryMirror(sheet_id)
+        return _mirrors[sheet_id]
+
+
+def get_registry_view(sheet_id):
+    """
+    Реестр таблицы целиком: копия листа до разбиения (в ее meta - время
+    синхронизации и список периодов) и копии листов периодов
+    """
+    primary = get_mirror(sheet_id)
+    return RegistryView(
+        sheet_id, [primary] + [get_mirror(shard_key(sheet_id, p)) for p in primary.shards()]
+    )
+
+
+def record_appended_rows(sheet_id, append_result, rows_values, period=LEGACY):
+    """
+    Добавить в копию строки, только что записанные в таблицу одним append
+    append_result - ответ spreadsheets.values.append (строки идут подряд
+    с первой строки updatedRange)
+    period - период листа (registry_shards), LEGACY - лист до разбиения
+    Ошибки копии не должны мешать записи чека - они только логируются
+    (строки позже подтянет синхронизация)
+    """
+    try:
+        row = row_number_from_range(append_result.get('updates', {}).get('updatedRange'))
+        if row is None:
+            return
+        get_mirror(shard_key(sheet_id, period)).append(
+            [record_from_values(row + i, values) for i, values in enumerate(rows_values)]
+        )
+        if period is not LEGACY:
+            get_mirror(sheet_id).add_shard(period)
+    except Exception as e:
+        logger.warning(f"Реестр {sheet_id}: строки не добавлены в локальную копию: {e}")
+
+
+def find_drive_links(sheet_id, links, last_rows=1000):
+    """
+    Какие из ссылок Drive уже есть в последних last_rows строках таблицы
+    Перед поиском копия дочитывается из таблицы: строку могли записать,
+    но ответ на append потерялся (синхронная функция - выполнять в потоке)
+    """
+    sync_registry(sheet_id)
+    return get_registry_view(sheet_id).find_drive_links(links, last_rows)
+
+
+def sync_due(sheet_id, now=None):
+    """
+    Какая синхронизация нужна: 'full', 'delta' или None
+    (учитывается время синхронизации любым воркером)
+    """
+    now = now or time.time()
+    meta = get_mirror(sheet_id).read_meta()
+    if now - meta.get('full_sync', 0) >= REGISTRY_FULL_SYNC_HOURS * 3600:
+        return 'full'
+    if now - meta.get('delta_sync', 0) >= REGISTRY_SYNC_INTERVAL:
+        return 'delta'
+    return None
+
+
+def sync_registry(sheet_id, full=False):
+    """
+    Синхронизация копий всех листов таблицы (синхронная функция - выполнять в потоке)
+    full=False - на каждом листе читаются строки начиная с первой отсутствующей в копии
+    Возвращает число прочитанных строк
+    """
+    from sheets_handler import SheetsHandler
+
+    primary = get_mirror(sheet_id)
+    sheets = SheetsHandler(sheet_id)
+    tabs = sheets.data_tabs()
+    now = time.time()
+
+    count = 0
+    complete = True
+    for period, tab in tabs:
+        tab_count, tab_full = sync_tab(sheets, shard_key(sheet_id, period), tab, full)
+        count += tab_count
+        complete &= tab_full
+
+    periods = [period for period, _ in tabs if period is not LEGACY]
+    if complete:
+        # Все листы прочитаны целиком: список периодов - ровно листы таблицы
+        primary.write_meta(full_sync=now, delta_sync=now, shards=periods)
+    else:
+        primary.write_meta(delta_sync=now)
+        for period in periods:
+            primary.add_shard(period)
+
+    logger.info(f"Реестр {sheet_id}: синхронизировано строк: {count}, листов: {len(tabs)}")
+    return count
+
+
+def sync_tab(sheets, key, tab, full=False):
+    """
+    Синхронизация копии одного листа: (прочитано строк, лист прочитан целиком)
+    """
+    mirror = get_mirror(key)
+    start = FIRST_DATA_ROW if full or not mirror.exists() else mirror.first_missing_row()
+    pages = iter_sheet_pages(sheets, start, tab)
+
+    if start == FIRST_DATA_ROW:
+        return mirror.replace(pages), True
+
+    count = 0
+    for page in pages:
+        mirror.append(page)
+        count += len(page)
+    return count, False
+
+
+def iter_sheet_pages(sheets, start, tab=None):
+    """
+    Записи таблицы страницами по REGISTRY_SYNC_PAGE_ROWS строк:
+    большой реестр не читается одним ответом и не собирается в памяти целиком
+    """
+    while True:
+        end = start + REGISTRY_SYNC_PAGE_ROWS - 1
+        values = sheets.read_rows(start, end, tab)
+        # Sheets не возвращает пустые строки в конце диапазона, поэтому короткая
+        # страница еще не конец таблицы (дальше могут быть строки после пустых)
+        if not values:
+            return
+        yield [record_from_values(start + i, row) for i, row in enumerate(values)]
+        start = end + 1
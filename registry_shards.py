@@ -0,0 +1,319 @@
+"""
+Разбиение реестра чеков пользователя на листы по периодам
+
+Реестр («<чат> - Реестр чеков») не растет на одном листе: каждая строка
+пишется на лист своего периода по дате чека - «2025 Q3» (REGISTRY_SHARD_PERIOD=
+quarter) или «2025» (year); чек без распознанной даты - на лист текущего
+периода. Лист создается при первой записи в период. Первым в таблице идет
+лист «Индекс»: период, ссылка на лист и время создания - по нему пользователь
+переходит к нужному периоду, а таблица открывается быстро (первым
+загружается маленький лист).
+
+Записи в таблицу (append) идут в небольшой лист периода, а не в конец
+многотысячного листа; локальная копия реестра (registry_mirror) хранит журнал
+на каждый лист и синхронизирует только их хвосты.
+
+Лист, на который писали до разбиения (первый лист таблицы, обычно «Чеки»),
+остается как есть - «старый» лист: его строки не переносятся, он читается
+вместе с листами периодов и записан в индекс первой строкой. Листами реестра
+считаются только листы, записанные в индекс: лист пользователя с названием
+вроде «2024» реестром не становится. REGISTRY_SHARD_PERIOD=off - прежняя запись
+на первый лист; таблица, которая уже разбита (есть индекс), и при off
+продолжает писаться на листы периодов.
+
+Какие листы есть в таблице, бот узнает из ее свойств (spreadsheets.get) и
+индекса один раз на процесс; название листа однозначно задает период, поэтому
+воркеры, одновременно создающие один лист, сходятся на нем же.
+"""
+import logging
+import os
+import re
+import threading
+from datetime import date, datetime
+
+import pytz
+
+logger = logging.getLogger(__name__)
+
+# Период листа реестра: quarter, year или off (без разбиения)
+REGISTRY_SHARD_PERIOD = os.getenv('REGISTRY_SHARD_PERIOD', 'quarter').lower()
+
+INDEX_TAB = 'Индекс'
+INDEX_HEADERS = ['Период', 'Лист', 'Создан (МСК)']
+# Строка индекса для листа, на который писали до разбиения
+LEGACY_LABEL = 'до разбиения по периодам'
+
+# Ключ журнала старого листа - сама таблица (журналы до разбиения остаются в силе)
+LEGACY = None
+
+QUARTER_RE = re.compile(r'(\d{4}) Q([1-4])')
+YEAR_RE = re.compile(r'(\d{4})')
+
+
+def sharding_enabled():
+    return REGISTRY_SHARD_PERIOD in ('quarter', 'year')
+
+
+def period_of(iso_date, period=REGISTRY_SHARD_PERIOD):
+    """
+    Период по дате ISO (YYYY-MM-DD): '2025-Q3' или '2025'
+    Без даты - период текущего дня (по Москве)
+    """
+    day = date.fromisoformat(iso_date) if iso_date else datetime.now(pytz.timezone('Europe/Moscow')).date()
+    if period == 'year':
+        return str(day.year)
+    return f"{day.year}-Q{(day.month - 1) // 3 + 1}"
+
+
+def tab_title(period):
+    """Название листа периода: '2025-Q3' → '2025 Q3', '2025' → '2025'"""
+    return period.replace('-', ' ')
+
+
+def period_from_title(title):
+    """Период по названию листа или None (не лист периода)"""
+    if QUARTER_RE.fullmatch(title) or YEAR_RE.fullmatch(title):
+        return title.replace(' ', '-')
+    return None
+
+
+def quote_tab(title):
+    """Название листа для диапазона A1: 'Лист' (кавычки внутри удваиваются)"""
+    return "'" + title.replace("'", "''") + "'"
+
+
+def shard_key(spreadsheet_id, period):
+    """Ключ локальной копии листа (registry_mirror): таблица или таблица:период"""
+    return spreadsheet_id if period is LEGACY else f"{spreadsheet_id}:{period}"
+
+
+def new_spreadsheet_sheets():
+    """Листы новой таблицы-реестра (spreadsheets.create)"""
+    title = INDEX_TAB if sharding_enabled() else 'Чеки'
+    return [{'properties': {'title': title, 'gridProperties': {'frozenRowCount': 1}}}]
+
+
+class RegistryShards:
+    """
+    Листы одной таблицы-реестра: период → название листа
+
+    Использование:
+        shards = get_registry_shards(spreadsheet_id)
+        title = shards.ensure_tab('2025-Q3')
+        for period, title in shards.tabs(): ...
+    """
+
+    def __init__(self, spreadsheet_id, service=None):
+        self.spreadsheet_id = spreadsheet_id
+        self._service = service
+        self._lock = threading.Lock()
+        # period → название листа; LEGACY → старый лист (если есть)
+        self._tabs = None
+        self._gids = {}
+
+    @property
+    def service(self):
+        if self._service is None:
+            from google_transport import build_service
+            self._service = build_service('sheets', 'v4')
+        return self._service
+
+    def _load(self):
+        """Листы таблицы из ее свойств и индекса"""
+        result = self.service.spreadsheets().get(
+            spreadsheetId=self.spreadsheet_id,
+            fields='sheets.properties(sheetId,title,index)'
+        ).execute()
+        sheets = sorted((s['properties'] for s in result.get('sheets', [])), key=lambda p: p.get('index', 0))
+        gids = {props['title']: props.get('sheetId') for props in sheets}
+
+        if INDEX_TAB in gids:
+            tabs = {period: title for period, title in self._read_index().items() if title in gids}
+        else:
+            # Разбиения еще не было: чеки на первом листе, как бы он ни назывался
+            tabs = {LEGACY: next(iter(gids))} if gids else {}
+        self._tabs, self._gids = tabs, gids
+        return gids
+
+    def _read_index(self):
+        """
+        Листы из индекса: {период: название}; старый лист (строка LEGACY_LABEL) -
+        под ключом LEGACY
+        """
+        from registry_mirror import hyperlink_text
+
+        values = self.service.spreadsheets().values().get(
+            spreadsheetId=self.spreadsheet_id,
+            range=f"{quote_tab(INDEX_TAB)}!A2:B"
+        ).execute().get('values', [])
+        tabs = {}
+        for row in values:
+            if len(row) < 2:
+                continue
+            title = hyperlink_text(str(row[1]))
+            if row[0] == LEGACY_LABEL:
+                tabs[LEGACY] = title
+            elif period_from_title(title) is not None:
+                tabs[period_from_title(title)] = title
+        return tabs
+
+    def sharded(self):
+        """Разбита ли таблица на листы периодов (есть индекс)"""
+        with self._lock:
+            if self._tabs is None:
+                self._load()
+            return INDEX_TAB in self._gids
+
+    def period_kind(self):
+        """
+        Период листов для записи: REGISTRY_SHARD_PERIOD, а при off - период
+        листов, на которые таблица уже разбита (quarter, если есть квартальные)
+        """
+        if sharding_enabled():
+            return REGISTRY_SHARD_PERIOD
+        periods = [period for period, _ in self.tabs() if period is not LEGACY]
+        return 'quarter' if not periods or any('-Q' in period for period in periods) else 'year'
+
+    def tabs(self, reload=False):
+        """
+        Листы с данными: [(период, название)], старый лист (LEGACY) - первым,
+        затем листы периодов по возрастанию
+        """
+        with self._lock:
+            if self._tabs is None or reload:
+                self._load()
+            tabs = dict(self._tabs)
+        legacy = [(LEGACY, tabs.pop(LEGACY))] if LEGACY in tabs else []
+        return legacy + sorted(tabs.items())
+
+    def ensure_tab(self, period):
+        """Название листа периода; лист создается при первой записи в период"""
+        with self._lock:
+            if self._tabs is None:
+                self._load()
+            title = self._tabs.get(period)
+            if title:
+                return title
+
+            title = tab_title(period)
+            try:
+                if INDEX_TAB not in self._gids:
+                    self._create_index()
+                self._create_tab(title)
+            except Exception as e:
+                # Индекс или лист мог только что создать другой воркер
+                # (если создан только индекс - запись повторится позже)
+                self._load()
+                if period in self._tabs:
+                    logger.info(f"Реестр {self.spreadsheet_id}: лист «{title}» уже создан ({e})")
+                    return self._tabs[period]
+                # Лист с заголовками реестра есть, но его нет в индексе: другой воркер
+                # не успел дописать строку индекса (или ее запись не удалась).
+                # Лист пользователя с тем же названием не трогаем
+                adoptable = INDEX_TAB in self._gids and title in self._gids
+                if not adoptable or not self._has_registry_headers(title):
+                    raise
+                logger.info(f"Реестр {self.spreadsheet_id}: лист «{title}» не записан в индекс - "
+                            f"добавляется ({e})")
+                self._tabs[period] = title
+                self._add_index_row(period, title)
+                return title
+
+            self._tabs[period] = title
+            self._add_index_row(period, title)
+            logger.info(f"Реестр {self.spreadsheet_id}: создан лист «{title}»")
+            return title
+
+    def _batch_update(self, requests):
+        return self.service.spreadsheets().batchUpdate(
+            spreadsheetId=self.spreadsheet_id,
+            body={'requests': requests}
+        ).execute()
+
+    def _add_sheet(self, title, index):
+        result = self._batch_update([{'addSheet': {'properties': {
+            'title': title,
+            'index': index,
+            'gridProperties': {'frozenRowCount': 1},
+        }}}])
+        sheet_id = result['replies'][0]['addSheet']['properties']['sheetId']
+        self._gids[title] = sheet_id
+        return sheet_id
+
+    def _write(self, range_, values):
+        self.service.spreadsheets().values().update(
+            spreadsheetId=self.spreadsheet_id,
+            range=range_,
+            valueInputOption='USER_ENTERED',
+            body={'values': values}
+        ).execute()
+
+    def _create_index(self):
+        """Лист «Индекс» первым в таблице; старый лист - первой строкой индекса"""
+        self._add_sheet(INDEX_TAB, 0)
+        rows = [INDEX_HEADERS]
+        legacy = self._tabs.get(LEGACY)
+        if legacy:
+            rows.append([LEGACY_LABEL, self._tab_link(legacy), ''])
+        self._write(f"{quote_tab(INDEX_TAB)}!A1:C{len(rows)}", rows)
+
+    def _create_tab(self, title):
+        """Лист периода сразу после индекса (новые периоды - ближе к началу) с заголовками"""
+        from registry_mirror import HEADERS
+
+        self._add_sheet(title, 1)
+        self._write(f"{quote_tab(title)}!A1:J1", [list(HEADERS)])
+
+    def _has_registry_headers(self, title):
+        """Заголовки листа - колонки реестра (лист создан ботом)"""
+        from registry_mirror import HEADERS
+
+        values = self.service.spreadsheets().values().get(
+            spreadsheetId=self.spreadsheet_id,
+            range=f"{quote_tab(title)}!A1:J1"
+        ).execute().get('values', [])
+        return bool(values) and tuple(values[0]) == tuple(HEADERS)
+
+    def _tab_link(self, title):
+        return f'=HYPERLINK("#gid={self._gids.get(title)}"; "{title}")'
+
+    def _add_index_row(self, period, title):
+        created = datetime.now(pytz.timezone('Europe/Moscow')).strftime('%d.%m.%Y %H:%M:%S')
+        try:
+            self.service.spreadsheets().values().append(
+                spreadsheetId=self.spreadsheet_id,
+                range=f"{quote_tab(INDEX_TAB)}!A:C",
+                valueInputOption='USER_ENTERED',
+                body={'values': [[tab_title(period), self._tab_link(title), created]]}
+            ).execute()
+        except Exception as e:
+            # Индекс - оглавление для пользователя, запись чека от него не зависит
+            logger.warning(f"Реестр {self.spreadsheet_id}: лист «{title}» не добавлен в индекс: {e}")
+
+
+_shards = {}
+_shards_lock = threading.Lock()
+
+
+def get_registry_shards(spreadsheet_id):
+    """Листы таблицы-реестра (один объект на процесс для каждой таблицы)"""
+    with _shards_lock:
+        if spreadsheet_id not in _shards:
+            _shards[spreadsheet_id] = RegistryShards(spreadsheet_id)
+        return _shards[spreadsheet_id]
+
+
+def group_rows_by_period(rows, period=REGISTRY_SHARD_PERIOD):
+    """
+    Строки реестра (колонки A:J) по периодам их дат, в исходном порядке
+    period - quarter или year
+    Возвращает {период: [строки]}
+    """
+    from receipt_model import parse_receipt_date
+
+    groups = {}
+    for row in rows:
+        receipt_date = parse_receipt_date(row[0])
+        key = period_of(receipt_date.isoformat() if receipt_date else None, period)
+        groups.setdefault(key, []).append(row)
+    return groups
@@ -0,0 +1,189 @@
+"""
+Справедливое распределение обработки чеков между чатами
+
+Любая работа с чеком (Vision, Drive, Sheets) выполняется внутри слота
+планировщика:
+- у каждого чата своя очередь, чаты обслуживаются по кругу (round-robin),
+  поэтому чат с 1000 файлами не задерживает остальных больше, чем на один файл
+- одиночные фото/PDF (INTERACTIVE) обслуживаются раньше файлов массового анализа (BATCH)
+- одновременно выполняется не больше SCHEDULER_MAX_IN_FLIGHT элементов всего
+  и SCHEDULER_PER_CHAT_IN_FLIGHT на чат; SCHEDULER_INTERACTIVE_RESERVE слотов
+  массовый анализ не занимает никогда - они остаются для одиночных чеков
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import Counter, deque
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = 0
+BATCH = 1
+
+SCHEDULER_MAX_IN_FLIGHT = int(os.getenv('SCHEDULER_MAX_IN_FLIGHT', '8'))
+SCHEDULER_PER_CHAT_IN_FLIGHT = int(os.getenv('SCHEDULER_PER_CHAT_IN_FLIGHT', '2'))
+SCHEDULER_INTERACTIVE_RESERVE = int(os.getenv('SCHEDULER_INTERACTIVE_RESERVE', '2'))
+
+
+class _Ticket:
+    def __init__(self, chat_id, priority):
+        self.chat_id = chat_id
+        self.priority = priority
+        self.created = time.monotonic()
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class FairScheduler:
+    """
+    Планировщик слотов обработки (один на процесс)
+
+    Использование:
+        async with scheduler.slot(chat_id, INTERACTIVE, on_queued=notify):
+            await asyncio.to_thread(processor.process_receipt_image, path)
+    """
+
+    def __init__(self, max_in_flight=SCHEDULER_MAX_IN_FLIGHT,
+                 per_chat=SCHEDULER_PER_CHAT_IN_FLIGHT,
+                 interactive_reserve=SCHEDULER_INTERACTIVE_RESERVE):
+        self.max_in_flight = max(1, max_in_flight)
+        self.per_chat = max(1, per_chat)
+        # Массовому анализу всегда достается хотя бы один слот
+        self.batch_limit = max(1, self.max_in_flight - interactive_reserve)
+
+        self._queues = {INTERACTIVE: {}, BATCH: {}}
+        self._rotation = {INTERACTIVE: deque(), BATCH: deque()}
+        self._in_flight = Counter()
+        self._total = 0
+        self.granted = Counter()
+        self.wait_time = Counter()
+
+    @asynccontextmanager
+    async def slot(self, chat_id, priority=INTERACTIVE, on_queued=None):
+        """
+        Слот для обработки одного элемента
+        on_queued - корутина on_queued(position), вызывается один раз,
+        если элемент не получил слот сразу
+        """
+        ticket = _Ticket(chat_id, priority)
+        self._enqueue(ticket)
+        self._dispatch()
+
+        try:
+            if not ticket.future.done():
+                if on_queued:
+                    try:
+                        await on_queued(self.position(ticket))
+                    except Exception as e:
+                        logger.warning(f"Не удалось сообщить позицию в очереди (чат {chat_id}): {e}")
+                await ticket.future
+        except BaseException:
+            # Отмена во время ожидания: убираем из очереди или возвращаем слот
+            if ticket.future.done() and not ticket.future.cancelled():
+                self._release(chat_id)
+            else:
+                ticket.future.cancel()
+                self._remove(ticket)
+            raise
+
+        waited = time.monotonic() - ticket.created
+        self.granted[priority] += 1
+        self.wait_time[priority] += waited
+        if waited > 1:
+            logger.info(f"Чат {chat_id}: ожидание слота обработки {waited:.1f} с")
+
+        try:
+            yield
+        finally:
+            self._release(chat_id)
+
+    def position(self, ticket):
+        """
+        Оценка позиции в очереди с учетом обслуживания по кругу:
+        перед элементом k-го места в очереди чата пройдет не больше k+1
+        элементов каждого другого чата, а для BATCH - еще и все INTERACTIVE
+        """
+        queue = self._queues[ticket.priority].get(ticket.chat_id, ())
+        index = next((i for i, t in enumerate(queue) if t is ticket), 0)
+
+        ahead = index
+        for chat_id, other in self._queues[ticket.priority].items():
+            if chat_id != ticket.chat_id:
+                ahead += min(len(other), index + 1)
+        if ticket.priority == BATCH:
+            ahead += sum(len(q) for q in self._queues[INTERACTIVE].values())
+        return ahead + 1
+
+    def stats(self):
+        """Текущее состояние для логов и отладки"""
+        return {
+            'in_flight': self._total,
+            'queued_interactive': sum(len(q) for q in self._queues[INTERACTIVE].values()),
+            'queued_batch': sum(len(q) for q in self._queues[BATCH].values()),
+            'avg_wait_interactive_s': self.wait_time[INTERACTIVE] / max(1, self.granted[INTERACTIVE]),
+            'avg_wait_batch_s': self.wait_time[BATCH] / max(1, self.granted[BATCH]),
+        }
+
+    def _enqueue(self, ticket):
+        queues = self._queues[ticket.priority]
+        if ticket.chat_id not in queues:
+            queues[ticket.chat_id] = deque()
+            self._rotation[ticket.priority].append(ticket.chat_id)
+        queues[ticket.chat_id].append(ticket)
+
+    def _remove(self, ticket):
+        queues = self._queues[ticket.priority]
+        queue = queues.get(ticket.chat_id)
+        if queue and ticket in queue:
+            queue.remove(ticket)
+            if not queue:
+                del queues[ticket.chat_id]
+                self._rotation[ticket.priority].remove(ticket.chat_id)
+
+    def _release(self, chat_id):
+        self._total -= 1
+        self._in_flight[chat_id] -= 1
+        if self._in_flight[chat_id] <= 0:
+            del self._in_flight[chat_id]
+        self._dispatch()
+
+    def _grant_next(self, priority):
+        """Выдать слот следующему по кругу чату данного приоритета"""
+        limit = self.max_in_flight if priority == INTERACTIVE else self.batch_limit
+        if self._total >= limit:
+            return False
+
+        queues = self._queues[priority]
+        rotation = self._rotation[priority]
+        for _ in range(len(rotation)):
+            chat_id = rotation[0]
+            rotation.rotate(-1)
+            if self._in_flight[chat_id] >= self.per_chat:
+                continue
+
+            ticket = queues[chat_id].popleft()
+            if not queues[chat_id]:
+                del queues[chat_id]
+                rotation.remove(chat_id)
+
+            self._total += 1
+            self._in_flight[chat_id] += 1
+            ticket.future.set_result(None)
+            return True
+        return False
+
+    def _dispatch(self):
+        while self._grant_next(INTERACTIVE) or self._grant_next(BATCH):
+            pass
+
+
+_scheduler = None
+
+
+def get_scheduler():
+    """Планировщик процесса (создается при первом обращении)"""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = FairScheduler()
+    return _scheduler
@@ -0,0 +1,229 @@
+"""
+Временные файлы обработки чеков (скачанные фото/PDF, страница PDF в JPEG)
+
+Файлы живут в каталоге области (scope): область открывает обработчик
+фото/PDF или задача /full_analyze, и при выходе из нее каталог удаляется
+целиком - в том числе при исключении. Каталоги - в RAM (tmpfs, по умолчанию
+/dev/shm), пока размер файлов процесса помещается в SCRATCH_QUOTA_MB; сверх
+квоты и без tmpfs - на диске. Место резервируется по заявленному размеру, а
+после записи файла (settle) учитывается настоящий: если он не помещается в
+квоту, файл переносится на диск. Каталог области
+называется по PID процесса: при запуске бот удаляет каталоги процессов,
+которых уже нет (упали, не успев убрать за собой).
+"""
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+# Каталог в RAM (tmpfs); пусто - /dev/shm, если доступен, "off" - только диск
+SCRATCH_RAM_DIR = os.getenv('SCRATCH_RAM_DIR', '')
+# Каталог на диске: для файлов сверх квоты и если tmpfs недоступен
+SCRATCH_DISK_DIR = os.getenv('SCRATCH_DISK_DIR', '') or tempfile.gettempdir()
+# Сколько файлов процесса (по заявленному размеру) держать в RAM
+SCRATCH_QUOTA_MB = int(os.getenv('SCRATCH_QUOTA_MB', '256'))
+# Размер файла, если он заранее неизвестен
+SCRATCH_DEFAULT_SIZE = 5 * MB
+
+SCRATCH_NAME = 'receipt_bot_scratch'
+
+
+def default_ram_dir():
+    """tmpfs для временных файлов или None"""
+    if SCRATCH_RAM_DIR == 'off':
+        return None
+    path = SCRATCH_RAM_DIR or '/dev/shm'
+    return path if os.path.isdir(path) and os.access(path, os.W_OK) else None
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class ScratchScope:
+    """
+    Область временных файлов: path() выдает путь для нового файла,
+    при закрытии каталоги области удаляются, а место в квоте возвращается
+    """
+
+    def __init__(self, space, name):
+        self.space = space
+        self.name = f"{os.getpid()}-{name}-{uuid.uuid4().hex[:8]}"
+        self._dirs = {}
+        self._reserved = {}
+        self._lock = threading.Lock()
+
+    def _dir(self, root):
+        with self._lock:
+            path = self._dirs.get(root)
+            if path is None:
+                path = os.path.join(root, self.name)
+                os.makedirs(path, exist_ok=True)
+                self._dirs[root] = path
+            return path
+
+    def path(self, suffix='', size=None):
+        """
+        Путь для нового файла (файл не создается)
+        size - ожидаемый размер в байтах: по нему файл попадает в RAM или на диск
+        """
+        size = int(size) if size else SCRATCH_DEFAULT_SIZE
+        root = self.space.reserve(size)
+        path = os.path.join(self._dir(root), f"{uuid.uuid4().hex}{suffix}")
+        with self._lock:
+            self._reserved[path] = (root, size)
+        return path
+
+    def settle(self, path):
+        """
+        Учет записанного файла по настоящему размеру (заявленный мог быть
+        неизвестен или занижен): файл в RAM сверх квоты переносится на диск
+        Возвращает путь к файлу (новый, если файл перенесен)
+        """
+        size = os.path.getsize(path)
+        with self._lock:
+            root, reserved = self._reserved.get(path, (None, 0))
+        if root is None:
+            return path
+
+        new_root = self.space.resize(root, reserved, size)
+        new_path = path
+        if new_root != root:
+            new_path = os.path.join(self._dir(new_root), os.path.basename(path))
+            shutil.move(path, new_path)
+            logger.info(f"Временный файл {size // MB} МБ не помещается в квоту RAM - перенесен на диск")
+        with self._lock:
+            self._reserved.pop(path, None)
+            self._reserved[new_path] = (new_root, size)
+        return new_path
+
+    def remove(self, path):
+        """Удалить файл области раньше закрытия (освобождает место в квоте)"""
+        with self._lock:
+            root, size = self._reserved.pop(path, (None, 0))
+        self.space.release(root, size)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        with self._lock:
+            reserved, self._reserved = self._reserved, {}
+            dirs, self._dirs = self._dirs, {}
+        for root, size in reserved.values():
+            self.space.release(root, size)
+        for path in dirs.values():
+            shutil.rmtree(path, ignore_errors=True)
+
+
+class ScratchSpace:
+    """
+    Корни временных файлов (RAM и диск) и квота RAM процесса
+
+    Использование:
+        with get_scratch_space().scope('pdf') as scratch:
+            path = scratch.path('.pdf', size=document.file_size)
+            await file.download_to_drive(path)
+            path = scratch.settle(path)
+            ...
+    """
+
+    def __init__(self, ram_dir=None, disk_dir=SCRATCH_DISK_DIR, quota_bytes=SCRATCH_QUOTA_MB * MB):
+        ram_dir = default_ram_dir() if ram_dir is None else ram_dir
+        self.ram_root = os.path.join(ram_dir, SCRATCH_NAME) if ram_dir else None
+        self.disk_root = os.path.join(disk_dir, SCRATCH_NAME)
+        self.quota = quota_bytes
+        self.ram_used = 0
+        self._lock = threading.Lock()
+        for root in self.roots:
+            os.makedirs(root, exist_ok=True)
+
+    @property
+    def roots(self):
+        return [root for root in (self.ram_root, self.disk_root) if root]
+
+    def reserve(self, size):
+        """Корень для файла size байт: RAM, если помещается в квоту, иначе диск"""
+        with self._lock:
+            if self.ram_root and self.ram_used + size <= self.quota:
+                self.ram_used += size
+                return self.ram_root
+        return self.disk_root
+
+    def resize(self, root, reserved, size):
+        """
+        Замена резерва reserved байт настоящим размером файла size
+        Возвращает корень, где файл должен лежать: диск, если в RAM он не помещается
+        """
+        if root != self.ram_root or root is None:
+            return root
+        with self._lock:
+            if self.ram_used - reserved + size <= self.quota:
+                self.ram_used += size - reserved
+                return root
+            self.ram_used = max(0, self.ram_used - reserved)
+        return self.disk_root
+
+    def release(self, root, size):
+        if root == self.ram_root and root is not None:
+            with self._lock:
+                self.ram_used = max(0, self.ram_used - size)
+
+    @contextmanager
+    def scope(self, name):
+        """Область временных файлов; каталоги удаляются при выходе"""
+        scope = ScratchScope(self, name)
+        try:
+            yield scope
+        finally:
+            scope.close()
+
+    def reclaim_orphans(self):
+        """
+        Удаление каталогов областей, чьих процессов уже нет
+        Вызывается при запуске до первой области, поэтому каталоги с PID этого
+        процесса тоже чужие (в контейнере PID после перезапуска тот же)
+        Возвращает число удаленных каталогов
+        """
+        removed = 0
+        for root in self.roots:
+            try:
+                names = os.listdir(root)
+            except FileNotFoundError:
+                continue
+            for name in names:
+                pid = name.split('-', 1)[0]
+                if not pid.isdigit() or (int(pid) != os.getpid() and pid_alive(int(pid))):
+                    continue
+                shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+                removed += 1
+        if removed:
+            logger.info(f"Удалено временных каталогов от прошлых запусков: {removed}")
+        return removed
+
+
+_scratch_space = None
+_scratch_space_lock = threading.Lock()
+
+
+def get_scratch_space():
+    """Временные файлы процесса (создаются при первом обращении)"""
+    global _scratch_space
+    with _scratch_space_lock:
+        if _scratch_space is None:
+            _scratch_space = ScratchSpace()
+    return _scratch_space
@@ -1,54 +1,51 @@
 # Файл: sheets_handler.py
 
-from googleapiclient.discovery import build
-from google_auth import get_google_credentials
+from google_transport import build_service
+from registry_mirror import record_appended_rows
+from registry_shards import (
+    get_registry_shards, group_rows_by_period, sharding_enabled, quote_tab, LEGACY
+)
 from datetime import datetime
 import pytz
 
-def extract_amount_number(amount_str):
+
+class PartialAppendError(Exception):
     """
-    Извлекает число из строки суммы
-    Например: "7 021.00 ₽" → 7021.00
+    Append на одном из листов периодов не прошел, а на предыдущих строки уже
+    записаны: повторять пачку можно только после проверки, что уже записано
+    error - исходная ошибка (resp - ее ответ, для classify_error)
     """
-    if not amount_str or amount_str == "Не распознано":
-        return 0
-    
-    try:
-        # Убираем все кроме цифр, точки и запятой
-        clean_str = amount_str.replace('₽', '').replace(' ', '').replace(',', '.').strip()
-        # Преобразуем в float
-        return float(clean_str)
-    except:
-        return 0
+    partial = True
+
+    def __init__(self, error, written_tabs):
+        super().__init__(f"{error} (строки уже записаны на листов: {written_tabs})")
+        self.error = error
+        self.resp = getattr(error, 'resp', None)
+
 
 class SheetsHandler:
     def __init__(self, spreadsheet_id):
         """
         Инициализация handler для Google Sheets
-        spreadsheet_id - ID таблицы
+        spreadsheet_id - ID таблицы-реестра (строки пишутся на листы периодов - registry_shards)
         """
-        creds = get_google_credentials()
-        self.service = build('sheets', 'v4', credentials=creds)
+        self.service = build_service('sheets', 'v4')
         self.spreadsheet_id = spreadsheet_id
     
-    def add_receipt_data(self, data, source_link=None, source_name=None):
-        """
-        Добавление данных чека в таблицу
-        data - словарь с полями:
-        {
-            'full_name': 'Фамилия И.О.',
-            'amount': '7 021,00 ₽',
-            'services': 'актерские услуги',
-            'buyer_inn': '9705246070',
-            'date': '13.08.2025',
-            'status': 'Действителен / Аннулирован',
-            'fns_url': 'https://...',
-            'drive_link': 'https://...',
-            'error_details': ''  # для ошибок
-        }
+    def add_receipt_data(self, receipt, source_link=None, source_name=None):
+        """
+        Добавление чека в таблицу
+        receipt - receipt_model.Receipt (дата, ФИО, ИНН покупателя, услуги,
+        сумма, статус, ссылки ФНС и Drive)
         source_link - ссылка на папку анализа (если чек из папки)
         source_name - название источника (если чек из папки)
         """
+        return self.add_receipt_rows([self.build_receipt_row(receipt, source_link, source_name)])
+    
+    def build_receipt_row(self, receipt, source_link=None, source_name=None):
+        """
+        Строка таблицы (колонки A:J) из чека - см. add_receipt_data
+        """
         # Получаем текущее время в московском часовом поясе
         moscow_tz = pytz.timezone('Europe/Moscow')
         timestamp = datetime.now(moscow_tz).strftime('%d.%m.%Y %H:%M:%S')
@@ -61,36 +58,125 @@ class SheetsHandler:
             # Обычная загрузка чека
             source_value = 'Прямая загрузка'
         
-        # Формируем строку для добавления
-        row = [
-            data.get('date', 'Не распознано'),
-            data.get('full_name', 'Не распознано'),
-            data.get('buyer_inn', 'Не распознано'),
-            data.get('services', 'Не распознано'),
-            extract_amount_number(data.get('amount', '0')),
-            data.get('status', 'Не распознано'),
-            data.get('fns_url', ''),
-            data.get('drive_link', ''),
-            timestamp,
-            source_value  # Колонка J - "Источник"
-        ]
+        # Колонка J - "Источник"
+        return receipt.registry_row(timestamp, source_value)
+    
+    def add_receipt_rows(self, rows):
+        """
+        Добавление нескольких строк (build_receipt_row): по одному запросу
+        на каждый лист периода, к которому относятся даты чеков
+        Возвращает список ответов append; если запрос к листу не прошел после
+        записи на другие листы - PartialAppendError
+        """
+        shards = self._shards()
+        if shards is None:
+            return [self._append_rows(None, LEGACY, rows)]
         
-        # Добавляем строку в конец таблицы
+        results = []
+        for period, period_rows in group_rows_by_period(rows, shards.period_kind()).items():
+            try:
+                results.append(self._append_rows(shards.ensure_tab(period), period, period_rows))
+            except Exception as e:
+                if results:
+                    raise PartialAppendError(e, len(results)) from e
+                raise
+        return results
+    
+    def _shards(self):
+        """
+        Листы периодов таблицы или None - запись на первый лист
+        Таблица, которая уже разбита на периоды, пишется на листы периодов
+        и при REGISTRY_SHARD_PERIOD=off (первый лист у нее - индекс)
+        """
+        shards = get_registry_shards(self.spreadsheet_id)
+        if sharding_enabled() or shards.sharded():
+            return shards
+        return None
+    
+    def _append_rows(self, tab, period, rows):
+        # Добавляем строки в конец листа (tab=None - первый лист таблицы)
         body = {
-            'values': [row]
+            'values': rows
         }
         result = self.service.spreadsheets().values().append(
             spreadsheetId=self.spreadsheet_id,
-            range='A:J',
+            range=self._range(tab, 'A:J'),
             valueInputOption='USER_ENTERED',
             body=body
         ).execute()
         
+        # Те же строки - в локальную копию листа (для /report и /summary)
+        record_appended_rows(self.spreadsheet_id, result, rows, period)
+        
         return result
     
+    @staticmethod
+    def _range(tab, cells):
+        return f"{quote_tab(tab)}!{cells}" if tab else cells
+    
+    def read_rows(self, start_row=2, end_row=None, tab=None):
+        """
+        Чтение строк листа tab (колонки A:J) с start_row по end_row (None - до конца)
+        tab=None - первый лист таблицы
+        Значения без форматирования: суммы и ИНН - числами, даты - как в таблице
+        """
+        result = self.service.spreadsheets().values().get(
+            spreadsheetId=self.spreadsheet_id,
+            range=self._range(tab, f'A{start_row}:J{end_row or ""}'),
+            valueRenderOption='UNFORMATTED_VALUE',
+            dateTimeRenderOption='FORMATTED_STRING'
+        ).execute()
+        
+        return result.get('values', [])
+    
+    def data_tabs(self):
+        """
+        Листы с чеками: [(период, название листа)]; без разбиения - [(LEGACY, None)]
+        """
+        shards = self._shards()
+        if shards is None:
+            return [(LEGACY, None)]
+        return shards.tabs(reload=True)
+
+    def update_statuses(self, updates):
+        """
+        Запись статусов чеков (колонка F) одним batchUpdate
+        updates - [(лист, строка, ссылка ФНС, статус)]; лист None - первый лист
+        Перед записью ссылки ФНС (колонка G) перечитываются: строку, которую
+        успели удалить или сдвинуть вручную, не перезаписываем
+        Возвращает записанные элементы updates
+        """
+        if not updates:
+            return []
+
+        values = self.service.spreadsheets().values().batchGet(
+            spreadsheetId=self.spreadsheet_id,
+            ranges=[self._range(tab, f'G{row}') for tab, row, _, _ in updates],
+            valueRenderOption='UNFORMATTED_VALUE'
+        ).execute().get('valueRanges', [])
+
+        matched = []
+        for update, value_range in zip(updates, values):
+            cell = value_range.get('values', [['']])
+            if cell and cell[0] and str(cell[0][0]) == update[2]:
+                matched.append(update)
+
+        if matched:
+            self.service.spreadsheets().values().batchUpdate(
+                spreadsheetId=self.spreadsheet_id,
+                body={
+                    'valueInputOption': 'RAW',
+                    'data': [
+                        {'range': self._range(tab, f'F{row}'), 'values': [[status]]}
+                        for tab, row, _, status in matched
+                    ]
+                }
+            ).execute()
+        return matched
+
     def setup_headers(self):
         """
-        Установка заголовков таблицы (запускать один раз)
+        Установка заголовков на всех листах с чеками (запускать один раз)
         """
         headers = [
             'Дата',
@@ -108,11 +194,10 @@ class SheetsHandler:
         body = {
             'values': [headers]
         }
-        result = self.service.spreadsheets().values().update(
-            spreadsheetId=self.spreadsheet_id,
-            range='A1:J1',
-            valueInputOption='RAW',
-            body=body
-        ).execute()
-        
-        return result
\ No newline at end of file
+        for _, tab in self.data_tabs():
+            self.service.spreadsheets().values().update(
+                spreadsheetId=self.spreadsheet_id,
+                range=self._range(tab, 'A1:J1'),
+                valueInputOption='RAW',
+                body=body
+            ).execute()
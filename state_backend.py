@@ -0,0 +1,654 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Идентификатор текущего процесса-воркера (владелец задач)
+WORKER_ID = os.getenv('WORKER_ID') or f"{socket.gethostname()}:{os.getpid()}"
+
+# Статусы задач в очереди
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+ACTIVE_JOB_STATUSES = (JOB_QUEUED, JOB_RUNNING)
+
+# Поля задачи, которые можно менять через update_job
+JOB_FIELDS = ('status', 'owner', 'lease_expires_at', 'cancel_requested', 'started_at',
+              'finished_at', 'progress', 'result', 'attempts')
+JOB_JSON_FIELDS = ('payload', 'progress', 'result')
+
+
+def _new_job(kind, chat_id, payload, dedupe_key):
+    return {
+        'id': uuid.uuid4().hex,
+        'kind': kind,
+        'chat_id': chat_id,
+        'payload': payload,
+        'status': JOB_QUEUED,
+        'owner': None,
+        'lease_expires_at': None,
+        'cancel_requested': False,
+        'created_at': time.time(),
+        'started_at': None,
+        'finished_at': None,
+        'progress': {},
+        'result': {},
+        'dedupe_key': dedupe_key,
+        'attempts': 0,
+    }
+
+
+class StateBackend(ABC):
+    """
+    Хранилище состояния бота, общее для всех воркеров:
+    - структуры пользователей (chat_id -> папка/таблица)
+    - ожидающие анализа папки (/full_analyze до нажатия кнопки)
+    - позиция в ленте изменений Drive (drive_ingest)
+    - индексы дедупликации (что уже обработано)
+    - результаты проверки чеков в ФНС (кэш fns_verifier)
+    - владение задачами (какой воркер выполняет задачу)
+    - очередь фоновых задач (/full_analyze), переживающая перезапуск
+    """
+
+    # --- Структуры пользователей ---
+
+    def get_user_structure(self, chat_id):
+        """Структура пользователя или None"""
+        return self._get('user_structure', str(chat_id))
+
+    def set_user_structure(self, chat_id, structure):
+        self._set('user_structure', str(chat_id), structure)
+
+    def list_user_structures(self):
+        """Все известные структуры: {chat_id: structure}"""
+        return {int(k): v for k, v in self._items('user_structure').items()}
+
+    # --- Папки анализа ---
+
+    def get_analysis_folder(self, chat_id):
+        """Информация о папке анализа или None"""
+        return self._get('analysis_folder', str(chat_id))
+
+    def set_analysis_folder(self, chat_id, folder_info):
+        self._set('analysis_folder', str(chat_id), folder_info)
+
+    def delete_analysis_folder(self, chat_id):
+        self._delete('analysis_folder', str(chat_id))
+
+    def list_analysis_folders(self):
+        """Все папки анализа: {chat_id: folder_info}"""
+        return {int(k): v for k, v in self._items('analysis_folder').items()}
+
+    # --- Лента изменений Drive ---
+
+    def get_drive_page_token(self):
+        """Сохраненная позиция в ленте изменений Drive (drive_ingest) или None"""
+        return self._get('drive_ingest', 'page_token')
+
+    def set_drive_page_token(self, token):
+        self._set('drive_ingest', 'page_token', token)
+
+    # --- Учет запросов к OpenAI ---
+
+    @abstractmethod
+    def add_usage(self, chat_id, period, usage):
+        """
+        Прибавить счетчики usage (словарь чисел) к учету чата за период
+        (атомарно: чаты обслуживают несколько воркеров)
+        """
+
+    def get_usage(self, chat_id):
+        """Учет чата: {период: счетчики}"""
+        prefix = f"{chat_id}:"
+        return {key[len(prefix):]: value for key, value in self._items('usage').items()
+                if key.startswith(prefix)}
+
+    # --- Проверка чеков в ФНС ---
+
+    def get_receipt_check(self, receipt_key):
+        """Последний ответ ФНС о чеке (fns_verifier) или None - чек не проверялся"""
+        return self._get('fns_check', receipt_key)
+
+    def set_receipt_check(self, receipt_key, check):
+        self._set('fns_check', receipt_key, check)
+
+    # --- Дедупликация ---
+
+    @abstractmethod
+    def mark_processed(self, namespace, key):
+        """
+        Отметить ключ как обработанный
+        Возвращает True, если ключ отмечен впервые, и False, если он уже был
+        """
+
+    @abstractmethod
+    def is_processed(self, namespace, key):
+        """Отмечен ли ключ как обработанный"""
+
+    @abstractmethod
+    def clear_processed(self, namespace):
+        """Сбросить все отметки пространства namespace"""
+
+    # --- Владение задачами ---
+
+    @abstractmethod
+    def acquire_job(self, job_id, owner=WORKER_ID, ttl=600):
+        """
+        Захват задачи воркером на ttl секунд
+        Успешен, если задача свободна, срок владения истек или владелец тот же
+        (повторный вызов продлевает владение)
+        Возвращает True/False
+        """
+
+    @abstractmethod
+    def release_job(self, job_id, owner=WORKER_ID):
+        """Освободить задачу (только ее владельцем)"""
+
+    @abstractmethod
+    def get_job_owner(self, job_id):
+        """Текущий владелец задачи или None"""
+
+    # --- Очередь задач ---
+
+    @abstractmethod
+    def enqueue_job(self, kind, chat_id, payload, dedupe_key=None):
+        """
+        Постановка задачи в очередь
+        dedupe_key - если активная задача с таким ключом уже есть, новая не создается
+
+        Возвращает (job, created)
+        """
+
+    @abstractmethod
+    def claim_next_job(self, owner=WORKER_ID, lease_ttl=60):
+        """
+        Захват самой старой задачи из очереди (или задачи, чей воркер перестал
+        продлевать владение - например, упал). Возвращает job или None
+        """
+
+    @abstractmethod
+    def heartbeat_job(self, job_id, owner=WORKER_ID, lease_ttl=60):
+        """
+        Продление владения выполняемой задачей
+        Возвращает False, если задача уже не принадлежит owner
+        """
+
+    @abstractmethod
+    def update_job(self, job_id, **fields):
+        """Обновление полей задачи (см. JOB_FIELDS)"""
+
+    @abstractmethod
+    def get_job(self, job_id):
+        """Задача по id или None"""
+
+    @abstractmethod
+    def list_jobs(self, chat_id=None, statuses=None):
+        """Задачи (по чату и/или статусам) в порядке постановки в очередь"""
+
+    @abstractmethod
+    def request_job_cancel(self, job_id):
+        """
+        Отмена задачи: задача из очереди отменяется сразу, у выполняемой
+        выставляется флаг cancel_requested (воркер проверяет его между файлами)
+        Проверка статуса и обновление выполняются атомарно: задачу, которую
+        воркер только что взял, отмена не переведет обратно в cancelled
+        Возвращает обновленную задачу или None
+        """
+
+    def release_owned_jobs(self, owner=WORKER_ID):
+        """
+        Возврат выполняемых задач воркера в очередь (при остановке бота)
+        Штатная остановка не считается неудачной попыткой
+        """
+        for job in self.list_jobs(statuses=[JOB_RUNNING]):
+            if job['owner'] == owner:
+                self.update_job(job['id'], status=JOB_QUEUED, owner=None, lease_expires_at=None,
+                                attempts=max(0, job['attempts'] - 1))
+
+    # --- Низкоуровневое key-value хранилище ---
+
+    @abstractmethod
+    def _get(self, namespace, key):
+        """Значение ключа или None"""
+
+    @abstractmethod
+    def _set(self, namespace, key, value):
+        """Записать значение ключа (JSON-совместимое)"""
+
+    @abstractmethod
+    def _delete(self, namespace, key):
+        """Удалить ключ (отсутствующий - не ошибка)"""
+
+    @abstractmethod
+    def _items(self, namespace):
+        """Все ключи пространства: {ключ: значение}"""
+
+
+class MemoryStateBackend(StateBackend):
+    """
+    Состояние в памяти одного процесса (поведение по умолчанию)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._kv = {}
+        self._processed = {}
+        self._jobs = {}
+        self._queue = {}
+
+    def _get(self, namespace, key):
+        with self._lock:
+            return self._kv.get(namespace, {}).get(key)
+
+    def _set(self, namespace, key, value):
+        with self._lock:
+            self._kv.setdefault(namespace, {})[key] = value
+
+    def _delete(self, namespace, key):
+        with self._lock:
+            self._kv.get(namespace, {}).pop(key, None)
+
+    def _items(self, namespace):
+        with self._lock:
+            return dict(self._kv.get(namespace, {}))
+
+    def add_usage(self, chat_id, period, usage):
+        with self._lock:
+            totals = self._kv.setdefault('usage', {}).setdefault(f"{chat_id}:{period}", {})
+            for field, value in usage.items():
+                totals[field] = totals.get(field, 0) + value
+
+    def mark_processed(self, namespace, key):
+        with self._lock:
+            keys = self._processed.setdefault(namespace, set())
+            if key in keys:
+                return False
+            keys.add(key)
+            return True
+
+    def is_processed(self, namespace, key):
+        with self._lock:
+            return key in self._processed.get(namespace, set())
+
+    def clear_processed(self, namespace):
+        with self._lock:
+            self._processed.pop(namespace, None)
+
+    def acquire_job(self, job_id, owner=WORKER_ID, ttl=600):
+        now = time.time()
+        with self._lock:
+            current = self._jobs.get(job_id)
+            if current and current[0] != owner and current[1] > now:
+                return False
+            self._jobs[job_id] = (owner, now + ttl)
+            return True
+
+    def release_job(self, job_id, owner=WORKER_ID):
+        with self._lock:
+            current = self._jobs.get(job_id)
+            if current and current[0] == owner:
+                del self._jobs[job_id]
+
+    def get_job_owner(self, job_id):
+        with self._lock:
+            current = self._jobs.get(job_id)
+            if current and current[1] > time.time():
+                return current[0]
+            return None
+
+    def enqueue_job(self, kind, chat_id, payload, dedupe_key=None):
+        with self._lock:
+            if dedupe_key:
+                for job in self._queue.values():
+                    if job['dedupe_key'] == dedupe_key and job['status'] in ACTIVE_JOB_STATUSES:
+                        return dict(job), False
+            job = _new_job(kind, chat_id, payload, dedupe_key)
+            self._queue[job['id']] = job
+            return dict(job), True
+
+    def claim_next_job(self, owner=WORKER_ID, lease_ttl=60):
+        now = time.time()
+        with self._lock:
+            for job in sorted(self._queue.values(), key=lambda j: j['created_at']):
+                stale = job['status'] == JOB_RUNNING and (job['lease_expires_at'] or 0) < now
+                if job['status'] == JOB_QUEUED or stale:
+                    job.update(status=JOB_RUNNING, owner=owner, lease_expires_at=now + lease_ttl,
+                               started_at=job['started_at'] or now, attempts=job['attempts'] + 1)
+                    return dict(job)
+            return None
+
+    def heartbeat_job(self, job_id, owner=WORKER_ID, lease_ttl=60):
+        with self._lock:
+            job = self._queue.get(job_id)
+            if not job or job['owner'] != owner or job['status'] != JOB_RUNNING:
+                return False
+            job['lease_expires_at'] = time.time() + lease_ttl
+            return True
+
+    def update_job(self, job_id, **fields):
+        with self._lock:
+            job = self._queue.get(job_id)
+            if job:
+                job.update({k: v for k, v in fields.items() if k in JOB_FIELDS})
+
+    def get_job(self, job_id):
+        with self._lock:
+            job = self._queue.get(job_id)
+            return dict(job) if job else None
+
+    def request_job_cancel(self, job_id):
+        with self._lock:
+            job = self._queue.get(job_id)
+            if not job:
+                return None
+            if job['status'] == JOB_QUEUED:
+                job.update(status=JOB_CANCELLED, finished_at=time.time())
+            elif job['status'] == JOB_RUNNING:
+                job['cancel_requested'] = True
+            return dict(job)
+
+    def list_jobs(self, chat_id=None, statuses=None):
+        with self._lock:
+            jobs = [dict(j) for j in self._queue.values()
+                    if (chat_id is None or j['chat_id'] == chat_id)
+                    and (statuses is None or j['status'] in statuses)]
+        return sorted(jobs, key=lambda j: j['created_at'])
+
+
+class SQLiteStateBackend(StateBackend):
+    """
+    Состояние в SQLite-файле: несколько процессов-воркеров на одном хосте
+    видят одни и те же данные (WAL-режим, атомарные upsert'ы)
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._init_schema()
+
+    def _conn(self):
+        # sqlite3-соединение нельзя делить между потоками - у каждого потока свое
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout=30000')
+            self._local.conn = conn
+        return conn
+
+    def _init_schema(self):
+        self._conn().executescript("""
+            CREATE TABLE IF NOT EXISTS kv (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                PRIMARY KEY (namespace, key)
+            );
+            CREATE TABLE IF NOT EXISTS processed (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            );
+            CREATE TABLE IF NOT EXISTS job_locks (
+                job_id TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                chat_id INTEGER NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                owner TEXT,
+                lease_expires_at REAL,
+                cancel_requested INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL,
+                progress TEXT NOT NULL DEFAULT '{}',
+                result TEXT NOT NULL DEFAULT '{}',
+                dedupe_key TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at);
+            CREATE INDEX IF NOT EXISTS jobs_chat ON jobs (chat_id, created_at);
+        """)
+
+    def _transaction(self):
+        """
+        Транзакция с блокировкой на запись (BEGIN IMMEDIATE): другие процессы
+        ждут ее завершения, поэтому «прочитать и обновить» выполняется атомарно
+        """
+        backend = self
+
+        class _Tx:
+            def __enter__(self):
+                self.conn = backend._conn()
+                self.conn.execute('BEGIN IMMEDIATE')
+                return self.conn
+
+            def __exit__(self, exc_type, exc, tb):
+                self.conn.execute('ROLLBACK' if exc_type else 'COMMIT')
+                return False
+
+        return _Tx()
+
+    @staticmethod
+    def _job_from_row(row):
+        if row is None:
+            return None
+        job = dict(row)
+        for field in JOB_JSON_FIELDS:
+            job[field] = json.loads(job[field]) if job[field] else {}
+        job['cancel_requested'] = bool(job['cancel_requested'])
+        return job
+
+    def _get(self, namespace, key):
+        row = self._conn().execute(
+            'SELECT value FROM kv WHERE namespace = ? AND key = ?', (namespace, key)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _set(self, namespace, key, value):
+        self._conn().execute(
+            'INSERT INTO kv (namespace, key, value) VALUES (?, ?, ?) '
+            'ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value',
+            (namespace, key, json.dumps(value, ensure_ascii=False))
+        )
+
+    def _delete(self, namespace, key):
+        self._conn().execute('DELETE FROM kv WHERE namespace = ? AND key = ?', (namespace, key))
+
+    def _items(self, namespace):
+        rows = self._conn().execute(
+            'SELECT key, value FROM kv WHERE namespace = ?', (namespace,)
+        ).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def add_usage(self, chat_id, period, usage):
+        key = f"{chat_id}:{period}"
+        with self._transaction() as conn:
+            row = conn.execute(
+                'SELECT value FROM kv WHERE namespace = ? AND key = ?', ('usage', key)
+            ).fetchone()
+            totals = json.loads(row[0]) if row else {}
+            for field, value in usage.items():
+                totals[field] = totals.get(field, 0) + value
+            conn.execute(
+                'INSERT INTO kv (namespace, key, value) VALUES (?, ?, ?) '
+                'ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value',
+                ('usage', key, json.dumps(totals))
+            )
+
+    def mark_processed(self, namespace, key):
+        cursor = self._conn().execute(
+            'INSERT OR IGNORE INTO processed (namespace, key, created_at) VALUES (?, ?, ?)',
+            (namespace, key, time.time())
+        )
+        return cursor.rowcount == 1
+
+    def is_processed(self, namespace, key):
+        row = self._conn().execute(
+            'SELECT 1 FROM processed WHERE namespace = ? AND key = ?', (namespace, key)
+        ).fetchone()
+        return row is not None
+
+    def clear_processed(self, namespace):
+        self._conn().execute('DELETE FROM processed WHERE namespace = ?', (namespace,))
+
+    def acquire_job(self, job_id, owner=WORKER_ID, ttl=600):
+        now = time.time()
+        # Один атомарный upsert: вставка, либо перехват истекшей/своей задачи
+        cursor = self._conn().execute(
+            'INSERT INTO job_locks (job_id, owner, expires_at) VALUES (?, ?, ?) '
+            'ON CONFLICT (job_id) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at '
+            'WHERE job_locks.expires_at < ? OR job_locks.owner = excluded.owner',
+            (job_id, owner, now + ttl, now)
+        )
+        return cursor.rowcount == 1
+
+    def release_job(self, job_id, owner=WORKER_ID):
+        self._conn().execute(
+            'DELETE FROM job_locks WHERE job_id = ? AND owner = ?', (job_id, owner)
+        )
+
+    def get_job_owner(self, job_id):
+        row = self._conn().execute(
+            'SELECT owner FROM job_locks WHERE job_id = ? AND expires_at >= ?', (job_id, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def _select_jobs(self, conn, where, params):
+        conn.row_factory = sqlite3.Row
+        try:
+            rows = conn.execute(f'SELECT * FROM jobs WHERE {where}', params).fetchall()
+        finally:
+            conn.row_factory = None
+        return [self._job_from_row(r) for r in rows]
+
+    def enqueue_job(self, kind, chat_id, payload, dedupe_key=None):
+        with self._transaction() as conn:
+            if dedupe_key:
+                active = self._select_jobs(
+                    conn, 'dedupe_key = ? AND status IN (?, ?) ORDER BY created_at LIMIT 1',
+                    (dedupe_key, *ACTIVE_JOB_STATUSES)
+                )
+                if active:
+                    return active[0], False
+
+            job = _new_job(kind, chat_id, payload, dedupe_key)
+            conn.execute(
+                'INSERT INTO jobs (id, kind, chat_id, payload, status, created_at, dedupe_key) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (job['id'], kind, chat_id, json.dumps(payload, ensure_ascii=False),
+                 JOB_QUEUED, job['created_at'], dedupe_key)
+            )
+            return job, True
+
+    def claim_next_job(self, owner=WORKER_ID, lease_ttl=60):
+        now = time.time()
+        with self._transaction() as conn:
+            jobs = self._select_jobs(
+                conn,
+                'status = ? OR (status = ? AND lease_expires_at < ?) ORDER BY created_at LIMIT 1',
+                (JOB_QUEUED, JOB_RUNNING, now)
+            )
+            if not jobs:
+                return None
+
+            job = jobs[0]
+            job.update(status=JOB_RUNNING, owner=owner, lease_expires_at=now + lease_ttl,
+                       started_at=job['started_at'] or now, attempts=job['attempts'] + 1)
+            conn.execute(
+                'UPDATE jobs SET status = ?, owner = ?, lease_expires_at = ?, started_at = ?, '
+                'attempts = ? WHERE id = ?',
+                (JOB_RUNNING, owner, job['lease_expires_at'], job['started_at'], job['attempts'],
+                 job['id'])
+            )
+            return job
+
+    def heartbeat_job(self, job_id, owner=WORKER_ID, lease_ttl=60):
+        cursor = self._conn().execute(
+            'UPDATE jobs SET lease_expires_at = ? WHERE id = ? AND owner = ? AND status = ?',
+            (time.time() + lease_ttl, job_id, owner, JOB_RUNNING)
+        )
+        return cursor.rowcount == 1
+
+    def update_job(self, job_id, **fields):
+        fields = {k: v for k, v in fields.items() if k in JOB_FIELDS}
+        if not fields:
+            return
+        values = [
+            json.dumps(v, ensure_ascii=False) if k in JOB_JSON_FIELDS
+            else int(v) if k == 'cancel_requested' else v
+            for k, v in fields.items()
+        ]
+        assignments = ', '.join(f'{k} = ?' for k in fields)
+        self._conn().execute(f'UPDATE jobs SET {assignments} WHERE id = ?', (*values, job_id))
+
+    def get_job(self, job_id):
+        jobs = self._select_jobs(self._conn(), 'id = ?', (job_id,))
+        return jobs[0] if jobs else None
+
+    def request_job_cancel(self, job_id):
+        with self._transaction() as conn:
+            # Статус проверяется в том же UPDATE, что и меняется
+            conn.execute(
+                'UPDATE jobs SET '
+                'status = CASE WHEN status = ? THEN ? ELSE status END, '
+                'finished_at = CASE WHEN status = ? THEN ? ELSE finished_at END, '
+                'cancel_requested = CASE WHEN status = ? THEN 1 ELSE cancel_requested END '
+                'WHERE id = ? AND status IN (?, ?)',
+                (JOB_QUEUED, JOB_CANCELLED, JOB_QUEUED, time.time(), JOB_RUNNING,
+                 job_id, *ACTIVE_JOB_STATUSES)
+            )
+            jobs = self._select_jobs(conn, 'id = ?', (job_id,))
+            return jobs[0] if jobs else None
+
+    def list_jobs(self, chat_id=None, statuses=None):
+        conditions = []
+        params = []
+        if chat_id is not None:
+            conditions.append('chat_id = ?')
+            params.append(chat_id)
+        if statuses:
+            conditions.append(f"status IN ({', '.join('?' * len(statuses))})")
+            params.extend(statuses)
+        where = ' AND '.join(conditions) or '1 = 1'
+        return self._select_jobs(self._conn(), f'{where} ORDER BY created_at', params)
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_state_backend():
+    """
+    Хранилище состояния, выбранное через .env:
+    STATE_BACKEND=memory (по умолчанию) - один процесс
+    STATE_BACKEND=sqlite - общее для воркеров на одном хосте (путь: STATE_DB_PATH)
+    """
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            kind = os.getenv('STATE_BACKEND', 'memory').lower()
+            if kind == 'sqlite':
+                _backend = SQLiteStateBackend(os.getenv('STATE_DB_PATH', 'bot_state.sqlite3'))
+            elif kind == 'memory':
+                _backend = MemoryStateBackend()
+            else:
+                raise ValueError(f"Неизвестный STATE_BACKEND: {kind} (ожидается memory или sqlite)")
+        return _backend
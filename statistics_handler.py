@@ -1,5 +1,4 @@
-from googleapiclient.discovery import build
-from google_auth import get_google_credentials
+from google_transport import build_service
 from datetime import datetime
 import pytz
 import os
@@ -17,9 +16,8 @@ class StatisticsHandler:
         """
         Инициализация. Использует ID таблицы из .env
         """
-        creds = get_google_credentials()
-        self.service = build('sheets', 'v4', credentials=creds)
-        self.drive_service = build('drive', 'v3', credentials=creds)
+        self.service = build_service('sheets', 'v4')
+        self.drive_service = build_service('drive', 'v3')
         
         # ID таблицы статистики (нужно будет добавить в .env)
         self.spreadsheet_id = os.getenv('STATISTICS_SHEET_ID')
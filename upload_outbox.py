@@ -0,0 +1,519 @@
+"""
+Отложенная запись одиночных чеков на Drive и в Sheets (outbox)
+
+Обработчик фото/PDF не ждет загрузки: распознанный чек сразу показывается
+пользователю, файл переносится в OUTBOX_DIR, а задание записывается в
+SQLite-файл OUTBOX_DB_PATH (переживает перезапуск и общий для воркеров
+на одном хосте). Фоновый воркер пачками до OUTBOX_BATCH_SIZE заданий:
+1. загружает файлы на Drive (не больше OUTBOX_DRIVE_CONCURRENCY одновременно)
+2. добавляет строки в таблицы - одним append на таблицу для всей пачки
+3. сообщает результат (бот редактирует сообщение с распознанными данными)
+Ошибка Google не теряет чек: задание повторяется с экспоненциальной паузой
+(до OUTBOX_RETRY_MAX секунд) не больше OUTBOX_MAX_ATTEMPTS раз.
+
+Идемпотентность:
+- ключ задания - sha256 содержимого файла и ID таблицы: повторная отправка
+  того же файла (или повторная доставка обновления Telegram) не создает
+  второе задание и вторую строку
+- файл на Drive помечается appProperties.upload_key: если ответ на загрузку
+  потерян, перед повторной попыткой ищется уже загруженный файл
+- так же перед повторным append строка ищется в копии реестра по ссылке Drive
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+
+from receipt_model import Receipt
+from state_backend import WORKER_ID
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_DB_PATH = os.getenv('OUTBOX_DB_PATH', 'upload_outbox.sqlite3')
+OUTBOX_DIR = os.getenv('OUTBOX_DIR', 'upload_outbox')
+# Заданий за один проход воркера
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '20'))
+OUTBOX_DRIVE_CONCURRENCY = int(os.getenv('OUTBOX_DRIVE_CONCURRENCY', '4'))
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', '2'))
+# Пауза перед повтором: OUTBOX_RETRY_BASE * 2^(попытка-1), не больше OUTBOX_RETRY_MAX
+OUTBOX_RETRY_BASE = float(os.getenv('OUTBOX_RETRY_BASE', '5'))
+OUTBOX_RETRY_MAX = float(os.getenv('OUTBOX_RETRY_MAX', '600'))
+# 100 попыток с паузой до 10 минут - больше 15 часов недоступности Google
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '100'))
+# Сколько хранить завершенные задания (повторная отправка того же файла
+# в этот срок не создает дубль)
+OUTBOX_RETENTION_DAYS = float(os.getenv('OUTBOX_RETENTION_DAYS', '7'))
+# Срок владения пачкой: задания упавшего воркера подхватит другой
+OUTBOX_LEASE_TTL = int(os.getenv('OUTBOX_LEASE_TTL', '300'))
+
+OUTBOX_PENDING = 'pending'
+OUTBOX_DONE = 'done'
+OUTBOX_FAILED = 'failed'
+
+STAGE_DRIVE = 'drive'
+STAGE_SHEETS = 'sheets'
+
+# Ответы Google, после которых повтор бессмыслен
+PERMANENT_HTTP_STATUSES = (400, 404)
+
+OUTBOX_JSON_FIELDS = ('data', 'drive')
+
+
+def upload_key(file_path, sheet_id):
+    """
+    Ключ идемпотентности: содержимое файла + таблица, в которую он пишется
+    file_path - путь к файлу или байты файла
+    """
+    digest = hashlib.sha256()
+    if isinstance(file_path, (bytes, bytearray)):
+        digest.update(file_path)
+    else:
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+    digest.update(sheet_id.encode())
+    return digest.hexdigest()
+
+
+def write_file_atomic(path, data):
+    """Запись через временный файл: после сбоя в OUTBOX_DIR не остается обрезанный файл"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def classify_error(error):
+    """
+    (permanent, uncertain) для ошибки вызова Google:
+    permanent - повтор не поможет; uncertain - запрос мог выполниться
+    (ответ 5xx или обрыв соединения) или часть строк уже записана
+    (sheets_handler.PartialAppendError), перед повтором нужна проверка
+    """
+    partial = getattr(error, 'partial', False)
+    status = getattr(getattr(error, 'resp', None), 'status', None)
+    if status is None:
+        return False, True
+    status = int(status)
+    if status in PERMANENT_HTTP_STATUSES:
+        return True, partial
+    return False, partial or status >= 500
+
+
+def retry_delay(attempts):
+    """Экспоненциальная пауза с разбросом (воркеры не повторяют синхронно)"""
+    delay = min(OUTBOX_RETRY_MAX, OUTBOX_RETRY_BASE * 2 ** max(0, attempts - 1))
+    return delay * random.uniform(0.8, 1.2)
+
+
+class UploadOutbox:
+    """
+    Хранилище заданий на запись (SQLite) и файлов чеков (OUTBOX_DIR)
+    """
+
+    def __init__(self, db_path=OUTBOX_DB_PATH, directory=OUTBOX_DIR):
+        self.db_path = db_path
+        self.directory = directory
+        self._local = threading.local()
+        os.makedirs(directory, exist_ok=True)
+        self._init_schema()
+
+    def _conn(self):
+        # sqlite3-соединение нельзя делить между потоками - у каждого потока свое
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout=30000')
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    def _init_schema(self):
+        self._conn().executescript("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id TEXT PRIMARY KEY,
+                chat_id INTEGER NOT NULL,
+                message_id INTEGER,
+                username TEXT,
+                kind TEXT NOT NULL,
+                file_path TEXT NOT NULL,
+                folder_id TEXT NOT NULL,
+                sheet_id TEXT NOT NULL,
+                data TEXT NOT NULL,
+                source_link TEXT,
+                source_name TEXT,
+                status TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                drive TEXT NOT NULL DEFAULT '{}',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                uncertain INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                owner TEXT,
+                lease_expires_at REAL,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                finished_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at);
+        """)
+
+    def _transaction(self):
+        """
+        Транзакция с блокировкой на запись (BEGIN IMMEDIATE): другие процессы
+        ждут ее завершения, поэтому «прочитать и обновить» выполняется атомарно
+        """
+        outbox = self
+
+        class _Tx:
+            def __enter__(self):
+                self.conn = outbox._conn()
+                self.conn.execute('BEGIN IMMEDIATE')
+                return self.conn
+
+            def __exit__(self, exc_type, exc, tb):
+                self.conn.execute('ROLLBACK' if exc_type else 'COMMIT')
+                return False
+
+        return _Tx()
+
+    @staticmethod
+    def _entry_from_row(row):
+        if row is None:
+            return None
+        entry = dict(row)
+        for field in OUTBOX_JSON_FIELDS:
+            entry[field] = json.loads(entry[field]) if entry[field] else {}
+        entry['data'] = Receipt.from_dict(entry['data'])
+        entry['uncertain'] = bool(entry['uncertain'])
+        return entry
+
+    def get(self, entry_id):
+        row = self._conn().execute('SELECT * FROM outbox WHERE id = ?', (entry_id,)).fetchone()
+        return self._entry_from_row(row)
+
+    def enqueue(self, chat_id, message_id, username, kind, file_path, folder_id, sheet_id,
+                data, source_link=None, source_name=None):
+        """
+        Постановка чека в очередь записи; файл file_path переносится в OUTBOX_DIR,
+        байты (фото, скачанное в память) записываются туда сразу
+        Возвращает (entry, created): created=False - такой файл уже записан
+        или ждет записи (файл-дубль удаляется)
+        """
+        in_memory = isinstance(file_path, (bytes, bytearray))
+        key = upload_key(file_path, sheet_id)
+        if in_memory:
+            from image_decode import media_type
+            extension = media_type(file_path)[0]
+        else:
+            extension = os.path.splitext(file_path)[1]
+        stored_path = os.path.join(self.directory, key + extension)
+        now = time.time()
+
+        with self._transaction() as conn:
+            existing = self._entry_from_row(
+                conn.execute('SELECT * FROM outbox WHERE id = ?', (key,)).fetchone()
+            )
+            if existing and existing['status'] != OUTBOX_FAILED:
+                if not in_memory:
+                    os.unlink(file_path)
+                return existing, False
+
+            if in_memory:
+                write_file_atomic(stored_path, file_path)
+            else:
+                shutil.move(file_path, stored_path)
+            if existing:
+                # Неудавшийся чек прислали снова - пробуем заново
+                conn.execute(
+                    'UPDATE outbox SET status = ?, message_id = ?, attempts = 0, '
+                    'next_attempt_at = ?, file_path = ?, last_error = NULL, finished_at = NULL '
+                    'WHERE id = ?',
+                    (OUTBOX_PENDING, message_id, now, stored_path, key)
+                )
+            else:
+                conn.execute(
+                    'INSERT INTO outbox (id, chat_id, message_id, username, kind, file_path, '
+                    'folder_id, sheet_id, data, source_link, source_name, status, stage, '
+                    'next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (key, chat_id, message_id, username, kind, stored_path, folder_id, sheet_id,
+                     json.dumps(data.to_dict(), ensure_ascii=False),
+                     source_link, source_name, OUTBOX_PENDING, STAGE_DRIVE, now, now)
+                )
+            entry = self._entry_from_row(
+                conn.execute('SELECT * FROM outbox WHERE id = ?', (key,)).fetchone()
+            )
+        return entry, True
+
+    def claim_batch(self, owner=WORKER_ID, limit=OUTBOX_BATCH_SIZE, lease_ttl=OUTBOX_LEASE_TTL):
+        """
+        Захват заданий, время которых пришло (в том числе брошенных упавшим воркером)
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            rows = conn.execute(
+                'SELECT * FROM outbox WHERE status = ? AND next_attempt_at <= ? '
+                'AND (owner IS NULL OR lease_expires_at < ?) ORDER BY next_attempt_at LIMIT ?',
+                (OUTBOX_PENDING, now, now, limit)
+            ).fetchall()
+            entries = [self._entry_from_row(r) for r in rows]
+            if entries:
+                conn.execute(
+                    f"UPDATE outbox SET owner = ?, lease_expires_at = ? "
+                    f"WHERE id IN ({', '.join('?' * len(entries))})",
+                    (owner, now + lease_ttl, *[e['id'] for e in entries])
+                )
+        return entries
+
+    def complete_drive(self, entry_id, drive_result):
+        """Файл на Drive - дальше строка в таблицу"""
+        self._conn().execute(
+            'UPDATE outbox SET stage = ?, drive = ?, uncertain = 0 WHERE id = ?',
+            (STAGE_SHEETS, json.dumps(drive_result, ensure_ascii=False), entry_id)
+        )
+
+    def mark_done(self, entry_ids):
+        """Чеки записаны: задания завершены, файлы больше не нужны"""
+        now = time.time()
+        for entry_id in entry_ids:
+            row = self._conn().execute(
+                'UPDATE outbox SET status = ?, owner = NULL, finished_at = ?, uncertain = 0 '
+                'WHERE id = ? RETURNING file_path',
+                (OUTBOX_DONE, now, entry_id)
+            ).fetchone()
+            if row and os.path.exists(row['file_path']):
+                os.unlink(row['file_path'])
+
+    def mark_retry(self, entry, error, permanent=False, uncertain=False):
+        """
+        Неудачная попытка: повтор позже или окончательная ошибка
+        Возвращает обновленное задание
+        """
+        attempts = entry['attempts'] + 1
+        status = OUTBOX_FAILED if permanent or attempts >= OUTBOX_MAX_ATTEMPTS else OUTBOX_PENDING
+        now = time.time()
+        self._conn().execute(
+            'UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?, '
+            'uncertain = ?, owner = NULL, lease_expires_at = NULL, finished_at = ? WHERE id = ?',
+            (status, attempts, now + retry_delay(attempts), str(error)[:500],
+             int(uncertain or entry['uncertain']), now if status == OUTBOX_FAILED else None,
+             entry['id'])
+        )
+        return self.get(entry['id'])
+
+    def release(self, owner=WORKER_ID):
+        """Вернуть захваченные задания (при остановке бота)"""
+        self._conn().execute(
+            'UPDATE outbox SET owner = NULL, lease_expires_at = NULL WHERE owner = ? AND status = ?',
+            (owner, OUTBOX_PENDING)
+        )
+
+    def pending_count(self, chat_id=None):
+        """Сколько чеков ждут записи (всего или в чате)"""
+        if chat_id is None:
+            row = self._conn().execute(
+                'SELECT COUNT(*) FROM outbox WHERE status = ?', (OUTBOX_PENDING,)
+            ).fetchone()
+        else:
+            row = self._conn().execute(
+                'SELECT COUNT(*) FROM outbox WHERE status = ? AND chat_id = ?',
+                (OUTBOX_PENDING, chat_id)
+            ).fetchone()
+        return row[0]
+
+    def purge(self, retention_days=OUTBOX_RETENTION_DAYS):
+        """Удаление старых завершенных заданий и файлов неудавшихся"""
+        cutoff = time.time() - retention_days * 86400
+        rows = self._conn().execute(
+            'DELETE FROM outbox WHERE status IN (?, ?) AND finished_at < ? RETURNING file_path',
+            (OUTBOX_DONE, OUTBOX_FAILED, cutoff)
+        ).fetchall()
+        for row in rows:
+            if os.path.exists(row['file_path']):
+                os.unlink(row['file_path'])
+        return len(rows)
+
+
+def upload_entry_to_drive(entry):
+    """
+    Загрузка файла задания на Drive (синхронная функция - выполнять в потоке)
+    После неоднозначной ошибки сначала ищется уже загруженный файл
+    """
+    from drive_handler import DriveHandler
+
+    data = entry['data']
+    drive = DriveHandler(entry['folder_id'])
+    return drive.upload_file(
+        file_path=entry['file_path'],
+        buyer_inn=data.buyer_inn,
+        receipt_date=data.date_obj,
+        full_name=data.full_name,
+        upload_key=entry['id'],
+        check_existing=entry['uncertain']
+    )
+
+
+def append_entries_to_sheet(sheet_id, entries):
+    """
+    Строки пачки - в таблицу одним append (синхронная функция - выполнять в потоке)
+    Строки, которые могли быть записаны прошлой попыткой, сначала ищутся
+    в копии реестра по ссылке Drive
+    """
+    from sheets_handler import SheetsHandler
+    from registry_mirror import find_drive_links
+
+    if any(e['uncertain'] for e in entries):
+        present = find_drive_links(sheet_id, {e['drive']['web_link'] for e in entries})
+        if present:
+            logger.info(f"Таблица {sheet_id}: строк уже записано прошлой попыткой: {len(present)}")
+        entries = [e for e in entries if e['drive']['web_link'] not in present]
+    if not entries:
+        return
+
+    sheets = SheetsHandler(sheet_id)
+    rows = []
+    for entry in entries:
+        receipt = entry['data']
+        receipt.drive_link = entry['drive']['web_link']
+        rows.append(sheets.build_receipt_row(receipt, entry['source_link'], entry['source_name']))
+    sheets.add_receipt_rows(rows)
+
+
+class OutboxWorker:
+    """
+    Фоновая запись заданий outbox
+
+    on_result - корутина on_result(bot, entry, status), status: 'done', 'retry' или 'failed'
+    """
+
+    def __init__(self, on_result, outbox=None, poll_interval=OUTBOX_POLL_INTERVAL):
+        self.on_result = on_result
+        self.poll_interval = poll_interval
+        self._outbox = outbox
+        self.bot = None
+        self._task = None
+        self._wakeup = None
+        self.stopping = False
+
+    @property
+    def outbox(self):
+        if self._outbox is None:
+            self._outbox = get_upload_outbox()
+        return self._outbox
+
+    def wake(self):
+        """Новое задание - не ждать следующего опроса"""
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def start(self, bot):
+        self.bot = bot
+        self.stopping = False
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        pending = await asyncio.to_thread(self.outbox.pending_count)
+        logger.info(f"Запущена запись чеков (outbox), ожидают записи: {pending}")
+
+    async def stop(self):
+        """Текущая пачка дорабатывается; захваченные задания возвращаются"""
+        if not self._task:
+            return
+        self.stopping = True
+        self._wakeup.set()
+        try:
+            await asyncio.wait_for(self._task, timeout=60)
+        except asyncio.TimeoutError:
+            self._task.cancel()
+        self._task = None
+        await asyncio.to_thread(self.outbox.release, WORKER_ID)
+
+    async def _run(self):
+        last_purge = 0
+        while not self.stopping:
+            try:
+                if time.time() - last_purge > 3600:
+                    await asyncio.to_thread(self.outbox.purge)
+                    last_purge = time.time()
+                entries = await asyncio.to_thread(self.outbox.claim_batch, WORKER_ID)
+            except Exception as e:
+                logger.error(f"Outbox: ошибка чтения очереди: {e}")
+                entries = []
+
+            if entries:
+                await self.process_batch(entries)
+                continue
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def process_batch(self, entries):
+        semaphore = asyncio.Semaphore(OUTBOX_DRIVE_CONCURRENCY)
+
+        async def drive_step(entry):
+            if entry['stage'] != STAGE_DRIVE:
+                return entry
+            async with semaphore:
+                try:
+                    result = await asyncio.to_thread(upload_entry_to_drive, entry)
+                except Exception as e:
+                    await self._failed(entry, e)
+                    return None
+            await asyncio.to_thread(self.outbox.complete_drive, entry['id'], result)
+            entry.update(stage=STAGE_SHEETS, drive=result, uncertain=False)
+            return entry
+
+        uploaded = [e for e in await asyncio.gather(*(drive_step(e) for e in entries)) if e]
+
+        by_sheet = defaultdict(list)
+        for entry in uploaded:
+            by_sheet[entry['sheet_id']].append(entry)
+
+        for sheet_id, group in by_sheet.items():
+            try:
+                await asyncio.to_thread(append_entries_to_sheet, sheet_id, group)
+            except Exception as e:
+                for entry in group:
+                    await self._failed(entry, e)
+                continue
+
+            await asyncio.to_thread(self.outbox.mark_done, [e['id'] for e in group])
+            for entry in group:
+                await self._report(entry, OUTBOX_DONE)
+
+    async def _failed(self, entry, error):
+        permanent, uncertain = classify_error(error)
+        entry = await asyncio.to_thread(self.outbox.mark_retry, entry, error, permanent, uncertain)
+        logger.warning(
+            f"Outbox: чек {entry['id'][:12]} (чат {entry['chat_id']}), попытка {entry['attempts']}: {error}"
+        )
+        await self._report(entry, OUTBOX_FAILED if entry['status'] == OUTBOX_FAILED else 'retry')
+
+    async def _report(self, entry, status):
+        try:
+            await self.on_result(self.bot, entry, status)
+        except Exception as e:
+            logger.warning(f"Outbox: не удалось сообщить результат (чат {entry['chat_id']}): {e}")
+
+
+_outbox = None
+_outbox_lock = threading.Lock()
+
+
+def get_upload_outbox():
+    """Outbox процесса (создается при первом обращении)"""
+    global _outbox
+    with _outbox_lock:
+        if _outbox is None:
+            _outbox = UploadOutbox()
+        return _outbox
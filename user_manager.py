@@ -1,5 +1,5 @@
-from googleapiclient.discovery import build
-from google_auth import get_google_credentials
+from google_transport import build_service
+from registry_shards import new_spreadsheet_sheets, sharding_enabled, quote_tab, INDEX_TAB, INDEX_HEADERS
 import os
 from dotenv import load_dotenv
 
@@ -15,9 +15,8 @@ class UserManager:
         """
         Инициализация сервисов Google Drive и Sheets
         """
-        creds = get_google_credentials()
-        self.drive_service = build('drive', 'v3', credentials=creds)
-        self.sheets_service = build('sheets', 'v4', credentials=creds)
+        self.drive_service = build_service('drive', 'v3')
+        self.sheets_service = build_service('sheets', 'v4')
         self.root_folder_id = os.getenv('GOOGLE_DRIVE_FOLDER_ID')
     
     def get_chat_name(self, chat_id, username=None, chat_title=None):
@@ -140,19 +139,13 @@ class UserManager:
         Создание корневой таблицы для пользователя
         Возвращает sheet_id
         """
-        # Создаем таблицу
+        # Создаем таблицу (с разбиением по периодам - только с листом «Индекс»,
+        # листы периодов создаются при записи чеков)
         spreadsheet = {
             'properties': {
                 'title': sheet_name
             },
-            'sheets': [{
-                'properties': {
-                    'title': 'Чеки',
-                    'gridProperties': {
-                        'frozenRowCount': 1
-                    }
-                }
-            }]
+            'sheets': new_spreadsheet_sheets()
         }
         
         spreadsheet = self.sheets_service.spreadsheets().create(
@@ -185,6 +178,16 @@ class UserManager:
         """
         Установка заголовков в корневую таблицу пользователя
         """
+        if sharding_enabled():
+            # Заголовки листов периодов ставит registry_shards при их создании
+            self.sheets_service.spreadsheets().values().update(
+                spreadsheetId=sheet_id,
+                range=f"{quote_tab(INDEX_TAB)}!A1:C1",
+                valueInputOption='RAW',
+                body={'values': [INDEX_HEADERS]}
+            ).execute()
+            return
+        
         headers = [
             'Дата',
             'ФИО',
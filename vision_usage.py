@@ -0,0 +1,238 @@
+"""
+Учет запросов к OpenAI Vision: токены, стоимость, время и повторы
+
+Каждый вызов OpenAIVisionParser.parse_receipt записывается через
+record_vision_call в текущую область учета (usage_scope). Область открывает
+тот, кто обрабатывает чек: одиночное фото/PDF (bot.process_single_receipt)
+или задача /full_analyze (analysis_jobs). asyncio.to_thread переносит контекст
+в поток, поэтому вызовы из потоков попадают в область вызывающей корутины.
+Итоги области прибавляются к учету чата за месяц (StateBackend.add_usage) -
+по ним отвечает /usage. Маршрутизация чеков (receipt_processor.recognize_receipt)
+добавляет число чеков, эскалаций в высокое качество и чеков, оставшихся
+с ошибками проверки, а проверка качества фото (image_quality) - число фото,
+отклоненных без запроса к Vision.
+
+Токены изображения API отдельно не возвращает (они входят в prompt_tokens) -
+они оцениваются по размеру изображения по правилам OpenAI для detail=auto.
+"""
+import contextvars
+import logging
+import math
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Цены, $ за 1M токенов (по умолчанию - gpt-4o-mini)
+VISION_PRICE_INPUT = float(os.getenv('VISION_PRICE_INPUT', '0.15'))
+VISION_PRICE_CACHED = float(os.getenv('VISION_PRICE_CACHED', '0.075'))
+VISION_PRICE_OUTPUT = float(os.getenv('VISION_PRICE_OUTPUT', '0.60'))
+
+# Счетчики учета (все - числа, складываются)
+USAGE_FIELDS = ('calls', 'failed_calls', 'retries', 'prompt_tokens', 'cached_tokens',
+                'completion_tokens', 'image_tokens', 'wall_ms', 'cost_usd',
+                'receipts', 'escalations', 'unresolved', 'quality_rejected')
+
+# Токены изображения: база + за каждый фрагмент 512×512 (detail=high/auto)
+IMAGE_TOKEN_RATES = {
+    'gpt-4o-mini': (2833, 5667),
+    'gpt-4o': (85, 170),
+}
+
+
+def estimate_image_tokens(width, height, model, detail='auto'):
+    """
+    Токены изображения width×height: вписываем в 2048×2048, короткую сторону
+    уменьшаем до 768, считаем фрагменты 512×512; detail=low - только база
+    """
+    base, per_tile = IMAGE_TOKEN_RATES.get(model, IMAGE_TOKEN_RATES['gpt-4o'])
+    if not width or not height:
+        return 0
+    if detail == 'low':
+        return base
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return base + per_tile * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def vision_cost(prompt_tokens, cached_tokens, completion_tokens):
+    """Стоимость запроса, $ (токены из кэша дешевле)"""
+    return (
+        (prompt_tokens - cached_tokens) * VISION_PRICE_INPUT
+        + cached_tokens * VISION_PRICE_CACHED
+        + completion_tokens * VISION_PRICE_OUTPUT
+    ) / 1_000_000
+
+
+def empty_usage():
+    return dict.fromkeys(USAGE_FIELDS, 0)
+
+
+def merge_usage(total, other):
+    """Прибавить счетчики other к total (на месте); возвращает total"""
+    for field in USAGE_FIELDS:
+        total[field] = total.get(field, 0) + (other.get(field) or 0)
+    return total
+
+
+class UsageTotals:
+    """
+    Счетчики одной области учета (вызовы могут идти из нескольких потоков)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = empty_usage()
+
+    def add(self, usage):
+        with self._lock:
+            merge_usage(self._totals, usage)
+
+    def as_dict(self):
+        with self._lock:
+            totals = dict(self._totals)
+        totals['cost_usd'] = round(totals['cost_usd'], 6)
+        return totals
+
+
+_current_usage = contextvars.ContextVar('vision_usage', default=None)
+
+
+@contextmanager
+def usage_scope():
+    """
+    Область учета: все вызовы Vision внутри (в том числе из потоков
+    asyncio.to_thread) суммируются в возвращаемый UsageTotals
+    """
+    totals = UsageTotals()
+    token = _current_usage.set(totals)
+    try:
+        yield totals
+    finally:
+        _current_usage.reset(token)
+
+
+def current_usage():
+    """Счетчики текущей области учета или None"""
+    totals = _current_usage.get()
+    return totals.as_dict() if totals else None
+
+
+def record_vision_call(model, wall_ms, usage=None, image_size=None, retries=0, failed=False,
+                       detail='auto'):
+    """
+    Учет одного запроса к Vision
+    usage - usage ответа OpenAI (None, если ответа нет)
+    image_size - (ширина, высота) отправленного изображения
+    detail - качество изображения в запросе (low/high/auto)
+    """
+    prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+    completion_tokens = getattr(usage, 'completion_tokens', 0) or 0
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached_tokens = getattr(details, 'cached_tokens', 0) or 0
+    image_tokens = estimate_image_tokens(*image_size, model, detail) if image_size else 0
+
+    call = {
+        'calls': 1,
+        'failed_calls': int(failed),
+        'retries': retries,
+        'prompt_tokens': prompt_tokens,
+        'cached_tokens': cached_tokens,
+        'completion_tokens': completion_tokens,
+        'image_tokens': image_tokens,
+        'wall_ms': round(wall_ms),
+        'cost_usd': vision_cost(prompt_tokens, cached_tokens, completion_tokens),
+    }
+    logger.info(
+        f"Vision {model} ({detail}): {wall_ms:.0f} мс, токенов {prompt_tokens}+{completion_tokens} "
+        f"(изображение ~{image_tokens}, из кэша {cached_tokens}), повторов {retries}"
+        + (", ошибка" if failed else "")
+    )
+
+    totals = _current_usage.get()
+    if totals:
+        totals.add(call)
+    return call
+
+
+def record_routing(escalated, unresolved):
+    """
+    Учет маршрутизации одного чека: escalated - понадобился запрос в высоком
+    качестве, unresolved - и после него поля не прошли проверку
+    """
+    totals = _current_usage.get()
+    if totals:
+        totals.add({'receipts': 1, 'escalations': int(escalated), 'unresolved': int(unresolved)})
+
+
+def record_quality_rejection():
+    """Учет фото, отклоненного проверкой качества до запроса к Vision"""
+    totals = _current_usage.get()
+    if totals:
+        totals.add({'quality_rejected': 1})
+
+
+def usage_period(now=None):
+    """Период учета чата: месяц 'YYYY-MM'"""
+    return (now or datetime.now()).strftime('%Y-%m')
+
+
+def record_chat_usage(state, chat_id, usage):
+    """Прибавить итоги области к учету чата за текущий месяц"""
+    if not usage or not (usage.get('calls') or usage.get('quality_rejected')):
+        return
+    try:
+        state.add_usage(chat_id, usage_period(), usage)
+    except Exception as e:
+        logger.warning(f"Не удалось сохранить учет OpenAI (чат {chat_id}): {e}")
+
+
+def format_usage_short(usage):
+    """Коротко для статистики и логов: 'Vision: 2 запр., 3 120 ток., $0.0006'"""
+    tokens = f"{usage['prompt_tokens'] + usage['completion_tokens']:,}".replace(',', ' ')
+    text = f"Vision: {usage['calls']} запр., {tokens} ток., ${usage['cost_usd']:.4f}"
+    if usage.get('receipts'):
+        text += f", эскалаций {usage['escalations']}/{usage['receipts']}"
+    if usage.get('quality_rejected'):
+        text += f", отклонено по качеству фото {usage['quality_rejected']}"
+    return text
+
+
+def format_usage(title, usage):
+    """Блок для /usage"""
+    calls = usage['calls']
+    if not calls:
+        return '\n'.join([f"{title}: запросов не было"] + format_quality(usage))
+    return '\n'.join([
+        f"{title}:",
+        f"  запросов: {calls} (ошибок {usage['failed_calls']}, повторов {usage['retries']})",
+        f"  токенов на запрос: промпт {usage['prompt_tokens'] / calls:.0f} "
+        f"(изображение ~{usage['image_tokens'] / calls:.0f}, из кэша {usage['cached_tokens'] / calls:.0f}), "
+        f"ответ {usage['completion_tokens'] / calls:.0f}",
+        f"  время запроса: {usage['wall_ms'] / calls / 1000:.1f} с в среднем",
+        f"  стоимость: ${usage['cost_usd']:.4f} (${usage['cost_usd'] / calls * 1000:.2f} за 1000 запросов)",
+    ] + format_routing(usage) + format_quality(usage))
+
+
+def format_routing(usage):
+    """Строки маршрутизации для /usage (пусто, если чеков не было)"""
+    receipts = usage.get('receipts')
+    if not receipts:
+        return []
+    return [
+        f"  чеков: {receipts}, повторно в высоком качестве {usage['escalations']} "
+        f"({usage['escalations'] / receipts * 100:.0f}%), "
+        f"с ошибками проверки {usage['unresolved']} ({usage['unresolved'] / receipts * 100:.0f}%)",
+    ]
+
+
+def format_quality(usage):
+    """Строка проверки качества фото для /usage (пусто, если отклоненных не было)"""
+    rejected = usage.get('quality_rejected')
+    if not rejected:
+        return []
+    return [f"  фото отклонено до запроса (качество): {rejected}"]